@@ -13,8 +13,8 @@ chunks.
 
 from ensemble_net.util import save_model
 from ensemble_net.ensemble_selection import preprocessing, model, verify
+from ensemble_net.ensemble_selection.buffers import SharedChunkLoader
 import numpy as np
-import multiprocessing
 import time
 import xarray as xr
 import os
@@ -82,39 +82,22 @@ else:
 
 #%% Process
 
-def process_chunk(ds, ret=False, **sel):
-    if len(sel) > 0:
-        ds = ds.sel(**sel)
-    forecast_predictors, fpi = preprocessing.convert_ensemble_predictors_to_samples(ds['ENS_PRED'].values,
-                                                                                    convolved=convolved)
-    ae_targets, eti = preprocessing.convert_ae_meso_predictors_to_samples(np.expand_dims(ds['AE_TAR'].values, 3),
-                                                                          convolved=convolved)
-    fps = forecast_predictors.shape[1:]
-    if model_fields_only:
-        combined_predictors = preprocessing.combine_predictors(forecast_predictors)
-    else:
-        ae_predictors, epi = preprocessing.convert_ae_meso_predictors_to_samples(ds['AE_PRED'].values,
-                                                                                 convolved=convolved)
-        combined_predictors = preprocessing.combine_predictors(forecast_predictors, ae_predictors)
+preprocessor = preprocessing.Preprocessor.from_options('targets' if model_fields_only else 'both', convolved=convolved,
+                                                       impute_missing=impute_missing, selection=ens_sel)
 
-    # Remove samples with NaN
-    if impute_missing:
-        p, t = combined_predictors, ae_targets
-    else:
-        p, t = preprocessing.delete_nan_samples(combined_predictors, ae_targets)
 
+def process_chunk(ds, ret=False):
+    p, t = preprocessor.process(ds)
     if ret:
-        return p, t, fps
+        return p, t, preprocessor.feature_shapes['ENS_PRED']
     else:
         return p, t
 
 
-def subprocess_chunk(pid, ds, shared, **sel):
-    print('Process %d (%s): loading new predictors...' % (pid, os.getpid()))
-    p, t = process_chunk(ds, **sel)
-    shared['p'] = p
-    shared['t'] = t
-    return shared
+# Runs in the SharedChunkLoader worker process, which is forked from this script and so sees predictor_ds
+def load_chunk(chunk):
+    print('Process %s: loading new predictors...' % os.getpid())
+    return process_chunk(predictor_ds.isel(init_date=chunk))
 
 
 # Copy the file to scratch, if requested, and available
@@ -134,6 +117,7 @@ if copy_file_to_scratch:
 print('Opening predictor dataset %s...' % predictor_file)
 predictor_ds = xr.open_dataset(predictor_file, mask_and_scale=True)
 num_dates = predictor_ds.ENS_PRED.shape[0]
+layout = preprocessing.ensemble_layout(predictor_ds.ENS_PRED.dims)
 num_members = predictor_ds.AE_TAR.shape[2]
 num_stations = predictor_ds.AE_TAR.shape[-1]
 if ens_sel == {}:
@@ -170,7 +154,7 @@ while index < len(train_set):
 
 # Load the validation set
 new_ds = predictor_ds.isel(init_date=val_set)
-p_val, t_val, conv_shape = process_chunk(new_ds, ret=True, **ens_sel)
+p_val, t_val, conv_shape = process_chunk(new_ds, ret=True)
 input_shape = p_val.shape[1:]
 num_outputs = t_val.shape[1]
 
@@ -178,6 +162,7 @@ num_outputs = t_val.shape[1]
 # Build an ensemble selection model
 print('Building an EnsembleSelector model...')
 selector = model.EnsembleSelector(impute_missing=impute_missing, scale_targets=scale_targets)
+selector.preprocessor = preprocessor
 layers = (
     ('PartialConv2D', (16,), {
         'kernel_size': (3, 3),
@@ -206,7 +191,7 @@ selector.build_model(layers=layers, gpus=n_gpu, loss='mse', optimizer='adam', me
 print('Fitting the EnsembleSelector Imputer and Scaler...')
 fit_set = train_set[:scaler_fit_size]
 new_ds = predictor_ds.isel(init_date=fit_set)
-predictors, targets = process_chunk(new_ds, **ens_sel)
+predictors, targets = process_chunk(new_ds)
 selector.init_fit(predictors, targets)
 
 
@@ -214,35 +199,21 @@ selector.init_fit(predictors, targets)
 # Train and evaluate the model
 print('Training the EnsembleSelector model...')
 start_time = time.time()
-first_chunk = True
-manager = multiprocessing.Manager()
-shared_chunk = manager.dict()
 history = []
-for loop in range(loops):
-    print('  Loop %d of %d' % (loop+1, loops))
-    for chunk in range(len(chunks)):
+# A background process loads the next chunk into shared memory while training on the current one
+samples_per_date = num_members * (predictor_ds.dims['convolution'] if convolved else 1)
+max_chunk_samples = max(len(c) for c in chunks) * samples_per_date
+with SharedChunkLoader(load_chunk, input_shape, t_val.shape[1:], max_chunk_samples, dtype=p_val.dtype) as loader:
+    for c, (predictors, targets) in enumerate(loader.iterate(chunks * loops)):
+        loop, chunk = divmod(c, len(chunks))
+        if chunk == 0:
+            print('  Loop %d of %d' % (loop+1, loops))
         print('    Data chunk %d of %d' % (chunk+1, len(chunks)))
-        predictors, targets, new_ds = (None, None, None)
-        # If we're on the first chunk, we need to do an initial set of the predictors and targets. Afterwards, we
-        # spawn a background process to load the next chunk while training on the current one.
-        if first_chunk:
-            new_ds = predictor_ds.isel(init_date=chunks[chunk])
-            predictors, targets = process_chunk(new_ds, **ens_sel)
-            first_chunk = False
-        else:
-            predictors, targets = (shared_chunk['p'].copy(), shared_chunk['t'].copy())
-        # Process the next chunk
-        next_chunk = (chunk + 1 if chunk < len(chunks) - 1 else 0)
-        new_ds = predictor_ds.isel(init_date=chunks[next_chunk])
-        process = multiprocessing.Process(target=subprocess_chunk, args=(1, new_ds, shared_chunk), kwargs=ens_sel)
-        process.start()
         # Fit the Selector
         print('    Training...')
         hist = selector.fit(predictors, targets, batch_size=batch_size, epochs=epochs_per_chunk, initialize=False,
                             verbose=1, validation_data=(p_val, t_val))
         history.append(hist)
-        # Wait for the background process to finish
-        process.join()
 
 end_time = time.time()
 
@@ -280,42 +251,37 @@ result = xr.Dataset(
 result['prediction'] = (('time', 'member', 'station', 'variable'), predicted)
 result['target'] = (('time', 'member', 'station', 'variable'), t_test)
 
-# Run the selection on the validation set
-selector_scores = []
-selector_ranks = []
-verif_ranks = []
-verif_scores = []
-last_time_scores = []
-last_time_ranks = []
-for day in val_set:
-    day_as_list = [day]
-    if print_results:
+# Run the selection on the validation set, for all days at once
+new_ds = predictor_ds.isel(init_date=val_set, **ens_sel)
+select_predictors, select_shape = preprocessing.format_select_predictors(new_ds.ENS_PRED.values,
+                                                                         None if model_fields_only else
+                                                                         new_ds.AE_PRED.values,
+                                                                         None, convolved=convolved,
+                                                                         num_members=num_members,
+                                                                         layout=layout, split_dates=True)
+select_verif = verify.select_verification(new_ds.AE_TAR.values, select_shape, date_axis=1,
+                                          convolved=convolved, agg=verify.stdmean)
+select_verif_12 = verify.select_verification(new_ds.AE_PRED[:, :, :, [-1]].values, select_shape, date_axis=1,
+                                             convolved=convolved, agg=verify.stdmean)
+selection = selector.select(select_predictors, select_shape, date_axis=1, agg=verify.stdmean)
+selector_scores = selection[:, :, 0]
+selector_ranks = selection[:, :, 1]
+verif_scores = select_verif[:, :, 0]
+verif_ranks = select_verif[:, :, 1]
+last_time_scores = select_verif_12[:, :, 0]
+last_time_ranks = select_verif_12[:, :, 1]
+if print_results:
+    selector_rank_scores = verify.rank_score(selector_ranks, verif_ranks, axis=1)
+    last_time_rank_scores = verify.rank_score(last_time_ranks, verif_ranks, axis=1)
+    selector_mse = np.mean((selector_scores - verif_scores) ** 2., axis=1)
+    last_time_mse = np.mean((last_time_scores - verif_scores) ** 2., axis=1)
+    for d, day in enumerate(val_set):
         print('\nDay %d:' % day)
-    new_ds = predictor_ds.isel(init_date=day_as_list, **ens_sel)
-    # TODO: fix shape error when model_fields_only == True
-    select_predictors, select_shape = preprocessing.format_select_predictors(new_ds.ENS_PRED.values,
-                                                                             new_ds.AE_PRED.values,
-                                                                             None, convolved=convolved,
-                                                                             num_members=num_members)
-    select_verif = verify.select_verification(new_ds.AE_TAR.values, select_shape,
-                                              convolved=convolved, agg=verify.stdmean)
-    select_verif_12 = verify.select_verification(new_ds.AE_PRED[:, :, :, [-1]].values, select_shape,
-                                                 convolved=convolved, agg=verify.stdmean)
-    selection = selector.select(select_predictors, select_shape, agg=verify.stdmean)
-    selector_scores.append(selection[:, 0])
-    selector_ranks.append(selection[:, 1])
-    verif_scores.append(select_verif[:, 0])
-    verif_ranks.append(select_verif[:, 1])
-    last_time_scores.append(select_verif_12[:, 0])
-    last_time_ranks.append(select_verif_12[:, 1])
-    ranks = np.vstack((selection[:, 1], select_verif[:, 1], select_verif_12[:, 1])).T
-    scores = np.vstack((selection[:, 0], select_verif[:, 0], select_verif_12[:, 0])).T
-    if print_results:
-        print(ranks)
-        print('Rank score of Selector: %f' % verify.rank_score(ranks[:, 0], ranks[:, 1]))
-        print('Rank score of last-time estimate: %f' % verify.rank_score(ranks[:, 2], ranks[:, 1]))
-        print('MSE of Selector score: %f' % np.mean((scores[:, 0] - scores[:, 1]) ** 2.))
-        print('MSE of last-time estimate: %f' % np.mean((scores[:, 2] - scores[:, 1]) ** 2.))
+        print(np.vstack((selector_ranks[d], verif_ranks[d], last_time_ranks[d])).T)
+        print('Rank score of Selector: %f' % selector_rank_scores[d])
+        print('Rank score of last-time estimate: %f' % last_time_rank_scores[d])
+        print('MSE of Selector score: %f' % selector_mse[d])
+        print('MSE of last-time estimate: %f' % last_time_mse[d])
 
 result['selector_scores'] = (('time', 'member'), selector_scores)
 result['selector_ranks'] = (('time', 'member'), selector_ranks)
@@ -13,6 +13,7 @@ algorithm.
 from ensemble_net.data_tools import NCARArray, GR2Array, MesoWest
 from ensemble_net.util import date_to_meso_date
 from ensemble_net.verify import ae_meso
+from ensemble_net.verify.util import ae_meso_to_dense
 from ensemble_net.ensemble_selection import preprocessing
 import numpy as np
 import pandas as pd
@@ -41,6 +42,7 @@ lat_1 = 40.
 lon_0 = -100.
 lon_1 = -78.
 grid_factor = 4
+grid_method = 'nearest'  # 'nearest', 'mean', 'max', or 'bilinear'; see preprocessing.interpolate_ensemble_predictors
 num_members = 10
 
 # When formatting data for ingestion into the learning algorithm, we can use convolutions over the spatial data to
@@ -50,6 +52,11 @@ convolution = None
 convolution_step = 50
 convolution_agg = 'rmse'
 
+# Layout of the ensemble predictors in the file. 'ensemble' stores (init, var, member, time, [convolution], y, x);
+# 'samples' stores (init, member, [convolution], y, x, var, time), which the conversion to training samples reads
+# without copying.
+layout = 'ensemble'
+
 # If enabled, this option retrieves the forecast data from the NCAR server. Disable if data has already been processed
 # by this script or a different one.
 retrieve_forecast_data = False
@@ -91,63 +98,25 @@ if retrieve_forecast_data:
 fill_value = np.array(nc.default_fillvals['f4']).astype(np.float32)
 
 
-# Generate the dataset on disk for the predictors. The first predictor arrays will determine the dimensions.
-print("Creating dataset '%s'" % predictor_file)
-ncf = nc.Dataset(predictor_file, 'w', format='NETCDF4')
-ncf.createDimension('init_date', 0)
-nc_time = ncf.createVariable('init_date', np.float64, ('init_date',))
-nc_time_units = 'hours since 1970-01-01 00:00'
-ncf.variables['init_date'][:] = nc.date2num(dates, nc_time_units)
-get_dims = True
-
-
-# Generate the predictors from the ensemble, iterating over init_dates
+# Generate the predictors from the ensemble, writing each init_date to the predictor file on disk as soon as it is
+# processed. The first predictor arrays will determine the dimensions.
 convolved = (convolution is not None)
 print('Initiating generation of predictors...')
-idate = -1
-for date in dates:
-    idate += 1
-    print('Ensemble predictors for %s' % date)
-    ensemble.set_init_dates([date])
-    ensemble.open(coords=[], autoclose=True,)
-    raw_forecast_predictors = preprocessing.predictors_from_ensemble(ensemble, (lon_0, lon_1), (lat_0, lat_1),
-                                                                     forecast_hours=tuple(forecast_hours),
-                                                                     variables=forecast_variables,
-                                                                     convolution=convolution,
-                                                                     convolution_step=convolution_step, verbose=True)
-    ensemble.close()
-
-    # Interpolate raw forecast predictors if desired
-    if grid_factor > 1:
-        raw_forecast_predictors = preprocessing.interpolate_ensemble_predictors(raw_forecast_predictors, grid_factor)
-
-    if get_dims:
-        # Need to create variables and dimensions for ensemble predictors.
-        print("Creating dimensions and variable 'ENS_PRED'")
-        ncf.createDimension('ens_var', raw_forecast_predictors.shape[1])
-        ncf.createDimension('member', raw_forecast_predictors.shape[2])
-        ncf.createDimension('ens_time', raw_forecast_predictors.shape[3])
-        ncf.createDimension('ny', raw_forecast_predictors.shape[-2])
-        ncf.createDimension('nx', raw_forecast_predictors.shape[-1])
-        if convolved:
-            ncf.createDimension('convolution', raw_forecast_predictors.shape[-3])
-            nc_var = ncf.createVariable('ENS_PRED', np.float32,
-                                        ('init_date', 'ens_var', 'member', 'ens_time', 'convolution', 'ny', 'nx'),
-                                        fill_value=fill_value, zlib=True)
-        else:
-            nc_var = ncf.createVariable('ENS_PRED', np.float32,
-                                        ('init_date', 'ens_var', 'member', 'ens_time', 'ny', 'nx'),
-                                        fill_value=fill_value, zlib=True)
-        nc_var.setncatts({
-            'long_name': 'Predictors from ensemble',
-            'units': 'N/A'
-        })
-        nc_var = None
-        get_dims = False
+ensemble.set_init_dates(dates)
+ensemble.open(coords=[], autoclose=True,)
+predictor_ds = preprocessing.predictors_from_ensemble_to_file(ensemble, predictor_file, (lon_0, lon_1), (lat_0, lat_1),
+                                                              forecast_hours=tuple(forecast_hours),
+                                                              variables=forecast_variables,
+                                                              convolution=convolution,
+                                                              convolution_step=convolution_step,
+                                                              interpolate_factor=grid_factor,
+                                                              interpolate_method=grid_method, layout=layout,
+                                                              verbose=True)
+predictor_ds.close()
+ensemble.close()
 
-    # Write to the file
-    ncf.variables['ENS_PRED'][idate, ...] = raw_forecast_predictors[0]  # Axis 0 should be len 1
-    raw_forecast_predictors = None
+# Re-open the predictor file to add the remaining variables
+ncf = nc.Dataset(predictor_file, 'a', format='NETCDF4')
 
 
 # Generate the forecast errors relative to observations. These should fit comfortably in memory.
@@ -182,8 +151,9 @@ else:
     # Reload ensemble with all data
     ensemble.set_init_dates(dates)
     ensemble.open(decode_times=False, autoclose=True)
-    error_ds = ae_meso(ensemble, meso)
+    error_ds = ae_meso(ensemble, meso, dense=True)
     error_ds.to_netcdf(ae_meso_file)
+error_ds = ae_meso_to_dense(error_ds)
 
 # Thankfully, ensemble is only needed here for lat/lon values.
 if copy_stations_file is not None:
@@ -255,13 +225,13 @@ if not convolved:
         'long_name': 'Latitude of individual stations',
         'units': 'degrees_north'
     })
-    nc_var[:] = np.array([error_ds[s].attrs['LATITUDE'] for s in stations])
+    nc_var[:] = error_ds['station_lat'].sel(station=stations).values
     nc_var = ncf.createVariable('station_lon', np.float32, ('station',), fill_value=fill_value)
     nc_var.setncatts({
         'long_name': 'Longitude of individual stations',
         'units': 'degrees_east'
     })
-    nc_var[:] = np.array([error_ds[s].attrs['LONGITUDE'] for s in stations])
+    nc_var[:] = error_ds['station_lon'].sel(station=stations).values
 
 # Add the radar FSS scores
 if radar_fss_file is not None:
@@ -6,26 +6,17 @@
 #
 
 """
-Trains and tests an ensemble selection model using predictors generated by ens_sel_batch_process.py. Implements an
-'online learning' scheme whereby chunks of the data are loaded dynamically and training occurs on these individual
-chunks. Uses Keras fit_generator() method to do so.
-Options for iterating over hyper-parameters.
-This script is currently useless because an HDF lock error occurs when trying to fit the next model in the loop. Keras
-seems to have an issue with terminating child processes of fit_generator.
+Cross-validates an ensemble selection model using predictors generated by ens_sel_batch_process.py, iterating over
+hyper-parameters. The data of each fold are processed once into memory-mapped shards; each combination of parameters
+and fold is then trained in its own process (see ensemble_net.ensemble_selection.sweep), with as many processes running
+at a time as fit on the available CPU cores. The validation scores and timings are saved to a netCDF file.
 """
 
-from ensemble_net.util import save_model, SGDLearningRateTracker, BatchHistory
-from ensemble_net.ensemble_selection import preprocessing, verify
-from ensemble_net.ensemble_selection.model import EnsembleSelector, DataGenerator
-import numpy as np
-import time
+from ensemble_net.ensemble_selection.model import EnsembleSelector
+from ensemble_net.ensemble_selection.sweep import make_folds, compile_folds, run_sweep
 import xarray as xr
 import os
-import random
 from shutil import copyfile
-from keras.optimizers import SGD
-from keras.callbacks import TerminateOnNaN, History
-import keras.backend as K
 
 
 #%% User parameters
@@ -33,7 +24,8 @@ import keras.backend as K
 # Paths to important files
 root_data_dir = '%s/Data/ensemble-net' % os.environ['WORKDIR']
 predictor_file = '%s/predictors_201504-201603_28N40N100W78W_x4_no_c.nc' % root_data_dir
-model_file = '%s/selector_ncar_MSLP' % root_data_dir
+sweep_directory = '%s/sweep_ncar_MSLP' % root_data_dir  # fold data, job logs, and (optionally) models
+result_file = '%s/sweep_ncar_MSLP.nc' % root_data_dir
 convolved = False
 
 # Copy file to scratch space
@@ -46,15 +38,20 @@ variables = [-1]
 model_fields_only = False
 
 # Neural network configuration and options
-batch_size = 6  # in model init dates
-scaler_fit_size = 100
+process_batch_size = 6  # in model init dates, when writing the shards
+shard_size = 4096
 epochs = 1
 impute_missing = True
 scale_targets = False
-val = 'random'
-val_size = 46
-# Use multiple GPUs
-n_gpu = 1
+num_folds = 4
+# Skip writing the fold data if it already exists in sweep_directory
+reuse_folds = False
+
+# Processes: total CPU cores to use (None for all), and threads per training process
+cores = None
+cores_per_job = 2
+# Save every trained model in its job directory
+save_models = False
 
 # Neural network configurations
 layers_1 = [
@@ -82,16 +79,14 @@ layers_2 = [
     }]
 ]
 
-# Seed the random validation set generator
-random.seed(0)
-
-# Save history at each batch or each epoch
-save_batch_history = False
+# Seed for the random assignment of dates to folds
+fold_seed = 0
 
-# Iterate over configurations or hyper-parameters
+# Iterate over configurations or hyper-parameters. 'batch_size' is in samples.
 cv_parameters = {
     'lr': [3e-4, 1e-4, 3e-5, 1e-5, 3e-6],
-    'structure': [layers_1, layers_2]
+    'layers': [layers_1, layers_2],
+    'batch_size': [64, 256]
 }
 
 
@@ -134,110 +129,30 @@ if copy_file_to_scratch:
 print('Opening predictor dataset %s...' % predictor_file)
 predictor_ds = xr.open_dataset(predictor_file, mask_and_scale=True)
 num_dates = predictor_ds.dims['init_date']
-num_members = predictor_ds.dims['member']
-num_stations = predictor_ds.dims['station']
 
 # Select the observation variables
-predictor_ds = predictor_ds.sel(**ens_sel)
-num_variables = predictor_ds.dims['obs_var']
-
-
-#%% Get indices for the training and validation sets
-
-if val == 'first':
-    val_set = list(range(0, val_size))
-    train_set = list(range(val_size, num_dates))
-elif val == 'last':
-    val_set = list(range(num_dates - val_size, num_dates))
-    train_set = list(range(0, num_dates - val_size))
-elif val == 'random':
-    train_set = list(range(num_dates))
-    val_set = []
-    for j in range(val_size):
-        i = random.choice(train_set)
-        val_set.append(i)
-        train_set.remove(i)
-    val_set.sort()
-else:
-    raise ValueError("'val' must be 'first', 'last', or 'random'")
-
-
-#%% Create an EnsembleSelector and Generator. The selector and generator are intertwined for scaling and imputing.
-
-print('Building an EnsembleSelector model...')
-selector = EnsembleSelector(impute_missing=impute_missing, scale_targets=scale_targets)
-
-# Make a DataGenerator for training
-generator = DataGenerator(selector, predictor_ds.isel(init_date=train_set), batch_size,
-                          convolved=convolved, model_fields_only=model_fields_only)
-
-# Make a DataGenerator for validation
-val_generator = DataGenerator(selector, predictor_ds.isel(init_date=val_set), batch_size,
-                              convolved=convolved, model_fields_only=model_fields_only)
-
-# Initialize the model's Imputer and Scaler with a larger set of data
-print('Fitting the EnsembleSelector Imputer and Scaler...')
-fit_set = train_set[:scaler_fit_size]
-predictors, targets = generator.generate_data(fit_set, scale_and_impute=False)
-input_shape = predictors.shape[1:]
-num_outputs = targets.shape[1]
-conv_shape = generator.spatial_shape
-selector.init_fit(predictors, targets)
-predictors = None
-targets = None
-
-# Load the validation set, which will now also be scaled
-print('Processing validation set...')
-p_val, t_val = val_generator.generate_data([])
-
-
-#%% Build and train the ensemble selection model, iterating over parameters
-
-for l_index, layers in enumerate(cv_parameters['structure']):
-    for learning_rate in cv_parameters['lr']:
-        layers[0][-1]['input_shape'] = input_shape
-        layers[-1][1] = (num_outputs,)
-        print(layers)
-        sgd = SGD(lr=learning_rate)
-        selector.build_model(layers=layers, gpus=n_gpu, loss='mse', optimizer=sgd, metrics=['mae'])
-
-        # Train and evaluate the model
-        print('Training the EnsembleSelector model...')
-        start_time = time.time()
-        if save_batch_history:
-            history = BatchHistory()
-        else:
-            history = History()
-        selector.fit_generator(generator, epochs=epochs, verbose=1, validation_data=(p_val, t_val),
-                               use_multiprocessing=True,
-                               callbacks=[TerminateOnNaN(), SGDLearningRateTracker(), history])
-
-        end_time = time.time()
-
-        # Use model.evaluate() because p_val and t_val are already scaled
-        score = selector.model.evaluate(p_val, t_val, verbose=0)
-        print("\nTrain time -- %s seconds --" % (end_time - start_time))
-        print('Val loss:', score[0])
-        print('Val mean absolute error:', score[1])
-
-        # Save the model, if requested
-        if model_file is not None:
-            model_file += '_struct_%d_lr_%0.1E' % (l_index, learning_rate)
-            print('Saving model to disk... (%s)' % model_file)
-            save_model(selector, model_file, history=history)
-
-        K.clear_session()
-
-        # Reset the generators... seems to cause HDF errors in multiprocessing
-        generator.ds.close()
-        generator = None
-        val_generator.ds.close()
-        val_generator = None
-        selector.model = None
-        predictor_ds.close()
-        predictor_ds = None
-        predictor_ds = xr.open_dataset(predictor_file, mask_and_scale=True)
-        generator = DataGenerator(selector, predictor_ds.isel(init_date=train_set), batch_size,
-                                  convolved=convolved, model_fields_only=model_fields_only)
-        val_generator = DataGenerator(selector, predictor_ds.isel(init_date=val_set), batch_size,
-                                      convolved=convolved, model_fields_only=model_fields_only)
+predictor_ds = predictor_ds.isel(**ens_sel)
+
+
+#%% Process the data of each fold into shards
+
+folds = make_folds(num_dates, num_folds, seed=fold_seed)
+fold_directories = [os.path.join(sweep_directory, 'fold_%d' % f) for f in range(num_folds)]
+if not (reuse_folds and all(os.path.isdir(f) for f in fold_directories)):
+    print('Processing the data of %d folds...' % num_folds)
+    selector = EnsembleSelector(impute_missing=impute_missing, scale_targets=scale_targets)
+    fold_directories = compile_folds(selector, predictor_ds, folds, sweep_directory,
+                                     batch_size=process_batch_size, shard_size=shard_size, convolved=convolved,
+                                     obs_errors='targets' if model_fields_only else 'both')
+predictor_ds.close()
+
+
+#%% Train and validate every configuration on every fold
+
+print('Running the sweep...')
+result = run_sweep(cv_parameters, fold_directories, os.path.join(sweep_directory, 'jobs'), cores=cores,
+                   cores_per_job=cores_per_job, save_models=save_models, epochs=epochs)
+result.to_netcdf(result_file)
+
+# Print the mean validation scores over folds
+print(result.drop(['error']).mean('fold').to_dataframe().to_string())
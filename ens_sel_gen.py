@@ -11,9 +11,10 @@ Trains and tests an ensemble selection model using predictors generated by ens_s
 chunks. Uses Keras fit_generator() method to do so.
 """
 
-from ensemble_net.util import save_model, AdamLearningRateTracker
+from ensemble_net.util import save_model, save_model_compact, AdamLearningRateTracker
 from ensemble_net.ensemble_selection import preprocessing, verify
-from ensemble_net.ensemble_selection.model import EnsembleSelector, DataGenerator
+from ensemble_net.ensemble_selection.model import EnsembleSelector, DataGenerator, PrefetchDataGenerator
+from ensemble_net.ensemble_selection.shards import compile_shards, ShardGenerator
 import numpy as np
 import time
 import xarray as xr
@@ -30,6 +31,8 @@ from keras.callbacks import TerminateOnNaN
 root_data_dir = '/home/disk/wave2/jweyn/Data/ensemble-net'
 predictor_file = '%s/predictors_201504-201703_28N40N100W78W_x4_no_c_fss.nc' % root_data_dir
 model_file = '%s/selector_ncar_2yr_fss_conv' % root_data_dir
+# Also save the model in the compact format (directory '${model_file}.compact'), for fast loading and sharing
+save_compact = True
 result_file = '%s/result_ncar_2yr_fss_conv.nc' % root_data_dir
 convolved = False
 
@@ -45,7 +48,6 @@ variables = 'all'
 
 # Neural network configuration and options
 batch_size = 8  # in model init dates
-scaler_fit_size = 200
 epochs = 50
 impute_missing = True
 scale_targets = False
@@ -53,6 +55,15 @@ val = 'random'
 val_size = 71
 # Use multiple GPUs
 n_gpu = 1
+# Pass the spatial predictors to native Conv2D layers as a second model input, instead of a PartialConv2D layer
+multi_input = False
+# Prepare batches in background threads: number of batches ahead, threads, and init dates kept in memory
+prefetch_batches = 2
+prefetch_workers = 2
+cache_days = 128
+# If not None, process the training set once into scaled shards in this directory and train from them
+shard_directory = None
+shard_batch_size = 256  # in samples
 
 # Seed the random validation set generator
 random.seed(0)
@@ -113,9 +124,8 @@ if radar_fss is not None:
     num_dates = len(valid_index)
     predictor_ds = predictor_ds.isel(init_date=valid_index)
 
-# Select the observation variables
-predictor_ds = predictor_ds.sel(**ens_sel)
-num_variables = predictor_ds.dims['obs_var']
+# The generators select the observation variables, so that the selection is saved with the model's Preprocessor
+num_variables = predictor_ds.sel(**ens_sel).dims['obs_var']
 
 
 #%% Get indices for the training and validation sets
@@ -144,27 +154,33 @@ print('Building an EnsembleSelector model...')
 selector = EnsembleSelector(impute_missing=impute_missing, scale_targets=scale_targets)
 
 # Make a DataGenerator for training
-generator = DataGenerator(selector, predictor_ds.isel(init_date=train_set), batch_size,
-                          convolved=convolved, obs_errors=obs_errors, radar_fss=radar_fss)
+generator = PrefetchDataGenerator(selector, predictor_ds.isel(init_date=train_set), batch_size,
+                                  prefetch=prefetch_batches, workers=prefetch_workers, cache_size=cache_days,
+                                  shuffle=True, convolved=convolved, obs_errors=obs_errors, radar_fss=radar_fss,
+                                  selection=ens_sel)
 
 # Make a DataGenerator for validation
 val_generator = DataGenerator(selector, predictor_ds.isel(init_date=val_set), batch_size,
-                              convolved=convolved, obs_errors=obs_errors, radar_fss=radar_fss)
+                              convolved=convolved, obs_errors=obs_errors, radar_fss=radar_fss, selection=ens_sel)
 
-# Initialize the model's Imputer and Scaler with a larger set of data
+# Initialize the model's Imputer and Scaler in one streaming pass over the full training set
 print('Fitting the EnsembleSelector Imputer and Scaler...')
-fit_set = train_set[:scaler_fit_size]
-predictors, targets = generator.generate_data(fit_set, scale_and_impute=False)
-input_shape = predictors.shape[1:]
-num_outputs = targets.shape[1]
+selector.init_fit(generator)
 conv_shape = generator.spatial_shape
-selector.init_fit(predictors, targets)
-predictors = None
-targets = None
 
 # Load the validation set, which will now also be scaled
 print('Processing validation set...')
 p_val, t_val = val_generator.generate_data([])
+input_shape = p_val.shape[1:]
+num_outputs = t_val.shape[1]
+
+# Optionally compile the training set into shards
+if shard_directory is not None:
+    print('Compiling training shards...')
+    compile_shards(generator, shard_directory, shuffle=True)
+    generator.close()
+    generator = ShardGenerator(shard_directory, batch_size=shard_batch_size, shuffle=True,
+                               conv_shape=conv_shape if multi_input else None)
 
 
 #%% Build and train the ensemble selection model
@@ -190,18 +206,36 @@ layers = (
         'activation': 'linear'
     })
 )
-selector.build_model(layers=layers, gpus=n_gpu, loss='mse', optimizer='adam', metrics=['mae'])
+if multi_input:
+    conv_layers = (
+        ('Conv2D', (16, 5), {
+            'strides': 3,
+            'activation': 'relu'
+        }),
+    )
+    selector.build_multi_input_model(conv_shape, input_shape[0] - int(np.prod(conv_shape)), conv_layers=conv_layers,
+                                     layers=layers[1:], extra_activation='relu', gpus=n_gpu, loss='mse',
+                                     optimizer='adam', metrics=['mae'])
+else:
+    selector.build_model(layers=layers, gpus=n_gpu, loss='mse', optimizer='adam', metrics=['mae'])
 
 # Train and evaluate the model
 print('Training the EnsembleSelector model...')
 start_time = time.time()
 history = selector.fit_generator(generator, epochs=epochs, verbose=1, validation_data=(p_val, t_val),
-                                 use_multiprocessing=True, callbacks=[TerminateOnNaN(), AdamLearningRateTracker()])
-
+                                 shuffle=False, workers=1, use_multiprocessing=False,
+                                 callbacks=[TerminateOnNaN(), AdamLearningRateTracker()])
 end_time = time.time()
 
+if shard_directory is None:
+    generator.close()
+    gen_stats = generator.stats()
+    print('Input pipeline: waited %0.1f s over %d batches (%0.1f%% of training time); %d of %d batches prefetched'
+          % (gen_stats['stall_time'], gen_stats['batches'], 100. * gen_stats['stall_fraction'],
+             gen_stats['prefetch_hits'], gen_stats['batches']))
+
 # Use model.evaluate() because p_val and t_val are already scaled
-score = selector.model.evaluate(p_val, t_val, verbose=0)
+score = selector.model.evaluate(selector.split_inputs(p_val), t_val, verbose=0)
 print("\nTrain time -- %s seconds --" % (end_time - start_time))
 print('Test loss:', score[0])
 print('Test mean absolute error:', score[1])
@@ -210,6 +244,8 @@ print('Test mean absolute error:', score[1])
 if model_file is not None:
     print('Saving model to disk...')
     save_model(selector, model_file, history=history)
+    if save_compact:
+        save_model_compact(selector, '%s.compact' % model_file, history=history)
 
 
 #%% Process the results
@@ -229,7 +265,7 @@ result = xr.Dataset(
     coords={
         'time': predictor_ds['init_date'].isel(init_date=val_set),
         'member': predictor_ds.member,
-        'variable': predictor_ds.obs_var.isel(**ens_sel),
+        'variable': predictor_ds.obs_var.sel(**ens_sel),
         'station': range(num_stations)
     }
 )
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2017-18 Jonathan Weyn <jweyn@uw.edu>
+#
+# See the file LICENSE for your rights.
+#
+
+"""
+Benchmark of convert_ensemble_predictors_to_samples for ensemble predictors in the 'ensemble' and 'samples' layouts
+(see preprocessing.predictors_from_ensemble). Uses random predictors of a typical shape, and reports the time of the
+conversion, the amount of data copied, and whether the result shares memory with the input.
+"""
+
+from ensemble_net.ensemble_selection import preprocessing
+import numpy as np
+import time
+
+
+#%% User parameters
+
+# Shape of the predictors in the 'ensemble' layout: (init, variable, member, fhour, y, x)
+predictor_shape = (60, 4, 10, 3, 48, 88)
+
+# Fraction of samples which are masked out, for the benchmark with a mask of valid samples
+mask_fraction = 0.1
+
+# Number of repetitions of each conversion; the fastest is reported
+num_repeats = 5
+
+
+#%% Generate the predictors in both layouts
+
+rng = np.random.RandomState(0)
+ensemble_predictors = rng.rand(*predictor_shape).astype(np.float32)
+samples_predictors = np.ascontiguousarray(
+    ensemble_predictors.transpose(preprocessing._layout_axes('samples', False)))
+predictors = {'ensemble': ensemble_predictors, 'samples': samples_predictors}
+mask = rng.rand(predictor_shape[0], predictor_shape[2]) >= mask_fraction
+print('Predictors: %s, %0.1f MB' % (predictor_shape, ensemble_predictors.nbytes / 2. ** 20))
+
+
+#%% Time the conversions
+
+results = []
+for use_mask in [False, True]:
+    for layout in preprocessing.ENSEMBLE_LAYOUTS:
+        times = []
+        for r in range(num_repeats):
+            start = time.time()
+            samples, input_shape = preprocessing.convert_ensemble_predictors_to_samples(
+                predictors[layout], mask=mask if use_mask else None, layout=layout)
+            times.append(time.time() - start)
+        view = np.shares_memory(samples, predictors[layout])
+        copied = 0 if view else samples.nbytes
+        results.append((layout, use_mask, min(times), copied, view))
+
+
+#%% Report
+
+print('\n%-10s %-6s %12s %12s %10s %6s' % ('layout', 'mask', 'time (ms)', 'copied (MB)', 'GB/s', 'view'))
+for layout, use_mask, t, copied, view in results:
+    rate = copied / t / 2. ** 30 if t > 0 else np.inf
+    print('%-10s %-6s %12.3f %12.1f %10.2f %6s' % (layout, use_mask, t * 1000., copied / 2. ** 20, rate, view))
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2017-18 Jonathan Weyn <jweyn@uw.edu>
+#
+# See the file LICENSE for your rights.
+#
+
+"""
+Benchmark of the training throughput of an EnsembleSelector with a first PartialConv2D layer, which reshapes flat
+samples into the convolution tensor and concatenates the result with the extra features on every forward pass,
+against the equivalent multi-input model of EnsembleSelector.build_multi_input_model, which takes the spatial
+predictors as a 4-dimensional tensor. Uses random predictors of a typical shape. The weights of the PartialConv2D
+model are copied to the multi-input model to check that both compute the same predictions.
+"""
+
+from ensemble_net.ensemble_selection import EnsembleSelector
+import numpy as np
+import time
+
+
+#%% User parameters
+
+# Shape of the spatial predictors of one sample (y, x, variable * fhour), and number of station/FSS features
+conv_shape = (48, 88, 12)
+num_extra_features = 400
+
+# Number of samples and of target outputs
+num_samples = 4096
+num_outputs = 60
+
+# Convolution and dense layer parameters
+filters = 16
+kernel_size = 5
+strides = 3
+dense_size = 1024
+
+# Training parameters; the first epoch is not timed
+batch_size = 64
+epochs = 3
+
+# Number of GPUs to use
+n_gpu = 1
+
+
+#%% Generate the predictors and fit the Imputer and Scaler
+
+rng = np.random.RandomState(0)
+num_conv_features = int(np.prod(conv_shape))
+predictors = rng.rand(num_samples, num_conv_features + num_extra_features).astype(np.float32)
+targets = rng.rand(num_samples, num_outputs).astype(np.float32)
+print('Predictors: %d samples of %d spatial %s and %d extra features, %0.1f MB' %
+      (num_samples, num_conv_features, conv_shape, num_extra_features, predictors.nbytes / 2. ** 20))
+
+dense_layers = (
+    ('Dense', (dense_size,), {
+        'activation': 'relu'
+    }),
+    ('Dropout', (0.25,), {}),
+    ('Dense', (num_outputs,), {
+        'activation': 'linear'
+    })
+)
+
+partial = EnsembleSelector()
+partial.init_fit(predictors, targets)
+partial.build_model(layers=(('PartialConv2D', (filters, kernel_size), {
+    'strides': strides,
+    'conv_size': conv_shape,
+    'conv_first': True,
+    'activation': 'relu',
+    'input_shape': predictors.shape[1:]
+}),) + dense_layers, gpus=n_gpu, loss='mse', optimizer='adam', metrics=['mae'])
+
+multi = EnsembleSelector()
+multi.init_fit(predictors, targets)
+multi.build_multi_input_model(conv_shape, num_extra_features, conv_layers=(('Conv2D', (filters, kernel_size), {
+    'strides': strides,
+    'activation': 'relu'
+}),), layers=dense_layers, extra_activation='relu', gpus=n_gpu, loss='mse', optimizer='adam', metrics=['mae'])
+
+
+#%% Check that the models are equivalent
+
+multi.model.set_weights(partial.model.get_weights())
+check = predictors[:batch_size]
+difference = np.max(np.abs(partial.predict(check) - multi.predict(check)))
+print('Maximum difference of predictions with the same weights: %0.3g' % difference)
+
+
+#%% Time the training
+
+# Scale once, so that only the Keras training is timed
+p_scaled, t_scaled = partial.fused_transform(predictors, targets, copy=True)
+inputs = {'PartialConv2D': p_scaled, 'multi-input': multi.split_inputs(p_scaled)}
+models = {'PartialConv2D': partial, 'multi-input': multi}
+
+results = []
+for name in ['PartialConv2D', 'multi-input']:
+    model = models[name].model
+    model.fit(inputs[name], t_scaled, batch_size=batch_size, epochs=1, verbose=0)
+    start = time.time()
+    model.fit(inputs[name], t_scaled, batch_size=batch_size, epochs=epochs - 1, verbose=0)
+    train_time = time.time() - start
+    start = time.time()
+    model.predict(inputs[name], batch_size=batch_size)
+    predict_time = time.time() - start
+    results.append((name, train_time, predict_time))
+
+
+#%% Report
+
+print('\n%-14s %14s %16s %18s' % ('model', 'train time (s)', 'train samples/s', 'predict samples/s'))
+for name, train_time, predict_time in results:
+    print('%-14s %14.2f %16.0f %18.0f' % (name, train_time, num_samples * (epochs - 1) / train_time,
+                                          num_samples / predict_time))
+speedup = results[0][1] / results[1][1]
+print('\nTraining speedup of the multi-input model: %0.2fx' % speedup)
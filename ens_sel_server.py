@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2017-18 Jonathan Weyn <jweyn@uw.edu>
+#
+# See the file LICENSE for your rights.
+#
+
+"""
+Starts a local inference server for a trained EnsembleSelector model. The model is loaded once and kept in memory;
+forecast jobs request member selections over HTTP (see ensemble_net.ensemble_selection.server.SelectionClient), and
+their requests are batched together for the model. Stop with Ctrl-C.
+"""
+
+from ensemble_net.util import load_model, load_model_compact
+from ensemble_net.ensemble_selection.server import SelectionServer
+import os
+
+
+#%% User parameters
+
+# Paths to important files
+root_data_dir = '%s/Data/ensemble-net' % os.environ['WORKDIR']
+model_file = '%s/selector_gr2_201501-201712_no_c_PC' % root_data_dir  # base name, or compact model directory
+
+# Server address
+host = '127.0.0.1'
+port = 8765
+
+# Micro-batching: maximum samples per batch and maximum time (s) to wait for a batch to fill
+max_batch_samples = 8192
+max_wait = 0.01
+
+# Log every request
+verbose = False
+
+
+#%% Load the model and serve
+
+print('Loading EnsembleSelector model %s...' % model_file)
+if os.path.isdir(model_file):
+    # Saved with save_model_compact
+    selector = load_model_compact(model_file, lazy=False)
+else:
+    selector = load_model(model_file)
+
+server = SelectionServer(selector, host=host, port=port, max_batch_samples=max_batch_samples, max_wait=max_wait,
+                         verbose=verbose)
+server.serve_forever()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2017-18 Jonathan Weyn <jweyn@uw.edu>
+#
+# See the file LICENSE for your rights.
+#
+
+"""
+Load test for an EnsembleSelector inference server started with ens_sel_server.py. Several concurrent clients send
+selection requests with random predictors of the shape expected by the served model, then client-side and
+server-side latencies are reported.
+"""
+
+from ensemble_net.ensemble_selection.server import SelectionClient
+import numpy as np
+import threading
+import time
+
+
+#%% User parameters
+
+# Server address
+host = '127.0.0.1'
+port = 8765
+
+# Load: concurrent clients, requests sent by each, and the ensemble shape of each request (member, convolution)
+num_clients = 8
+requests_per_client = 50
+ensemble_shape = (10, 1)
+agg = 'stdmean'
+
+
+#%% Run the load test
+
+client = SelectionClient(host, port)
+info = client.info()
+if info['input_shape'] is None or None in info['input_shape']:
+    raise ValueError('the server did not report a fixed model input shape')
+input_shape = tuple(info['input_shape'])
+print('Server model input shape: %s' % (input_shape,))
+
+latencies = []
+errors = []
+lock = threading.Lock()
+
+
+def run_client(seed):
+    c = SelectionClient(host, port)
+    rng = np.random.RandomState(seed)
+    for r in range(requests_per_client):
+        predictors = rng.rand(*(ensemble_shape + input_shape)).astype(np.float32)
+        start = time.time()
+        try:
+            c.select(predictors, ensemble_shape, agg=agg)
+        except Exception as e:
+            with lock:
+                errors.append(str(e))
+            continue
+        with lock:
+            latencies.append(time.time() - start)
+
+
+print('Sending %d requests from %d clients...' % (num_clients * requests_per_client, num_clients))
+start_time = time.time()
+threads = [threading.Thread(target=run_client, args=(i,)) for i in range(num_clients)]
+for thread in threads:
+    thread.start()
+for thread in threads:
+    thread.join()
+elapsed = time.time() - start_time
+
+
+#%% Report
+
+latencies = np.array(latencies)
+print('\nCompleted %d requests in %0.2f s (%0.1f requests/s); %d errors' %
+      (len(latencies), elapsed, len(latencies) / elapsed, len(errors)))
+if len(errors) > 0:
+    print('First error: %s' % errors[0])
+if len(latencies) > 0:
+    print('Client latency (ms): mean %0.1f, p50 %0.1f, p90 %0.1f, p99 %0.1f, max %0.1f' %
+          tuple(1000. * v for v in (latencies.mean(), np.percentile(latencies, 50), np.percentile(latencies, 90),
+                                    np.percentile(latencies, 99), latencies.max())))
+
+stats = client.stats()
+print('Server: %d requests in %d batches (mean %0.1f samples per batch)' %
+      (stats['requests'], stats['batches'], stats['mean_batch_samples']))
+for name in ['request_latency', 'queue_wait', 'predict_time']:
+    h = stats[name]
+    print('Server %s (ms): mean %0.1f, p50 <= %0.1f, p90 <= %0.1f, p99 <= %0.1f, max %0.1f' %
+          (name, 1000. * h['mean'], 1000. * h['p50'], 1000. * h['p90'], 1000. * h['p99'], 1000. * h['max']))
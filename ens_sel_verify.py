@@ -133,33 +133,19 @@ if plotting:
 
 #%% Load the predictors and the model, and run the predictions
 
-def process_chunk(ds, **sel):
-    if len(sel) > 0:
-        ds = ds.sel(**sel)
-    forecast_predictors, fpi = preprocessing.convert_ensemble_predictors_to_samples(ds['ENS_PRED'].values,
-                                                                                    convolved=convolved)
-    ae_targets, eti = preprocessing.convert_ae_meso_predictors_to_samples(np.expand_dims(ds['AE_TAR'].values, 3),
-                                                                          convolved=convolved)
-    if model_fields_only:
-        combined_predictors = preprocessing.combine_predictors(forecast_predictors)
-    else:
-        ae_predictors, epi = preprocessing.convert_ae_meso_predictors_to_samples(ds['AE_PRED'].values,
-                                                                                 convolved=convolved)
-        combined_predictors = preprocessing.combine_predictors(forecast_predictors, ae_predictors)
+preprocessor = preprocessing.Preprocessor.from_options('targets' if model_fields_only else 'both', convolved=convolved,
+                                                       impute_missing=impute_missing, selection=ens_sel)
 
-    # Remove samples with NaN
-    if impute_missing:
-        p, t = combined_predictors, ae_targets
-    else:
-        p, t = preprocessing.delete_nan_samples(combined_predictors, ae_targets)
 
-    return p, t
+def process_chunk(ds):
+    return preprocessor.process(ds)
 
 
 # Load a Dataset with the predictors
 print('Opening predictor dataset %s...' % predictor_file)
 predictor_ds = xr.open_dataset(predictor_file, mask_and_scale=True)
 num_dates = predictor_ds.ENS_PRED.shape[0]
+layout = preprocessing.ensemble_layout(predictor_ds.ENS_PRED.dims)
 num_members = predictor_ds.member.shape[0]
 num_stations = predictor_ds.AE_TAR.shape[-1]
 if ens_sel == {}:
@@ -187,12 +173,18 @@ if calculate:
     else:
         raise ValueError("'val' must be 'first', 'last', or 'random'")
 
-    p_test, t_test = process_chunk(predictor_ds.isel(init_date=val_set), **ens_sel)
-
     # Load the model
     print('Loading EnsembleSelector model %s...' % model_file)
     selector = load_model(model_file)
 
+    # Process the predictors with the same pipeline as in training, if it was saved with the model
+    if getattr(selector, 'preprocessor', None) is not None:
+        preprocessor = selector.preprocessor
+        # Models trained on a pre-selected Dataset saved a Preprocessor without the selection of variables
+        if preprocessor.selection is None and ens_sel != {}:
+            preprocessor.selection = dict(ens_sel)
+    p_test, t_test = process_chunk(predictor_ds.isel(init_date=val_set))
+
     # Run the model
     print('Predicting with the EnsembleSelector...')
     predicted = selector.predict(p_test)
@@ -230,39 +222,39 @@ if calculate:
 
     verification_dates = [predictor_ds['init_date'].isel(init_date=d) for d in val_set]
     verification_dates = nc.num2date(verification_dates, 'hours since 1970-01-01 00:00:00')
-    selector_scores = []
-    selector_ranks = []
-    verif_ranks = []
-    verif_scores = []
-    last_time_scores = []
-    last_time_ranks = []
-    for d in range(len(val_set)):
-        day_as_list = [val_set[d]]
+    # Select for all validation days at once, with predictors of (member, date, [convolution,] features)
+    num_val = len(val_set)
+    new_ds = predictor_ds.isel(init_date=val_set, **ens_sel)
+    select_predictors, select_shape = preprocessing.format_select_predictors(new_ds.ENS_PRED.values,
+                                                                             None if model_fields_only else
+                                                                             new_ds.AE_PRED.values,
+                                                                             None, convolved=convolved,
+                                                                             num_members=num_members,
+                                                                             layout=layout, split_dates=True)
+    print('Selecting with the EnsembleSelector...')
+    selection = selector.select(select_predictors, select_shape, date_axis=1, agg=verify.stdmean)
+    select_verif = verify.select_verification(new_ds.AE_TAR.values, select_shape, date_axis=1,
+                                              convolved=convolved, agg=verify.stdmean)
+    select_verif_12 = verify.select_verification(new_ds.AE_PRED[:, :, :, [-1]].values, select_shape, date_axis=1,
+                                                 convolved=convolved, agg=verify.stdmean)
+    selector_scores = selection[:, :, 0]
+    selector_ranks = selection[:, :, 1]
+    verif_scores = select_verif[:, :, 0]
+    verif_ranks = select_verif[:, :, 1]
+    last_time_scores = select_verif_12[:, :, 0]
+    last_time_ranks = select_verif_12[:, :, 1]
+    # Rank scores and score errors of all days at once
+    selector_rank_scores = verify.rank_score(selector_ranks, verif_ranks, axis=1)
+    last_time_rank_scores = verify.rank_score(last_time_ranks, verif_ranks, axis=1)
+    selector_mse = np.mean((selector_scores - verif_scores) ** 2., axis=1)
+    last_time_mse = np.mean((last_time_scores - verif_scores) ** 2., axis=1)
+    for d in range(num_val):
         print('\nDay %d (%s):' % (val_set[d], verification_dates[d]))
-        new_ds = predictor_ds.isel(init_date=day_as_list, **ens_sel)
-        # TODO: fix shape error when model_fields_only == True
-        select_predictors, select_shape = preprocessing.format_select_predictors(new_ds.ENS_PRED.values,
-                                                                                 new_ds.AE_PRED.values,
-                                                                                 None, convolved=convolved,
-                                                                                 num_members=num_members)
-        select_verif = verify.select_verification(new_ds.AE_TAR.values, select_shape,
-                                                  convolved=convolved, agg=verify.stdmean)
-        select_verif_12 = verify.select_verification(new_ds.AE_PRED[:, :, :, [-1]].values, select_shape,
-                                                     convolved=convolved, agg=verify.stdmean)
-        selection = selector.select(select_predictors, select_shape, agg=verify.stdmean)
-        selector_scores.append(selection[:, 0])
-        selector_ranks.append(selection[:, 1])
-        verif_scores.append(select_verif[:, 0])
-        verif_ranks.append(select_verif[:, 1])
-        last_time_scores.append(select_verif_12[:, 0])
-        last_time_ranks.append(select_verif_12[:, 1])
-        ranks = np.vstack((selection[:, 1], select_verif[:, 1], select_verif_12[:, 1])).T
-        scores = np.vstack((selection[:, 0], select_verif[:, 0], select_verif_12[:, 0])).T
-        print(ranks)
-        print('Rank score of Selector: %f' % verify.rank_score(ranks[:, 0], ranks[:, 1]))
-        print('Rank score of last-time estimate: %f' % verify.rank_score(ranks[:, 2], ranks[:, 1]))
-        print('MSE of Selector score: %f' % np.mean((scores[:, 0] - scores[:, 1]) ** 2.))
-        print('MSE of last-time estimate: %f' % np.mean((scores[:, 2] - scores[:, 1]) ** 2.))
+        print(np.vstack((selector_ranks[d], verif_ranks[d], last_time_ranks[d])).T)
+        print('Rank score of Selector: %f' % selector_rank_scores[d])
+        print('Rank score of last-time estimate: %f' % last_time_rank_scores[d])
+        print('MSE of Selector score: %f' % selector_mse[d])
+        print('MSE of last-time estimate: %f' % last_time_mse[d])
 
     result['selector_scores'] = (('time', 'member'), selector_scores)
     result['selector_ranks'] = (('time', 'member'), selector_ranks)
@@ -280,14 +272,14 @@ else:
 
 #%% Write CSV
 
+verif_scores = result.verif_scores.values
+verif_ranks = result.verif_ranks.values
 all_scores = np.full((result.dims['time'], 5), np.nan, dtype=object)
-for d in range(result.dims['time']):
-    day = verification_dates[d]
-    all_scores[d, 0] = '%s' % day
-    all_scores[d, 1] = np.mean((result.verif_scores[d, :].values - result.selector_scores[d, :].values) ** 2.)
-    all_scores[d, 2] = np.mean((result.verif_scores[d, :].values - result.last_time_scores[d, :].values) ** 2.)
-    all_scores[d, 3] = verify.rank_score(result.selector_ranks.values[d, :], result.verif_ranks.values[d, :])
-    all_scores[d, 4] = verify.rank_score(result.last_time_ranks.values[d, :], result.verif_ranks.values[d, :])
+all_scores[:, 0] = ['%s' % day for day in verification_dates]
+all_scores[:, 1] = np.mean((verif_scores - result.selector_scores.values) ** 2., axis=1)
+all_scores[:, 2] = np.mean((verif_scores - result.last_time_scores.values) ** 2., axis=1)
+all_scores[:, 3] = verify.rank_score(result.selector_ranks.values, verif_ranks, axis=1)
+all_scores[:, 4] = verify.rank_score(result.last_time_ranks.values, verif_ranks, axis=1)
 np.savetxt('%s.csv' % '.'.join(result_file.split('.')[:-1]), all_scores, fmt='%s', delimiter=',',
            header='day,selector score,12-hour score,selector rank,12-hour rank')
 
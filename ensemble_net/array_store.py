@@ -0,0 +1,274 @@
+#
+# Copyright (c) 2017-18 Jonathan Weyn <jweyn@uw.edu>
+#
+# See the file LICENSE for your rights.
+#
+
+"""
+A simple on-disk store of named numpy arrays. Each array is a .npy file in the store directory, and a small JSON
+manifest records the shape, data type and attributes of every array. Arrays are read as memory maps, so that slices
+are read without loading the whole array, and many threads or processes can read a store at the same time. Used to
+save the large predictor and target arrays of the preprocessing functions in place of pickle files.
+"""
+
+import os
+import json
+import pickle
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+
+MANIFEST_FILE = 'manifest.json'
+
+
+class ArrayStore(object):
+    """
+    Directory of named arrays. Open with mode 'r' (read only), 'a' (read and add or overwrite arrays), or 'w' (start a
+    new store, removing the arrays of an existing one).
+
+    Example:
+        store = ArrayStore('predictors.store', mode='w')
+        store.write('predictors', predictors)
+        ...
+        predictors = ArrayStore('predictors.store')['predictors']  # memory-mapped
+    """
+
+    def __init__(self, directory, mode='r'):
+        """
+        Open an ArrayStore.
+
+        :param directory: str: directory of the store
+        :param mode: str: 'r', 'a', or 'w'
+        """
+        if mode not in ['r', 'a', 'w']:
+            raise ValueError("'mode' must be 'r', 'a', or 'w'")
+        self.directory = directory
+        self.mode = mode
+        self.arrays = {}
+        self.attrs = {}
+        manifest_file = os.path.join(directory, MANIFEST_FILE)
+        if mode == 'r' and not os.path.isfile(manifest_file):
+            raise IOError('no array store found at %s' % directory)
+        if mode == 'w':
+            os.makedirs(directory, exist_ok=True)
+            if os.path.isfile(manifest_file):
+                with open(manifest_file, 'r') as f:
+                    old_manifest = json.load(f)
+                for entry in old_manifest['arrays'].values():
+                    try:
+                        os.remove(os.path.join(directory, entry['file']))
+                    except OSError:
+                        pass
+            self.flush()
+        elif os.path.isfile(manifest_file):
+            with open(manifest_file, 'r') as f:
+                manifest = json.load(f)
+            self.arrays = manifest['arrays']
+            self.attrs = manifest['attrs']
+        else:
+            os.makedirs(directory, exist_ok=True)
+            self.flush()
+
+    def _check_writable(self):
+        if self.mode == 'r':
+            raise IOError('array store %s is opened read-only' % self.directory)
+
+    def _check_name(self, name):
+        if name not in self.arrays:
+            raise KeyError("no array '%s' in store %s" % (name, self.directory))
+
+    def flush(self):
+        """
+        Write the manifest, including any changes to the attributes of the store or of its arrays.
+        """
+        self._check_writable()
+        with open(os.path.join(self.directory, MANIFEST_FILE), 'w') as f:
+            json.dump({'arrays': self.arrays, 'attrs': self.attrs}, f, indent=2)
+
+    def keys(self):
+        """
+        :return: list: names of the arrays in the store
+        """
+        return list(self.arrays.keys())
+
+    def __contains__(self, name):
+        return name in self.arrays
+
+    def __getitem__(self, name):
+        return self.read(name)
+
+    def shape(self, name):
+        """
+        :param name: str: array name
+        :return: tuple: shape of the array
+        """
+        self._check_name(name)
+        return tuple(self.arrays[name]['shape'])
+
+    def create(self, name, shape, dtype=np.float32, fill_value=None, attrs=None):
+        """
+        Create a new array in the store and return it as a writable memory map, to be filled in place.
+
+        :param name: str: array name; also used for the file name
+        :param shape: tuple: shape of the array
+        :param dtype: numpy dtype: data type of the array
+        :param fill_value: if not None, initial value of all elements
+        :param attrs: dict: JSON-serializable attributes of the array
+        :return: numpy memmap
+        """
+        self._check_writable()
+        if os.sep in name or name in ['', '.', '..']:
+            raise ValueError("invalid array name '%s'" % name)
+        file_name = '%s.npy' % name
+        array = np.lib.format.open_memmap(os.path.join(self.directory, file_name), mode='w+', dtype=np.dtype(dtype),
+                                          shape=tuple(int(s) for s in shape))
+        if fill_value is not None:
+            array[...] = fill_value
+        self.arrays[name] = {
+            'file': file_name,
+            'shape': [int(s) for s in shape],
+            'dtype': np.dtype(dtype).str,
+            'attrs': attrs or {}
+        }
+        self.flush()
+        return array
+
+    def write(self, name, array, dtype=None, attrs=None, chunk_size=None):
+        """
+        Write an array to the store, copying it in chunks along its first dimension.
+
+        :param name: str: array name
+        :param array: ndarray: data to write
+        :param dtype: numpy dtype: data type to store (default: that of 'array')
+        :param attrs: dict: JSON-serializable attributes of the array
+        :param chunk_size: int: number of elements along the first dimension copied at a time (default: about
+            64 MB per chunk)
+        """
+        array = np.asanyarray(array)
+        out = self.create(name, array.shape, dtype=dtype or array.dtype, attrs=attrs)
+        if array.ndim == 0:
+            out[...] = array
+        else:
+            if chunk_size is None:
+                row_size = max(int(np.prod(array.shape[1:])) * out.dtype.itemsize, 1)
+                chunk_size = max(1, (64 << 20) // row_size)
+            for start in range(0, array.shape[0], chunk_size):
+                out[start:start + chunk_size] = array[start:start + chunk_size]
+        out.flush()
+
+    def read(self, name, mmap=True):
+        """
+        Read an array from the store.
+
+        :param name: str: array name
+        :param mmap: bool: if True, return a read-only memory map; otherwise load the array into memory
+        :return: ndarray
+        """
+        self._check_name(name)
+        return np.load(os.path.join(self.directory, self.arrays[name]['file']), mmap_mode='r' if mmap else None)
+
+    def slice(self, name, index):
+        """
+        Read part of an array into memory.
+
+        :param name: str: array name
+        :param index: index or tuple of indices (slices, integers, or index arrays) into the array
+        :return: ndarray
+        """
+        return np.array(self.read(name)[index])
+
+    def take(self, name, indices, axis=0, n_jobs=1):
+        """
+        Read the elements 'indices' along an axis of an array into memory, optionally in parallel threads.
+
+        :param name: str: array name
+        :param indices: iter: integer indices along 'axis'
+        :param axis: int: axis of the indices
+        :param n_jobs: int: number of threads reading at a time
+        :return: ndarray
+        """
+        array = self.read(name)
+        indices = np.asarray(indices, dtype=int)
+        if n_jobs <= 1 or len(indices) < 2:
+            return np.take(array, indices, axis=axis)
+        result = np.empty(array.shape[:axis % array.ndim] + (len(indices),) + array.shape[axis % array.ndim + 1:],
+                          dtype=array.dtype)
+        result_view = np.moveaxis(result, axis, 0)
+
+        def read_chunk(chunk):
+            result_view[chunk] = np.moveaxis(np.take(array, indices[chunk], axis=axis), axis, 0)
+
+        with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+            for future in [executor.submit(read_chunk, chunk)
+                           for chunk in np.array_split(np.arange(len(indices)), n_jobs)]:
+                future.result()
+        return result
+
+    def remove(self, name):
+        """
+        Remove an array from the store.
+
+        :param name: str: array name
+        """
+        self._check_writable()
+        self._check_name(name)
+        os.remove(os.path.join(self.directory, self.arrays[name]['file']))
+        del self.arrays[name]
+        self.flush()
+
+
+def save_arrays(directory, attrs=None, **arrays):
+    """
+    Write arrays to a new ArrayStore.
+
+    :param directory: str: directory of the store
+    :param attrs: dict: JSON-serializable attributes of the store
+    :param arrays: arrays to write, by name
+    :return: ArrayStore: the store, opened for appending
+    """
+    store = ArrayStore(directory, mode='w')
+    for name, array in arrays.items():
+        store.write(name, array)
+    if attrs is not None:
+        store.attrs.update(attrs)
+        store.flush()
+    return store
+
+
+def load_arrays(directory, *names, mmap=True):
+    """
+    Read arrays from an ArrayStore.
+
+    :param directory: str: directory of the store
+    :param names: str: names of the arrays to read (default: all)
+    :param mmap: bool: if True, return read-only memory maps; otherwise load the arrays into memory
+    :return: dict of ndarrays
+    """
+    store = ArrayStore(directory)
+    if len(names) == 0:
+        names = store.keys()
+    return {name: store.read(name, mmap=mmap) for name in names}
+
+
+def pickle_to_store(pickle_file, directory, remove_pickle=False):
+    """
+    Convert a pickle file of a dictionary of arrays, as written by the preprocessing functions, to an ArrayStore.
+
+    :param pickle_file: str: pickle file
+    :param directory: str: directory of the new store
+    :param remove_pickle: bool: if True, delete the pickle file after the conversion
+    :return: ArrayStore: the new store
+    """
+    with open(pickle_file, 'rb') as handle:
+        save_vars = pickle.load(handle)
+    if not isinstance(save_vars, dict):
+        raise TypeError('pickle file %s does not contain a dictionary of arrays' % pickle_file)
+    store = ArrayStore(directory, mode='w')
+    for name, array in save_vars.items():
+        store.write(name, array)
+        save_vars[name] = None
+    store.attrs['source'] = os.path.abspath(pickle_file)
+    store.flush()
+    if remove_pickle:
+        os.remove(pickle_file)
+    return store
@@ -19,6 +19,7 @@ import random
 from ..util import meso_date_to_datetime, date_to_meso_date
 from datetime import timedelta
 from collections import OrderedDict
+from ..qc import trim_meso_data
 
 
 def _convert_variable_names(variables):
@@ -354,30 +355,17 @@ class MesoWest(Meso):
         meta = self.metadata(**kwargs)
         self.Metadata = meta
 
-    def trim_stations(self, missing_tolerance=0.05):
+    def trim_stations(self, missing_tolerance=0.05, return_stats=False):
         """
-        Trims stations in the loaded data that have a larger fraction of missing values than missing_tolerance.
+        Trims stations in the loaded data that have a larger fraction of missing values than missing_tolerance,
+        relative to the station with the most non-missing values.
 
         :param missing_tolerance: float: fraction of missing values allowed in a station's timeseries
-        :return:
+        :param return_stats: bool: if True, return the completeness statistics of all stations before trimming (see
+            ensemble_net.qc.completeness)
+        :return: xarray Dataset: completeness statistics, if return_stats is True
         """
-        def get_count(data):
-            station_list = list(data.keys())
-            n_s = len(station_list)
-            count = 0
-            for s in range(n_s):
-                count = max(count, np.sum(~np.isnan(data[station_list[s]].values)))
-            return count
-
-        def trim(data, num):
-            new_data = {}
-            for s in data.keys():
-                if np.sum(~np.isnan(data[s].values)) >= num:
-                    new_data[s] = data[s]
-            return new_data
-
-        if missing_tolerance > 1. or missing_tolerance < 0.:
-            raise ValueError("'missing_tolerance' must be between 0 and 1")
-        count_non_missing = (1 - missing_tolerance) * get_count(self.Data)
-        self.Data = trim(self.Data, count_non_missing)
+        self.Data, stats = trim_meso_data(self.Data, missing_tolerance, return_stats=True)
         self.stations = list(self.Data.keys())
+        if return_stats:
+            return stats
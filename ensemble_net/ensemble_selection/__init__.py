@@ -4,5 +4,5 @@
 # See the file LICENSE for your rights.
 #
 
-from . import preprocessing, verify
+from . import preprocessing, verify, shards, server
 from .model import *
@@ -0,0 +1,201 @@
+#
+# Copyright (c) 2017-18 Jonathan Weyn <jweyn@uw.edu>
+#
+# See the file LICENSE for your rights.
+#
+
+"""
+Double-buffered loading of training data chunks in a background process. A persistent worker process loads chunks
+(predictors and targets) directly into preallocated shared-memory buffers, so that the main process can train on one
+chunk while the next is loaded, without pickling or copying the arrays between processes. Requires Python 3.8 or
+newer for multiprocessing.shared_memory.
+
+The worker is started with the 'fork' start method by default, so that the load function may be defined in a flat
+training script (such as ens_sel.py) and read the script's global variables. With 'spawn' or 'forkserver' (the
+defaults on macOS and, from Python 3.14, on Linux), the worker would instead import the main script and run all of it
+again; use those only with a load function from an importable module, called from a script whose body is guarded by
+"if __name__ == '__main__'".
+"""
+
+import numpy as np
+import multiprocessing
+
+try:
+    from multiprocessing.shared_memory import SharedMemory
+except ImportError:
+    SharedMemory = None
+
+
+def _buffer_arrays(blocks, x_shape, y_shape, max_samples, dtype):
+    # Two slots, each with a predictor and a target array
+    arrays = []
+    for slot in range(2):
+        X = np.ndarray((max_samples,) + x_shape, dtype=dtype, buffer=blocks[2 * slot].buf)
+        y = np.ndarray((max_samples,) + y_shape, dtype=dtype, buffer=blocks[2 * slot + 1].buf)
+        arrays.append((X, y))
+    return arrays
+
+
+def _worker(load_function, names, x_shape, y_shape, max_samples, dtype, tasks, results):
+    blocks = [SharedMemory(name=name) for name in names]
+    arrays = _buffer_arrays(blocks, x_shape, y_shape, max_samples, dtype)
+    try:
+        while True:
+            task = tasks.get()
+            if task is None:
+                break
+            slot, arg = task
+            try:
+                X, y = load_function(arg)
+                num_samples = X.shape[0]
+                if num_samples > max_samples:
+                    raise ValueError('chunk has %d samples; buffers hold %d' % (num_samples, max_samples))
+                if X.shape[1:] != x_shape or y.shape[1:] != y_shape or y.shape[0] != num_samples:
+                    raise ValueError('chunk shapes %s, %s do not match buffer shapes %s, %s' %
+                                     (X.shape, y.shape, x_shape, y_shape))
+                arrays[slot][0][:num_samples] = X
+                arrays[slot][1][:num_samples] = y
+                results.put((slot, num_samples, None))
+            except Exception as e:
+                results.put((slot, 0, '%s: %s' % (type(e).__name__, e)))
+    finally:
+        arrays = None
+        for block in blocks:
+            block.close()
+
+
+class SharedChunkLoader(object):
+    """
+    Loads chunks of training data in a persistent background process into two shared-memory buffers. While the main
+    process uses one buffer, the next chunk is loaded into the other. Use as a context manager, or call 'start' and
+    'close'.
+
+    Example:
+        with SharedChunkLoader(load_chunk, x_shape, y_shape, max_samples) as loader:
+            for predictors, targets in loader.iterate(chunks):
+                model.fit(predictors, targets)
+    """
+
+    def __init__(self, load_function, x_shape, y_shape, max_samples, dtype=np.float32, start_method='fork'):
+        """
+        Initialize a SharedChunkLoader.
+
+        :param load_function: function: called in the worker process as load_function(arg) for each requested chunk;
+            must return a tuple of (predictors, targets) arrays with sample as the first dimension
+        :param x_shape: tuple: shape of one predictor sample
+        :param y_shape: tuple: shape of one target sample
+        :param max_samples: int: maximum number of samples in a chunk
+        :param dtype: numpy dtype: data type of the buffers
+        :param start_method: str: multiprocessing start method of the worker process, 'fork', 'spawn', or
+            'forkserver'. With the default 'fork', load_function may be any function of the main script; other
+            methods require it to be importable from a module (see the module docstring).
+        """
+        if SharedMemory is None:
+            raise ImportError('SharedChunkLoader requires multiprocessing.shared_memory (Python 3.8 or newer)')
+        if max_samples < 1:
+            raise ValueError("'max_samples' must be a positive integer")
+        self.load_function = load_function
+        self.x_shape = tuple(x_shape)
+        self.y_shape = tuple(y_shape)
+        self.max_samples = int(max_samples)
+        self.dtype = np.dtype(dtype)
+        try:
+            self._context = multiprocessing.get_context(start_method)
+        except ValueError:
+            raise ValueError("start method '%s' is not available on this platform" % start_method)
+        self._blocks = []
+        self._arrays = []
+        self._process = None
+        self._tasks = None
+        self._results = None
+        self._next_slot = 0
+        self._pending = 0
+
+    def start(self):
+        """
+        Allocate the shared buffers and start the worker process.
+        """
+        if self._process is not None:
+            return
+        sizes = [self.max_samples * int(np.prod(shape)) * self.dtype.itemsize
+                 for shape in (self.x_shape, self.y_shape)] * 2
+        self._blocks = [SharedMemory(create=True, size=max(size, 1)) for size in sizes]
+        self._arrays = _buffer_arrays(self._blocks, self.x_shape, self.y_shape, self.max_samples, self.dtype)
+        self._tasks = self._context.Queue()
+        self._results = self._context.Queue()
+        self._process = self._context.Process(target=_worker,
+                                              args=(self.load_function, [b.name for b in self._blocks],
+                                                    self.x_shape, self.y_shape, self.max_samples, self.dtype,
+                                                    self._tasks, self._results),
+                                              daemon=True)
+        self._process.start()
+
+    def submit(self, arg):
+        """
+        Request that the worker load a chunk into the next free buffer. At most two chunks may be outstanding; the
+        arrays returned by 'result' for a buffer are overwritten by the second following 'submit'.
+
+        :param arg: argument passed to load_function
+        """
+        if self._process is None:
+            self.start()
+        if self._pending >= 2:
+            raise RuntimeError('both buffers are in use; call result() first')
+        self._tasks.put((self._next_slot, arg))
+        self._next_slot = 1 - self._next_slot
+        self._pending += 1
+
+    def result(self):
+        """
+        Wait for the oldest submitted chunk.
+
+        :return: ndarray, ndarray: predictors and targets, as views of the shared buffer
+        """
+        if self._pending == 0:
+            raise RuntimeError('no chunk has been submitted')
+        slot, num_samples, error = self._results.get()
+        self._pending -= 1
+        if error is not None:
+            raise RuntimeError('SharedChunkLoader: error loading chunk: %s' % error)
+        X, y = self._arrays[slot]
+        return X[:num_samples], y[:num_samples]
+
+    def iterate(self, args):
+        """
+        Iterate over chunks, loading each next chunk while the current one is used.
+
+        :param args: iterable of arguments passed to load_function
+        :return: generator of (predictors, targets)
+        """
+        args = list(args)
+        if len(args) == 0:
+            return
+        self.submit(args[0])
+        for a in range(len(args)):
+            X, y = self.result()
+            if a + 1 < len(args):
+                self.submit(args[a + 1])
+            yield X, y
+
+    def close(self):
+        """
+        Stop the worker process and free the shared buffers.
+        """
+        if self._process is not None:
+            self._tasks.put(None)
+            self._process.join()
+            self._process = None
+        self._arrays = []
+        for block in self._blocks:
+            block.close()
+            block.unlink()
+        self._blocks = []
+        self._pending = 0
+        self._next_slot = 0
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -15,14 +15,87 @@ future.
 import keras
 import keras.layers
 import numpy as np
+import os
+import time
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from numba import jit
 import keras.models
 from keras.utils import multi_gpu_model, Sequence
 
-from .preprocessing import convert_ensemble_predictors_to_samples, convert_ae_meso_predictors_to_samples, \
-    convert_fss_predictors_to_samples, combine_predictors
-from ..nowcast.preprocessing import delete_nan_samples
+from .preprocessing import convert_ensemble_predictors_to_samples, ensemble_layout, split_model_inputs, Preprocessor
 from .. import util
-from .verify import rank
+from .verify import aggregate_scores
+
+
+@jit(nopython=True)
+def _fused_min_max(a, fill, scale, offset):
+    # Same operations, in the same order and precision, as Imputer and MinMaxScaler transforms
+    for i in range(a.shape[0]):
+        for j in range(a.shape[1]):
+            if np.isnan(a[i, j]):
+                a[i, j] = fill[j]
+            a[i, j] = a[i, j] * scale[j]
+            a[i, j] = a[i, j] + offset[j]
+
+
+@jit(nopython=True)
+def _fused_standard(a, fill, mean, scale):
+    # Same operations, in the same order and precision, as Imputer and StandardScaler/MaxAbsScaler transforms
+    for i in range(a.shape[0]):
+        for j in range(a.shape[1]):
+            if np.isnan(a[i, j]):
+                a[i, j] = fill[j]
+            a[i, j] = a[i, j] - mean[j]
+            a[i, j] = a[i, j] / scale[j]
+
+
+class _RunningStats(object):
+    """
+    NaN-aware running statistics of each feature (column) of 2d arrays, updated one batch at a time. Batch means and
+    sums of squared deviations are merged with the parallel algorithm of Chan et al. (1979).
+    """
+    def __init__(self):
+        self.rows = 0
+        self.count = None
+        self.mean = None
+        self.m2 = None
+        self.min = None
+        self.max = None
+
+    def update(self, a):
+        valid = ~np.isnan(a)
+        n = valid.sum(axis=0)
+        if self.count is None:
+            self.count = np.zeros(a.shape[1])
+            self.mean = np.zeros(a.shape[1])
+            self.m2 = np.zeros(a.shape[1])
+            self.min = np.full(a.shape[1], np.inf)
+            self.max = np.full(a.shape[1], -np.inf)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            batch_mean = np.where(n > 0, np.nansum(a, axis=0) / n, 0.)
+        batch_m2 = np.nansum((a - batch_mean) ** 2, axis=0)
+        total = self.count + n
+        delta = batch_mean - self.mean
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self.mean = np.where(total > 0, self.mean + delta * n / total, 0.)
+            self.m2 = np.where(total > 0, self.m2 + batch_m2 + delta ** 2 * self.count * n / total, 0.)
+        self.count = total
+        self.min = np.fmin(self.min, np.where(valid, a, np.inf).min(axis=0))
+        self.max = np.fmax(self.max, np.where(valid, a, -np.inf).max(axis=0))
+        self.rows += a.shape[0]
+
+    def imputed_var(self):
+        # Variance after replacing all missing values with the mean
+        return self.m2 / self.rows
+
+    def check_missing(self, name):
+        # A mean Imputer drops features missing in every row, so they cannot be imputed
+        missing = np.nonzero(self.count == 0)[0]
+        if len(missing) > 0:
+            raise ValueError('%s features %s are missing in every sample and cannot be imputed' %
+                             (name, missing.tolist()))
 
 
 class EnsembleSelector(object):
@@ -38,29 +111,19 @@ class EnsembleSelector(object):
         self.imputer = None
         self.imputer_y = None
         self.model = None
+        self.preprocessor = None
+        self.conv_shape = None
         self.is_parallel = False
         self.is_init_fit = False
 
-    def build_model(self, layers=(), gpus=1, **compile_kwargs):
-        """
-        Build a Keras Sequential model using the specified layers. Each element of layers must be a tuple consisting of
-        (layer_name, layer_args, layer_kwargs); that is, each tuple is the name of the layer as defined in keras.layers,
-        a tuple of arguments passed to the layer, and a dictionary of kwargs passed to the layer.
-
-        :param layers: tuple: tuple of (layer_name, kwargs_dict) pairs added to the model
-        :param gpus: int: number of GPU units on which to parallelize the Keras model
-        :param compile_kwargs: kwargs passed to the 'compile' method of the Keras model
-        :return:
-        """
-        # Test the parameters
-        if type(gpus) is not int:
-            raise TypeError("'gpus' argument must be an int")
+    @staticmethod
+    def _check_layers(layers, name='layers'):
         if type(layers) not in [list, tuple]:
-            raise TypeError("'layers' argument must be a tuple")
+            raise TypeError("'%s' argument must be a tuple" % name)
         for l in range(len(layers)):
             layer = layers[l]
             if type(layer) not in [list, tuple]:
-                raise TypeError("each element of 'layers' must be a tuple")
+                raise TypeError("each element of '%s' must be a tuple" % name)
             if len(layer) != 3:
                 raise ValueError("each layer must be specified by three elements (name, args, kwargs)")
             if layer[1] is None:
@@ -71,22 +134,114 @@ class EnsembleSelector(object):
                 layer[2] = {}
             if type(layer[2]) is not dict:
                 raise TypeError("the 'kwargs' element of layer %d must be a dict" % l)
+
+    @staticmethod
+    def _make_layer(layer):
+        try:
+            layer_class = util.get_from_class('keras.layers', layer[0])
+        except (ImportError, AttributeError):
+            layer_class = util.get_from_class('ensemble_net.util', layer[0])
+        return layer_class(*layer[1], **layer[2])
+
+    def build_model(self, layers=(), gpus=1, **compile_kwargs):
+        """
+        Build a Keras Sequential model using the specified layers. Each element of layers must be a tuple consisting of
+        (layer_name, layer_args, layer_kwargs); that is, each tuple is the name of the layer as defined in keras.layers,
+        a tuple of arguments passed to the layer, and a dictionary of kwargs passed to the layer.
+
+        :param layers: tuple: tuple of (layer_name, kwargs_dict) pairs added to the model
+        :param gpus: int: number of GPU units on which to parallelize the Keras model
+        :param compile_kwargs: kwargs passed to the 'compile' method of the Keras model
+        :return:
+        """
+        # Test the parameters
+        if type(gpus) is not int:
+            raise TypeError("'gpus' argument must be an int")
+        self._check_layers(layers)
         # Self-explanatory
         util.make_keras_picklable()
         # Build a model, either on a single GPU or on a CPU to control multiple GPUs
         self.model = keras.models.Sequential()
         for l in range(len(layers)):
-            layer = layers[l]
-            try:
-                layer_class = util.get_from_class('keras.layers', layer[0])
-            except (ImportError, AttributeError):
-                layer_class = util.get_from_class('ensemble_net.util', layer[0])
-            self.model.add(layer_class(*layer[1], **layer[2]))
+            self.model.add(self._make_layer(layers[l]))
+        self.conv_shape = None
         if gpus > 1:
             self.model = multi_gpu_model(self.model, gpus=gpus, cpu_relocation=True)
             self.is_parallel = True
         self.model.compile(**compile_kwargs)
 
+    def build_multi_input_model(self, conv_shape, num_extra_features, conv_layers=(), layers=(),
+                                extra_activation=None, gpus=1, **compile_kwargs):
+        """
+        Build a Keras model with two inputs: the spatial (ENS_PRED) predictors as a 4-dimensional tensor of samples by
+        conv_shape, passed through conv_layers and flattened, and the remaining (station and FSS) predictors, which
+        are concatenated with the flattened convolution output and passed through layers. This replaces a first
+        PartialConv2D layer, which reshapes and concatenates the inputs on every forward pass, with native Conv2D
+        layers. Layers are specified as in 'build_model', without an 'input_shape'.
+
+        Predictors passed to 'fit', 'predict', 'evaluate' and 'select' may still be samples-by-features arrays, as
+        produced by the DataGenerator, with the spatial features first; they are split into the two inputs after
+        scaling (see preprocessing.split_model_inputs). They may also be lists of [spatial, extra] arrays.
+
+        :param conv_shape: tuple: shape of the spatial predictors of one sample, e.g. DataGenerator.spatial_shape
+        :param num_extra_features: int: number of other predictor features. If 0, the model has only the spatial
+            input.
+        :param conv_layers: tuple: tuple of (layer_name, layer_args, layer_kwargs) applied to the spatial input
+        :param layers: tuple: tuple of (layer_name, layer_args, layer_kwargs) applied to the combined features
+        :param extra_activation: str: if not None, activation applied to the extra features before the
+            concatenation. Use the activation of the first convolution to reproduce a PartialConv2D model, which
+            applies its activation to the extra features.
+        :param gpus: int: number of GPU units on which to parallelize the Keras model
+        :param compile_kwargs: kwargs passed to the 'compile' method of the Keras model
+        :return:
+        """
+        if type(gpus) is not int:
+            raise TypeError("'gpus' argument must be an int")
+        conv_shape = tuple(int(c) for c in conv_shape)
+        if len(conv_shape) != 3:
+            raise ValueError("'conv_shape' must be of length 3, e.g. (rows, cols, channels)")
+        if num_extra_features < 0:
+            raise ValueError("'num_extra_features' must be non-negative")
+        self._check_layers(conv_layers, 'conv_layers')
+        self._check_layers(layers)
+        util.make_keras_picklable()
+        spatial_input = keras.layers.Input(shape=conv_shape, name='spatial')
+        x = spatial_input
+        for l in range(len(conv_layers)):
+            x = self._make_layer(conv_layers[l])(x)
+        x = keras.layers.Flatten()(x)
+        inputs = [spatial_input]
+        if num_extra_features > 0:
+            extra_input = keras.layers.Input(shape=(int(num_extra_features),), name='extra')
+            inputs.append(extra_input)
+            extra = extra_input
+            if extra_activation is not None:
+                extra = keras.layers.Activation(extra_activation)(extra)
+            x = keras.layers.Concatenate(axis=-1)([x, extra])
+        for l in range(len(layers)):
+            x = self._make_layer(layers[l])(x)
+        self.model = keras.models.Model(inputs=inputs, outputs=x)
+        self.conv_shape = conv_shape
+        if gpus > 1:
+            self.model = multi_gpu_model(self.model, gpus=gpus, cpu_relocation=True)
+            self.is_parallel = True
+        self.model.compile(**compile_kwargs)
+
+    def split_inputs(self, predictors):
+        """
+        Split samples-by-features predictors into the inputs of the model. Predictors are returned unchanged if the
+        model was not built with 'build_multi_input_model', or if they are already a list of inputs.
+
+        :param predictors: ndarray: samples by features predictor data
+        :return: ndarray or list of ndarrays: model inputs
+        """
+        if getattr(self, 'conv_shape', None) is None or isinstance(predictors, (list, tuple)):
+            return predictors
+        spatial, extra = split_model_inputs(predictors, self.conv_shape)
+        if len(self.model.inputs) == 1:
+            return spatial
+        return [spatial, extra]
+
     @staticmethod
     def _reshape(a, ret=False):
         a_shape = a.shape
@@ -133,15 +288,201 @@ class EnsembleSelector(object):
         else:
             return X_transform.reshape(X_shape)
 
-    def init_fit(self, predictors, targets):
+    def _scaler_from_stats(self, stats):
+        # Fit a scaler on synthesized rows which have the accumulated statistics
+        scaler_class = util.get_from_class('sklearn.preprocessing', self.scaler_type)
+        scaler = scaler_class()
+        if self.scaler_type in ['MinMaxScaler', 'MaxAbsScaler']:
+            scaler.fit(np.vstack((stats.min, stats.max)))
+        else:
+            std = np.sqrt(stats.imputed_var())
+            scaler.fit(np.vstack((stats.mean + std, stats.mean - std)))
+        scaler.n_samples_seen_ = stats.rows
+        return scaler
+
+    def _streaming_init_fit(self, batches):
+        scaler_class = util.get_from_class('sklearn.preprocessing', self.scaler_type)
+        if self.impute:
+            if self.scaler_type not in ['MinMaxScaler', 'MaxAbsScaler', 'StandardScaler']:
+                raise ValueError("scaler type '%s' cannot be fit incrementally with imputing" % self.scaler_type)
+            stats_X = _RunningStats()
+            stats_y = _RunningStats()
+        else:
+            if not hasattr(scaler_class, 'partial_fit'):
+                raise ValueError("scaler type '%s' cannot be fit incrementally" % self.scaler_type)
+            self.scaler = scaler_class()
+            self.scaler_y = scaler_class()
+
+        num_batches = 0
+        for X, y in batches:
+            X = self._reshape(X)
+            y = self._reshape(y)
+            if X.shape[0] == 0:
+                continue
+            if self.impute:
+                stats_X.update(X)
+                stats_y.update(y)
+            else:
+                self.scaler.partial_fit(X)
+                if self.scale_targets:
+                    self.scaler_y.partial_fit(y)
+            num_batches += 1
+        if num_batches == 0:
+            raise ValueError('no samples were provided to fit the Scaler')
+
+        if self.impute:
+            stats_X.check_missing('predictor')
+            stats_y.check_missing('target')
+            imputer_class = util.get_from_class('sklearn.preprocessing', 'Imputer')
+            self.imputer = imputer_class(missing_values=np.nan, strategy="mean", axis=0, copy=False)
+            self.imputer_y = imputer_class(missing_values=np.nan, strategy="mean", axis=0, copy=False)
+            self.imputer.fit(stats_X.mean[np.newaxis, :])
+            self.imputer_y.fit(stats_y.mean[np.newaxis, :])
+            self.scaler = self._scaler_from_stats(stats_X)
+            if self.scale_targets:
+                self.scaler_y = self._scaler_from_stats(stats_y)
+            else:
+                self.scaler_y = scaler_class()
+
+    @staticmethod
+    def _fused_parameters(scaler, imputer, num_features):
+        # Parameters for the fused kernels, or None if the pre-processors are not supported
+        if imputer is not None:
+            fill = np.asarray(imputer.statistics_, dtype=np.float64)
+            if fill.shape[0] != num_features or np.any(np.isnan(fill)):
+                return None
+        else:
+            fill = np.full(num_features, np.nan)
+        zeros = np.zeros(num_features)
+        ones = np.ones(num_features)
+        if scaler is None:
+            return _fused_standard, fill, zeros, ones
+        scaler_name = type(scaler).__name__
+        if scaler_name == 'MinMaxScaler' and not getattr(scaler, 'clip', False):
+            return _fused_min_max, fill, np.asarray(scaler.scale_, dtype=np.float64), \
+                np.asarray(scaler.min_, dtype=np.float64)
+        elif scaler_name == 'StandardScaler':
+            mean = np.asarray(scaler.mean_, dtype=np.float64) if scaler.with_mean else zeros
+            scale = np.asarray(scaler.scale_, dtype=np.float64) if scaler.with_std else ones
+            return _fused_standard, fill, mean, scale
+        elif scaler_name == 'MaxAbsScaler':
+            return _fused_standard, fill, zeros, np.asarray(scaler.scale_, dtype=np.float64)
+        return None
+
+    @staticmethod
+    def _writable_array(a, copy):
+        if not np.issubdtype(a.dtype, np.floating):
+            return a.astype(np.float64)
+        elif copy or not a.flags['C_CONTIGUOUS'] or not a.flags['WRITEABLE']:
+            return np.array(a, order='C')
+        return a
+
+    def _fused_transform_array(self, a, scaler, imputer, copy):
+        if isinstance(a, (list, tuple)):
+            return self._fused_transform_inputs(a, scaler, imputer, copy)
+        a = self._writable_array(a, copy)
+        a_2d = a.reshape((a.shape[0], -1))
+        parameters = self._fused_parameters(scaler, imputer, a_2d.shape[1])
+        if parameters is None:
+            if imputer is not None:
+                a_2d = imputer.transform(a_2d)
+            if scaler is not None:
+                a_2d = scaler.transform(a_2d)
+            return a_2d.reshape(a.shape)
+        kernel, fill, p1, p2 = parameters
+        kernel(a_2d, fill, p1, p2)
+        return a
+
+    def _fused_transform_inputs(self, inputs, scaler, imputer, copy):
+        # Arrays of consecutive features, transformed piecewise with slices of the full-width parameters
+        sizes = [int(np.prod(a.shape[1:])) for a in inputs]
+        bounds = np.cumsum([0] + sizes)
+        parameters = self._fused_parameters(scaler, imputer, int(bounds[-1]))
+        if parameters is None:
+            combined = np.concatenate([np.reshape(a, (a.shape[0], -1)) for a in inputs], axis=-1)
+            combined = self._fused_transform_array(combined, scaler, imputer, False)
+            return [combined[:, bounds[i]:bounds[i + 1]].reshape(inputs[i].shape) for i in range(len(inputs))]
+        kernel, fill, p1, p2 = parameters
+        result = []
+        for i, a in enumerate(inputs):
+            a = self._writable_array(a, copy)
+            kernel(a.reshape((a.shape[0], -1)), fill[bounds[i]:bounds[i + 1]], p1[bounds[i]:bounds[i + 1]],
+                   p2[bounds[i]:bounds[i + 1]])
+            result.append(a)
+        return result
+
+    def num_features(self):
+        """
+        :return: int: number of predictor features the fitted Imputer and Scaler (and so the model) expect, or None
+            if they are not fitted
+        """
+        if self.impute and self.imputer is not None:
+            return len(self.imputer.statistics_)
+        if self.scaler is not None and hasattr(self.scaler, 'scale_'):
+            return len(self.scaler.scale_)
+        return None
+
+    def _check_num_features(self, X):
+        if isinstance(X, (list, tuple)):
+            width = sum(int(np.prod(a.shape[1:])) for a in X)
+        else:
+            width = int(np.prod(X.shape[1:]))
+        expected = self.num_features()
+        if expected is not None and width != expected:
+            raise ValueError('predictors have %d features, but the EnsembleSelector was fit on %d; check that they '
+                             'are processed with the same variables and options as in training' % (width, expected))
+
+    def fused_transform(self, X, y=None, copy=False):
+        """
+        Impute (if the model imputes) and scale predictors, and optionally targets, in a single pass over the data.
+        Floating-point arrays are transformed in place unless copy is True; the dtype (e.g. float32) is kept. The
+        result is identical to imputer_transform followed by scaler_transform. Scalers other than MinMaxScaler,
+        StandardScaler, and MaxAbsScaler fall back to the sklearn transforms. X may also be a list of arrays of
+        consecutive features, such as the [spatial, extra] inputs of a multi-input model, which are transformed
+        piecewise without being combined.
+
+        :param X: ndarray or list of ndarrays: predictor data
+        :param y: ndarray: optional target data
+        :param copy: bool: if True, do not modify the input arrays
+        :return: ndarray: transformed X (ndarray: transformed y)
+        """
+        self._check_num_features(X)
+        X = self._fused_transform_array(X, self.scaler, self.imputer if self.impute else None, copy)
+        if y is None:
+            return X
+        if self.impute or self.scale_targets:
+            y = self._fused_transform_array(y, self.scaler_y if self.scale_targets else None,
+                                            self.imputer_y if self.impute else None, copy)
+        return X, y
+
+    def init_fit(self, predictors, targets=None):
         """
         Initialize the Imputer and Scaler of the model manually. This is useful for fitting the data pre-processors
         on a larger set of data before calls to the model 'fit' method with smaller sets of data and initialize=False.
 
-        :param predictors: ndarray: predictor data
-        :param targets: ndarray: corresponding truth data
+        Instead of arrays, predictors may be a DataGenerator or an iterable of (predictors, targets) batches. The
+        statistics are then accumulated in one pass over the batches without holding all the data in memory, using
+        the scaler's 'partial_fit', or, when imputing, NaN-aware running statistics (the scaler must then be a
+        MinMaxScaler, MaxAbsScaler, or StandardScaler).
+
+        :param predictors: ndarray: predictor data; or DataGenerator; or iterable of (predictors, targets)
+        :param targets: ndarray: corresponding truth data, if predictors is an ndarray
         :return:
         """
+        if isinstance(predictors, DataGenerator):
+            generator = predictors
+            batches = (generator.generate_data(np.arange(d, min(d + generator.batch_size, generator.num_dates)),
+                                               scale_and_impute=False)
+                       for d in range(0, generator.num_dates, generator.batch_size))
+            self._streaming_init_fit(batches)
+            self.is_init_fit = True
+            return
+        elif not isinstance(predictors, np.ndarray):
+            self._streaming_init_fit(predictors)
+            self.is_init_fit = True
+            return
+        if targets is None:
+            raise ValueError("'targets' must be provided with an array of predictors")
         if self.impute:
             self.imputer_fit(predictors, targets)
             predictors, targets = self.imputer_transform(predictors, y=targets)
@@ -161,46 +502,41 @@ class EnsembleSelector(object):
         """
         if initialize:
             self.init_fit(predictors, targets)
-        if self.impute:
-            predictors, targets = self.imputer_transform(predictors, y=targets)
-        predictors_scaled, targets_scaled = self.scaler_transform(predictors, targets)
+        predictors_scaled, targets_scaled = self.fused_transform(predictors, targets, copy=True)
         # Need to scale the validation data if it is given
         if 'validation_data' in kwargs:
-            if self.impute:
-                predictors_test_scaled, targets_test_scaled = self.imputer_transform(*kwargs['validation_data'])
-            else:
-                predictors_test_scaled, targets_test_scaled = kwargs['validation_data']
-            predictors_test_scaled, targets_test_scaled = self.scaler_transform(predictors_test_scaled,
-                                                                                targets_test_scaled)
-            kwargs['validation_data'] = (predictors_test_scaled, targets_test_scaled)
-        self.model.fit(predictors_scaled, targets_scaled, **kwargs)
+            predictors_test_scaled, targets_test_scaled = self.fused_transform(*kwargs['validation_data'], copy=True)
+            kwargs['validation_data'] = (self.split_inputs(predictors_test_scaled), targets_test_scaled)
+        self.model.fit(self.split_inputs(predictors_scaled), targets_scaled, **kwargs)
 
     def fit_generator(self, generator, **kwargs):
         """
         Fit the EnsembleSelector model using a generator.
 
         :param generator: a generator for producing batches of data (see Keras docs)
-        :param kwargs: passed to the model's fit_generator() method
+        :param kwargs: passed to the model's fit_generator() method. Already-scaled validation_data arrays are split
+            into the inputs of a multi-input model.
         :return:
         """
         # If generator is a DataGenerator below, check that we have called init_fit
         if isinstance(generator, DataGenerator):
             if not self.is_init_fit:
                 raise AttributeError('EnsembleSelector has not been initialized for fitting with init_fit()')
+        if isinstance(kwargs.get('validation_data', None), tuple):
+            kwargs['validation_data'] = (self.split_inputs(kwargs['validation_data'][0]),) + \
+                tuple(kwargs['validation_data'][1:])
         self.model.fit_generator(generator, **kwargs)
 
     def predict(self, predictors, **kwargs):
         """
         Make a prediction with the EnsembleSelector model. Also performs input feature scaling.
 
-        :param predictors: ndarray: predictor data
+        :param predictors: ndarray or list of ndarrays: predictor data
         :param kwargs: passed to Keras 'predict' method
         :return:
         """
-        if self.impute:
-            predictors = self.imputer_transform(predictors)
-        predictors_scaled = self.scaler_transform(predictors)
-        predicted = self.model.predict(predictors_scaled, **kwargs)
+        predictors_scaled = self.fused_transform(predictors, copy=True)
+        predicted = self.model.predict(self.split_inputs(predictors_scaled), **kwargs)
         if self.scale_targets:
             return self.scaler_y.inverse_transform(predicted)
         else:
@@ -210,36 +546,41 @@ class EnsembleSelector(object):
         """
         Run the Keras model's 'evaluate' method, with input feature scaling.
 
-        :param predictors: ndarray: predictor data
+        :param predictors: ndarray or list of ndarrays: predictor data
         :param targets: ndarray: target data
         :param kwargs: passed to Keras 'evaluate' method
         :return:
         """
-        if self.impute:
-            predictors, targets = self.imputer_transform(predictors, targets)
-        predictors_scaled, targets_scaled = self.scaler_transform(predictors, targets)
-        score = self.model.evaluate(predictors_scaled, targets_scaled, **kwargs)
+        predictors_scaled, targets_scaled = self.fused_transform(predictors, targets, copy=True)
+        score = self.model.evaluate(self.split_inputs(predictors_scaled), targets_scaled, **kwargs)
         return score
 
-    def select(self, predictors, ensemble_shape, axis=0, abs=True, agg=np.mean, **kwargs):
+    def select(self, predictors, ensemble_shape, axis=0, date_axis=None, abs=True, agg=np.mean,
+               predict_batch_size=4096, **kwargs):
         """
         Make a prediction from the predictors for an ensemble, and determine which ensemble member yields the least
-        error.
-        TODO: add support for init_date dimension as well
+        error. Samples are passed to the model in chunks of predict_batch_size, so that many init dates may be
+        processed at once with bounded memory.
 
         :param predictors: ndarray: array of predictor data. The first m dimensions must match the shape given by
             ensemble_shape, while the remaining dimensions must match the expected feature input shape of the fitted
             Keras model.
         :param ensemble_shape: tuple: ensemble dimensions (first m dimensions of predictors). Must contain an ensemble
-            member dimension. Other dimensions are considered convolutions and simply averaged.
+            member dimension. Other dimensions, except the init date dimension, are considered convolutions and
+            simply averaged.
         :param axis: int: the axis among the first m dimensions (given by ensemble_shape) of the ensemble member dim
+        :param date_axis: int: if not None, the axis among the first m dimensions of an init date dimension. Scores
+            and ranks are then computed for each date.
         :param abs: bool: if True, take the absolute mean of the predicted errors
         :param agg: method: aggregation method for combining predicted errors into one score. Should accept an 'axis'
             kwarg. If None, then returns the raw selection scores.
+        :param predict_batch_size: int: maximum number of samples passed to the 'predict' method at a time
         :param kwargs: passed to Keras 'predict' method
-        :return: ndarray: 2-dimensional array of aggregated error score and rank of each ensemble member
+        :return: ndarray: array of aggregated error score and rank of each ensemble member, of shape (member, 2), or
+            (date, member, 2) if date_axis is given
         """
         p_shape = predictors.shape
+        ensemble_shape = tuple(ensemble_shape)
         ens_size = len(ensemble_shape)
         if p_shape[:ens_size] != ensemble_shape:
             raise ValueError("'ensemble_shape' must match the first m dimensions of 'predictors'")
@@ -247,36 +588,28 @@ class EnsembleSelector(object):
             raise ValueError("'axis' larger than dimensions in 'ensemble_shape'")
         if axis == -1:
             axis = ens_size - 1
-        predict_shape = (np.cumprod(ensemble_shape)[-1],) + p_shape[ens_size:]
-        predicted = self.predict(predictors.reshape(predict_shape), **kwargs)
-        predicted_shape = ensemble_shape + (-1,)
-        predicted = predicted.reshape(predicted_shape)
-        dim_sub = 0
-        for dim in range(ens_size):
-            if dim != axis:
-                predicted = np.mean(predicted, axis=dim - dim_sub)
-                dim_sub += 1
-        # We should now have a ens_size-by-target_features array
-        # Use the aggregation method
-        if abs:
-            predicted = np.abs(predicted)
-            if agg is None:
-                print("warning: returning absolute value of the prediction ('abs' is True)")
-        if agg is None:
-            return predicted
-        agg_score = agg(predicted, axis=1)
-        agg_rank = rank(agg_score)
-        return np.vstack((agg_score, agg_rank)).T
+        num_samples = int(np.prod(ensemble_shape))
+        predict_shape = (num_samples,) + p_shape[ens_size:]
+        predictors = predictors.reshape(predict_shape)
+        predicted = None
+        for start in range(0, num_samples, predict_batch_size):
+            chunk = self.predict(predictors[start:start + predict_batch_size], **kwargs)
+            if predicted is None:
+                predicted = np.empty((num_samples,) + chunk.shape[1:], dtype=chunk.dtype)
+            predicted[start:start + predict_batch_size] = chunk
+        predicted = predicted.reshape(ensemble_shape + (-1,))
+        return aggregate_scores(predicted, axis=axis, date_axis=date_axis, abs=abs, agg=agg, mean=np.mean)
 
 
 class DataGenerator(Sequence):
     """
     Class used to generate training data on the fly from a loaded DataSet of predictor data. Depends on the structure
-    of the EnsembleSelector to do scaling and imputing of data.
+    of the EnsembleSelector to do scaling and imputing of data. Batches are split into the inputs of the selector's
+    model if it was built with 'build_multi_input_model'.
     """
 
     def __init__(self, selector, ds, batch_size=32, convolved=False, shuffle=False, missing_threshold=None,
-                 obs_errors='both', radar_fss='none'):
+                 obs_errors='both', radar_fss='none', selection=None, n_jobs=1):
         """
         Initialize a DataGenerator.
 
@@ -297,6 +630,10 @@ class DataGenerator(Sequence):
             't' or 'targets': use as targets only
             'both': use as both predictors and targets
             'none': do not use
+        :param selection: dict: if given, passed to the Dataset's 'sel' method before processing, e.g.
+            {'obs_var': [0]}. Use this rather than selecting from ds beforehand, so that the selection is saved with
+            the selector's Preprocessor.
+        :param n_jobs: int: number of threads converting the arrays of a batch
         """
         self.selector = selector
         self.ds = ds
@@ -316,8 +653,17 @@ class DataGenerator(Sequence):
         self.obs_errors = obs_errors
         self.radar_fss = radar_fss
         self.impute_missing = self.selector.impute
+        self.layout = ensemble_layout(self.ds['ENS_PRED'].dims)
         self.indices = []
 
+        # The pipeline producing the samples; saved with the selector, if it does not have one yet
+        self.preprocessor = Preprocessor.from_options(obs_errors, radar_fss, convolved=convolved,
+                                                      impute_missing=self.impute_missing,
+                                                      missing_threshold=missing_threshold, selection=selection,
+                                                      n_jobs=n_jobs)
+        if getattr(self.selector, 'preprocessor', None) is None:
+            self.selector.preprocessor = self.preprocessor
+
         self.num_dates = self.ds.dims['init_date']
         if self.convolved:
             self.num_samples = self.ds.dims['init_date'] * self.ds.dims['member'] * self.ds.dims['convolution']
@@ -332,7 +678,7 @@ class DataGenerator(Sequence):
         :return: the shape of the spatial component of ensemble predictors
         """
         forecast_predictors, fpi = convert_ensemble_predictors_to_samples(
-            self.ds['ENS_PRED'].isel(init_date=[0]).values, convolved=self.convolved)
+            self.ds['ENS_PRED'].isel(init_date=[0]).values, convolved=self.convolved, layout=self.layout)
         return forecast_predictors.shape[1:]
 
     def on_epoch_end(self):
@@ -345,47 +691,7 @@ class DataGenerator(Sequence):
             ds = self.ds.isel(init_date=days)
         else:
             ds = self.ds.isel(init_date=slice(None))
-        ds.load()
-
-        # Load all requested predictors
-        forecast_predictors, fpi = convert_ensemble_predictors_to_samples(ds['ENS_PRED'].values,
-                                                                          convolved=self.convolved)
-        if self.obs_errors in ['p', 'predictors', 'both']:
-            ae_predictors, epi = convert_ae_meso_predictors_to_samples(ds['AE_PRED'].values, convolved=self.convolved)
-            p = combine_predictors(forecast_predictors, ae_predictors)
-        else:
-            p = combine_predictors(forecast_predictors)
-        if self.radar_fss in ['p', 'predictors', 'both']:
-            fss_predictors, fsi = convert_fss_predictors_to_samples(ds['FSS_PRED'].values)
-            p = combine_predictors(p, fss_predictors)
-
-        # Load all requested targets
-        if self.obs_errors in ['t', 'targets', 'both']:
-            ae_targets, eti = convert_ae_meso_predictors_to_samples(np.expand_dims(ds['AE_TAR'].values, 3),
-                                                                    convolved=self.convolved)
-            t = combine_predictors(ae_targets)
-        else:
-            t = None
-        if self.radar_fss in ['t', 'targets', 'both']:
-            fss_targets, fsi = convert_fss_predictors_to_samples(np.expand_dims(ds['FSS_TAR'].values, -1))
-            t = combine_predictors(t, fss_targets)
-
-        ds.close()
-        ds = None
-
-        # Remove samples with NaN
-        if self.impute_missing:
-            if self.missing_threshold is not None:
-                p, t = delete_nan_samples(p, t, threshold=self.missing_threshold)
-            if scale_and_impute:
-                p, t = self.selector.imputer_transform(p, t)
-                p, t = self.selector.scaler_transform(p, t)
-        else:
-            p, t = delete_nan_samples(p, t)
-            if scale_and_impute:
-                p, t = self.selector.scaler_transform(p, t)
-
-        return p, t
+        return self.preprocessor.transform(ds, selector=self.selector if scale_and_impute else None)
 
     def __len__(self):
         """
@@ -405,4 +711,197 @@ class DataGenerator(Sequence):
         # Generate data
         X, y = self.generate_data(indexes)
 
+        return self.selector.split_inputs(X), y
+
+
+class PrefetchDataGenerator(DataGenerator):
+    """
+    DataGenerator which prepares the next batches in background threads while the model trains on the current one,
+    and keeps the processed (scaled and imputed) samples of each init date in a bounded LRU cache, so that dates
+    recurring in later epochs are not processed again. Keeps timing statistics of how long training waited on the
+    input pipeline; see the 'stats' method.
+
+    Prefetching assumes batches are requested in order, so use the generator's own 'shuffle' option and call
+    fit_generator with shuffle=False, workers=1 and use_multiprocessing=False. Prefetching starts on the first
+    requested batch, so the selector's Imputer and Scaler may be fit after the generator is created; if they are
+    re-fit afterwards, call 'clear_cache'.
+    """
+
+    def __init__(self, selector, ds, batch_size=32, prefetch=2, workers=2, cache_size=128, **kwargs):
+        """
+        Initialize a PrefetchDataGenerator.
+
+        :param selector: ensemble_net.ensemble_selection.EnsembleSelector model instance
+        :param ds: xarray Dataset: predictor dataset
+        :param batch_size: int: number of samples (days) to take at a time from the dataset
+        :param prefetch: int: number of batches to prepare ahead of the current one
+        :param workers: int: number of background threads preparing batches
+        :param cache_size: int: maximum number of init dates whose samples are kept in memory
+        :param kwargs: passed to DataGenerator
+        """
+        if prefetch < 0:
+            raise ValueError("'prefetch' must be a non-negative integer")
+        if workers < 1:
+            raise ValueError("'workers' must be a positive integer")
+        if cache_size < 0:
+            raise ValueError("'cache_size' must be a non-negative integer")
+        self.prefetch = prefetch
+        self.workers = workers
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._futures = {}
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pid = None
+        self._stats = {}
+        self.reset_stats()
+        super(PrefetchDataGenerator, self).__init__(selector, ds, batch_size=batch_size, **kwargs)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_cache'] = OrderedDict()
+        state['_futures'] = {}
+        state['_lock'] = None
+        state['_executor'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        # A forked process does not inherit the executor's threads
+        if self._executor is None or self._pid != os.getpid():
+            self._executor = ThreadPoolExecutor(max_workers=self.workers)
+            self._futures = {}
+            self._pid = os.getpid()
+        return self._executor
+
+    def _get_day(self, day):
+        with self._lock:
+            if day in self._cache:
+                self._cache.move_to_end(day)
+                self._stats['cache_hits'] += 1
+                return self._cache[day]
+            self._stats['cache_misses'] += 1
+        start_time = time.time()
+        p, t = self.generate_data([day])
+        with self._lock:
+            self._stats['prepare_time'] += time.time() - start_time
+            if self.cache_size > 0:
+                self._cache[day] = (p, t)
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+        return p, t
+
+    def _get_batch(self, index):
+        days = self.indices[index * self.batch_size:(index + 1) * self.batch_size]
+        samples = [self._get_day(day) for day in days]
+        X = np.concatenate([s[0] for s in samples])
+        y = np.concatenate([s[1] for s in samples])
         return X, y
+
+    def _schedule(self, index):
+        executor = self._get_executor()
+        with self._lock:
+            for i in range(index + 1, min(index + 1 + self.prefetch, len(self))):
+                if i not in self._futures:
+                    self._futures[i] = executor.submit(self._get_batch, i)
+
+    def on_epoch_end(self):
+        super(PrefetchDataGenerator, self).on_epoch_end()
+        # Batches prefetched for the old order of dates are no longer valid
+        with self._lock:
+            for future in self._futures.values():
+                future.cancel()
+            self._futures = {}
+
+    def clear_cache(self):
+        """
+        Remove all cached samples and prefetched batches.
+        """
+        self.on_epoch_end()
+        with self._lock:
+            self._cache.clear()
+
+    def close(self):
+        """
+        Shut down the background threads.
+        """
+        self.clear_cache()
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def reset_stats(self):
+        """
+        Reset the timing statistics.
+        """
+        self._stats = {
+            'batches': 0,
+            'prefetch_hits': 0,
+            'stall_time': 0.,
+            'max_stall_time': 0.,
+            'prepare_time': 0.,
+            'cache_hits': 0,
+            'cache_misses': 0,
+            'start_time': None,
+            'last_time': None
+        }
+
+    def stats(self):
+        """
+        Return timing statistics since the last reset:
+            'batches': number of batches served
+            'prefetch_hits': number of batches which had been prefetched
+            'stall_time': total time (s) spent waiting on batches
+            'mean_stall_time', 'max_stall_time': per-batch time (s) spent waiting on batches
+            'stall_fraction': fraction of the time since the first batch spent waiting on batches. Near 0, the model
+                is the bottleneck; near 1, the input pipeline is.
+            'prepare_time': total time (s) the workers spent processing init dates
+            'cache_hits', 'cache_misses': number of init dates found and not found in the cache
+            'cache_days': number of init dates currently in the cache
+
+        :return: dict: statistics
+        """
+        with self._lock:
+            stats = {k: v for k, v in self._stats.items() if k not in ['start_time', 'last_time']}
+            if self._stats['start_time'] is not None:
+                elapsed = self._stats['last_time'] - self._stats['start_time']
+            else:
+                elapsed = 0.
+            stats['cache_days'] = len(self._cache)
+        stats['mean_stall_time'] = stats['stall_time'] / max(stats['batches'], 1)
+        stats['stall_fraction'] = stats['stall_time'] / elapsed if elapsed > 0 else 0.
+        return stats
+
+    def __getitem__(self, index):
+        """
+        Get one batch of data
+        :param index: index of batch
+        :return:
+        """
+        start_time = time.time()
+        self._get_executor()
+        with self._lock:
+            future = self._futures.pop(index, None)
+        if future is not None and not future.cancelled():
+            X, y = future.result()
+            prefetched = True
+        else:
+            X, y = self._get_batch(index)
+            prefetched = False
+        self._schedule(index)
+        end_time = time.time()
+
+        stall = end_time - start_time
+        with self._lock:
+            self._stats['batches'] += 1
+            self._stats['prefetch_hits'] += int(prefetched)
+            self._stats['stall_time'] += stall
+            self._stats['max_stall_time'] = max(self._stats['max_stall_time'], stall)
+            if self._stats['start_time'] is None:
+                self._stats['start_time'] = start_time
+            self._stats['last_time'] = end_time
+
+        return self.selector.split_inputs(X), y
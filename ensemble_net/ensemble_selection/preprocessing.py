@@ -9,11 +9,22 @@ Methods for pre-processing data before use in an ensemble-selection model.
 """
 
 import numpy as np
+import netCDF4 as nc
+import xarray as xr
 import pickle
+import hashlib
+import threading
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from ..data_tools import NCARArray
-from ..nowcast.preprocessing import train_data_from_pickle, train_data_to_pickle, delete_nan_samples
+from ..verify.util import ae_meso_to_dense, is_dense_ae_meso
+from ..qc import trim_ae_meso
+from ..nowcast.preprocessing import train_data_from_pickle, train_data_to_pickle, train_data_from_store, \
+    train_data_to_store, delete_nan_samples
+from ..array_store import ArrayStore
 from numba import jit
+from scipy.sparse import csr_matrix
+from scipy.spatial import cKDTree
 
 
 @jit(nopython=True)
@@ -84,35 +95,50 @@ def _conv_agg(arr, agg, axis=0):
     return new_arr
 
 
-def predictors_from_ensemble(ensemble, xlim, ylim, variables=(), latlon=True, forecast_hours=(0, 12, 24),
-                             convolution=None, convolution_step=1, pickle_file=None, verbose=True):
+def _window_station_matrix(lats, lons, station_lats, station_lons):
     """
-    Generate predictor data from processed (written/loaded) ensemble files, for the ensemble selection model.
-    Data are hourly. Parameter 'forecast_hours' determines which forecast hours for each initialization are included
-    as predictors. The parameters 'convolution' and 'convolution_step' are used to split spatial data into multiple
-    predictor samples. If 'convolution' is not None, then either an integer or a tuple of integers of length 2 should
-    be provided; these integers determine the size of the convolution pass in the spatial directions (x,y). The
-    parameter 'convolution_step' determines the number of grid points to advance forward in space at each convolution.
-
-    :param ensemble: NCARArray or GR2Array object with .open() method called
-    :param variables: tuple of str: names of variables to retrieve from the data (see data docs)
-    :param xlim: tuple: minimum and maximum x-direction grid points (or longitude if latlon == True)
-    :param ylim: tuple: minimum and maximum y-direction grid points (or latitude if latlon == True)
-    :param latlon: bool: if True, assumes xlim and ylim are lon/lat points, and converts to grid points as required
-    :param forecast_hours: iter: iterable of forecast hours to include in the predictors
-    :param convolution: int or tuple: size of the convolution layer in (x,y) directions, or if int, square of specified
-        size. If None, no convolution is performed and the number of samples is the number of initialization dates
-        times the number of ensemble members.
-    :param convolution_step: int: spacing in grid points between convolutions. Ignored if convolution==None.
-    :param pickle_file: str: if given, file to write pickled predictor array
-    :param verbose: bool: print progress statements
-    :return: ndarray: array of predictors
+    Build a sparse (window x station) membership matrix for the lat/lon bounds of convolution windows, as returned by
+    _convolve_latlon. Stations are indexed by sorting on latitude, so that each window only checks the longitude of the
+    stations within its latitude band.
     """
-    # Test that data is loaded
-    if ensemble.Dataset is None:
-        raise IOError('no data loaded to ensemble object.')
+    num_windows = lats.shape[0]
+    num_stations = len(station_lats)
+    order = np.argsort(station_lats, kind='mergesort')
+    sorted_lats = station_lats[order]
+    rows = []
+    cols = []
+    for c in range(num_windows):
+        start = np.searchsorted(sorted_lats, lats[c, 0], side='left')
+        end = np.searchsorted(sorted_lats, lats[c, 1], side='right')
+        candidates = order[start:end]
+        candidate_lons = station_lons[candidates]
+        inside = candidates[(candidate_lons >= lons[c, 0]) & (candidate_lons <= lons[c, 1])]
+        rows.append(np.full(len(inside), c, dtype=np.int64))
+        cols.append(inside)
+    rows = np.concatenate(rows) if num_windows > 0 else np.array([], dtype=np.int64)
+    cols = np.concatenate(cols) if num_windows > 0 else np.array([], dtype=np.int64)
+    return csr_matrix((np.ones(len(rows)), (rows, cols)), shape=(num_windows, num_stations))
+
+
+def _sparse_conv_agg(matrix, arr, agg):
+    """
+    Equivalent of _conv_agg(arr[stations], agg, axis=0) for every window (row) of a sparse membership matrix from
+    _window_station_matrix at once. 'arr' must be 2-dimensional with stations as the first axis.
+    """
+    valid = ~np.isnan(arr)
+    arr = np.where(valid, arr, 0.).astype(np.float64)
+    if agg in ['mse', 'rmse']:
+        arr **= 2.
+    count = matrix.dot(valid.astype(np.float64))
+    total = matrix.dot(arr)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        new_arr = total / count
+    if agg == 'rmse':
+        new_arr = np.sqrt(new_arr)
+    return new_arr
 
-    # Sanity check for parameters
+
+def _check_convolution(convolution, convolution_step):
     if convolution_step < 1:
         raise ValueError("'convolution_step' should be at least 1")
     if convolution is not None:
@@ -125,7 +151,59 @@ def predictors_from_ensemble(ensemble, xlim, ylim, variables=(), latlon=True, fo
                 raise TypeError("'convolution' must be None, an integer, or a length-2 tuple of integers")
         if len(convolution) != 2:
             raise ValueError("'convolution' must be None, an integer, or a length-2 tuple of integers")
+    return convolution
+
+
+# Layouts of ensemble predictor arrays. 'ensemble': (init, variable, member, fhour, [convolution], y, x), as written
+# by default. 'samples': (init, member, [convolution], y, x, variable, fhour), the memory order of the samples of
+# convert_ensemble_predictors_to_samples, which then reshapes the array without copying it.
+ENSEMBLE_LAYOUTS = ('ensemble', 'samples')
+
+
+def _check_layout(layout):
+    if layout not in ENSEMBLE_LAYOUTS:
+        raise ValueError("'layout' must be one of %s" % list(ENSEMBLE_LAYOUTS))
+
+
+def ensemble_layout(dims):
+    """
+    Determine the layout of an ensemble predictor array from its dimension names, as in the files written by
+    predictors_from_ensemble_to_file.
+
+    :param dims: iter: dimension names, e.g. ds['ENS_PRED'].dims
+    :return: str: 'ensemble' or 'samples'
+    """
+    dims = tuple(dims)
+    if len(dims) > 1 and dims[1] == 'member':
+        return 'samples'
+    return 'ensemble'
+
+
+def _ensemble_layout_dims(layout, convolved):
+    # Dimension names of a predictor array in the given layout
+    if layout == 'samples':
+        dims = ('init_date', 'member', 'ny', 'nx', 'ens_var', 'ens_time')
+    else:
+        dims = ('init_date', 'ens_var', 'member', 'ens_time', 'ny', 'nx')
+    if convolved:
+        dims = dims[:-2] + ('convolution',) + dims[-2:] if layout == 'ensemble' else \
+            dims[:2] + ('convolution',) + dims[2:]
+    return dims
+
 
+def _layout_axes(layout, convolved):
+    # Order of the axes of the 'ensemble' layout in the given layout
+    if layout == 'ensemble':
+        return tuple(range(7 if convolved else 6))
+    return (0, 2, 4, 5, 6, 1, 3) if convolved else (0, 2, 4, 5, 1, 3)
+
+
+def _ensemble_predictor_setup(ensemble, xlim, ylim, variables, latlon, forecast_hours, convolution, convolution_step,
+                              verbose):
+    """
+    Get the sample indices, spatial bounds, and the shape of a single sample for predictors_from_ensemble. The sample
+    shape is in the order the samples are generated, i.e., before the convolution dimension is transposed.
+    """
     # Get the indexes of all training samples
     num_init = len(ensemble.dataset_init_dates)
     grand_index_list = []
@@ -157,29 +235,39 @@ def predictors_from_ensemble(ensemble, xlim, ylim, variables=(), latlon=True, fo
         x1, x2 = xlim
         y1, y2 = ylim
 
-    # Define the large arrays
+    # Define the shape of a sample
     num_x = x2 - x1
     num_y = y2 - y1
     if num_x < 1 or num_y < 1:
         raise ValueError("invalid 'xlim' or 'ylim'; must be monotonically increasing")
     num_var = len(variables)
-    num_samples = len(grand_index_list)
     num_members = ensemble.Dataset.dims['member']
     num_f_hours = len(forecast_hours)
     grand_index_array = np.array(grand_index_list, dtype=object)
     if convolution is None:
-        predictors = np.full((num_samples, num_var, num_members, num_f_hours, num_y, num_x,), np.nan, dtype=np.float32)
+        sample_shape = (num_var, num_members, num_f_hours, num_y, num_x)
     else:
         start_point_y = (convolution[1] + 1) // 2 - 1
         start_point_x = (convolution[0] + 1) // 2 - 1
         num_conv_y = len(range(start_point_y, num_y - convolution[1] // 2, convolution_step))
         num_conv_x = len(range(start_point_x, num_x - convolution[0] // 2, convolution_step))
         num_conv = num_conv_y * num_conv_x
-        predictors = np.full((num_samples, num_var, num_members, num_f_hours, convolution[1], convolution[0], num_conv),
-                             np.nan, dtype=np.float32)
+        sample_shape = (num_var, num_members, num_f_hours, convolution[1], convolution[0], num_conv)
 
-    # Add the data to the arrays
-    print('predictors_from_ensemble: strap in; this is gonna take a while.')
+    return grand_index_array, (y1, y2, x1, x2), sample_shape
+
+
+def _ensemble_predictor_blocks(ensemble, variables, grand_index_array, bounds, sample_shape, convolution,
+                               convolution_step, verbose):
+    """
+    Generator which loads the ensemble data for one init date at a time and yields the index of the init date and an
+    array of the predictor samples for that init date, of shape (num_samples_in_init,) + sample_shape.
+    """
+    y1, y2, x1, x2 = bounds
+    num_var, num_members, num_f_hours = sample_shape[:3]
+    num_y = y2 - y1
+    num_x = x2 - x1
+    num_samples = len(grand_index_array)
     if verbose:
         print('predictors_from_ensemble: dropping unnecessary variables')
     reduced_ds = ensemble.Dataset.copy()
@@ -189,7 +277,10 @@ def predictors_from_ensemble(ensemble, xlim, ylim, variables=(), latlon=True, fo
     # Split the samples by their init_dates. This requires manual counting, but makes loading of data much less
     # memory-intensive. If only xarray could load properly from the mf_dataset...
     sample_count = -1
-    for init in range(num_init):
+    for init in range(len(ensemble.dataset_init_dates)):
+        part_index_array = grand_index_array[grand_index_array[:, 0] == init]
+        if len(part_index_array) == 0:
+            continue
         init_date = ensemble.dataset_init_dates[init]
         if verbose:
             print('predictors_from_ensemble: reading all the data for init %s' % init_date)
@@ -199,7 +290,7 @@ def predictors_from_ensemble(ensemble, xlim, ylim, variables=(), latlon=True, fo
         except ValueError:
             new_ds = reduced_ds.isel(time=init, lat=range(y1, y2), lon=range(x1, x2))
         new_ds.load()
-        part_index_array = grand_index_array[grand_index_array[:, 0] == init]
+        block = np.full((len(part_index_array),) + sample_shape, np.nan, dtype=np.float32)
         for sample in range(len(part_index_array)):
             sample_count += 1
             for v in range(num_var):
@@ -210,14 +301,91 @@ def predictors_from_ensemble(ensemble, xlim, ylim, variables=(), latlon=True, fo
                 ind = part_index_array[sample]
                 field = new_ds[variable].isel(fhour=ind[1]).values.reshape((num_members, num_f_hours, num_y, num_x))
                 if convolution is None:
-                    predictors[sample_count, v, ...] = field
+                    block[sample, v, ...] = field
                 else:
-                    new_field = _convolve(field, convolution, convolution_step)
-                    predictors[sample_count, v, ...] = new_field
+                    block[sample, v, ...] = _convolve(field, convolution, convolution_step)
+        new_ds.close()
+        yield init, block
 
-    # Transpose the array if using convolutions, so that y,x are the last 2 dims
-    if convolution is not None:
-        predictors = predictors.transpose((0, 1, 2, 3, 6, 4, 5))
+
+def predictors_from_ensemble(ensemble, xlim, ylim, variables=(), latlon=True, forecast_hours=(0, 12, 24),
+                             convolution=None, convolution_step=1, interpolate_factor=1, interpolate_method='nearest',
+                             pickle_file=None, store_directory=None, layout='ensemble', verbose=True):
+    """
+    Generate predictor data from processed (written/loaded) ensemble files, for the ensemble selection model.
+    Data are hourly. Parameter 'forecast_hours' determines which forecast hours for each initialization are included
+    as predictors. The parameters 'convolution' and 'convolution_step' are used to split spatial data into multiple
+    predictor samples. If 'convolution' is not None, then either an integer or a tuple of integers of length 2 should
+    be provided; these integers determine the size of the convolution pass in the spatial directions (x,y). The
+    parameter 'convolution_step' determines the number of grid points to advance forward in space at each convolution.
+
+    :param ensemble: NCARArray or GR2Array object with .open() method called
+    :param variables: tuple of str: names of variables to retrieve from the data (see data docs)
+    :param xlim: tuple: minimum and maximum x-direction grid points (or longitude if latlon == True)
+    :param ylim: tuple: minimum and maximum y-direction grid points (or latitude if latlon == True)
+    :param latlon: bool: if True, assumes xlim and ylim are lon/lat points, and converts to grid points as required
+    :param forecast_hours: iter: iterable of forecast hours to include in the predictors
+    :param convolution: int or tuple: size of the convolution layer in (x,y) directions, or if int, square of specified
+        size. If None, no convolution is performed and the number of samples is the number of initialization dates
+        times the number of ensemble members.
+    :param convolution_step: int: spacing in grid points between convolutions. Ignored if convolution==None.
+    :param interpolate_factor: int: if > 1, coarsen the predictors of each init date as they are generated, with
+        'interpolate_ensemble_predictors', so that the full-resolution array is never held in memory
+    :param interpolate_method: str: method for 'interpolate_ensemble_predictors'
+    :param pickle_file: str: if given, file to write pickled predictor array
+    :param store_directory: str: if given, directory of an ArrayStore (see ensemble_net.array_store) to which to
+        write the predictor array, as 'predictors_from_ensemble'. The array is filled directly in the store and
+        returned as a memory map.
+    :param layout: str: 'ensemble' for an array of (init, variable, member, fhour, [convolution], y, x), or 'samples'
+        for (init, member, [convolution], y, x, variable, fhour), which convert_ensemble_predictors_to_samples
+        reshapes without copying
+    :param verbose: bool: print progress statements
+    :return: ndarray: array of predictors
+    """
+    # Test that data is loaded
+    if ensemble.Dataset is None:
+        raise IOError('no data loaded to ensemble object.')
+
+    # Sanity check for parameters
+    convolution = _check_convolution(convolution, convolution_step)
+    _check_layout(layout)
+    convolved = (convolution is not None)
+    interpolate_factor = int(interpolate_factor)
+    if interpolate_factor < 1:
+        raise ValueError("'interpolate_factor' must be >= 1")
+
+    # Define the large array, with the shape of the samples in the requested layout
+    grand_index_array, bounds, sample_shape = _ensemble_predictor_setup(ensemble, xlim, ylim, variables, latlon,
+                                                                        forecast_hours, convolution, convolution_step,
+                                                                        verbose)
+    num_samples = len(grand_index_array)
+    if convolved:
+        # Transpose the convolution dimension, so that y,x are the last 2 dims
+        ensemble_shape = (num_samples,) + sample_shape[:3] + (sample_shape[5],) + sample_shape[3:5]
+    else:
+        ensemble_shape = (num_samples,) + sample_shape
+    if interpolate_factor > 1:
+        ensemble_shape = ensemble_shape[:-2] + tuple(_interpolated_size(n, interpolate_factor, interpolate_method)
+                                                     for n in ensemble_shape[-2:])
+    layout_axes = _layout_axes(layout, convolved)
+    out_shape = tuple(ensemble_shape[a] for a in layout_axes)
+    if store_directory is not None:
+        predictors = ArrayStore(store_directory, mode='a').create('predictors_from_ensemble', out_shape,
+                                                                  fill_value=np.nan)
+    else:
+        predictors = np.full(out_shape, np.nan, dtype=np.float32)
+
+    # Add the data to the arrays
+    print('predictors_from_ensemble: strap in; this is gonna take a while.')
+    sample_count = 0
+    for init, block in _ensemble_predictor_blocks(ensemble, variables, grand_index_array, bounds, sample_shape,
+                                                  convolution, convolution_step, verbose):
+        if convolved:
+            block = block.transpose((0, 1, 2, 3, 6, 4, 5))
+        if interpolate_factor > 1:
+            block = interpolate_ensemble_predictors(block, interpolate_factor, interpolate_method)
+        predictors[sample_count:sample_count + block.shape[0]] = block.transpose(layout_axes)
+        sample_count += block.shape[0]
 
     # Save as pickle, if requested
     if pickle_file is not None:
@@ -227,18 +395,119 @@ def predictors_from_ensemble(ensemble, xlim, ylim, variables=(), latlon=True, fo
         with open(pickle_file, 'wb') as handle:
             pickle.dump(save_vars, handle, pickle.HIGHEST_PROTOCOL)
 
+    # Flush the array store, if requested
+    if store_directory is not None:
+        predictors.flush()
+
     return predictors
 
 
+def predictors_from_ensemble_to_file(ensemble, file_name, xlim, ylim, variables=(), latlon=True,
+                                     forecast_hours=(0, 12, 24), convolution=None, convolution_step=1,
+                                     interpolate_factor=1, interpolate_method='nearest', file_format='netcdf',
+                                     layout='ensemble', verbose=True):
+    """
+    Out-of-core version of 'predictors_from_ensemble'. Instead of allocating the full predictor array in memory, the
+    predictors for each init date are written to 'file_name' as soon as they are computed, so that peak memory use is
+    bounded by the data for a single init date. The result is opened lazily and returned. Init dates for which no
+    predictors could be generated are left as missing values.
+
+    :param ensemble: NCARArray or GR2Array object with .open() method called
+    :param file_name: str: path of the output file
+    :param xlim: tuple: minimum and maximum x-direction grid points (or longitude if latlon == True)
+    :param ylim: tuple: minimum and maximum y-direction grid points (or latitude if latlon == True)
+    :param variables: tuple of str: names of variables to retrieve from the data (see data docs)
+    :param latlon: bool: if True, assumes xlim and ylim are lon/lat points, and converts to grid points as required
+    :param forecast_hours: iter: iterable of forecast hours to include in the predictors
+    :param convolution: int or tuple: see 'predictors_from_ensemble'
+    :param convolution_step: int: spacing in grid points between convolutions. Ignored if convolution==None.
+    :param interpolate_factor: int: if > 1, coarsen the spatial grid of each init date with
+        'interpolate_ensemble_predictors' before writing
+    :param interpolate_method: str: method for 'interpolate_ensemble_predictors'
+    :param file_format: str: 'netcdf' to write a netCDF4 file with an 'ENS_PRED' variable along an unlimited
+        'init_date' dimension (the layout used by ens_sel_batch_process.py), or 'npy' to write a numpy array file
+    :param layout: str: order of the dimensions of the predictors; see 'predictors_from_ensemble'
+    :param verbose: bool: print progress statements
+    :return: xarray Dataset opened from the netCDF file, or read-only memory-mapped ndarray for 'npy'
+    """
+    # Test that data is loaded
+    if ensemble.Dataset is None:
+        raise IOError('no data loaded to ensemble object.')
+
+    # Sanity check for parameters
+    convolution = _check_convolution(convolution, convolution_step)
+    if file_format not in ['netcdf', 'npy']:
+        raise ValueError("'file_format' must be 'netcdf' or 'npy'")
+    if interpolate_method not in INTERPOLATE_METHODS:
+        raise ValueError("'interpolate_method' must be one of %s" % list(INTERPOLATE_METHODS))
+    _check_layout(layout)
+    convolved = (convolution is not None)
+    layout_axes = _layout_axes(layout, convolved)
+
+    grand_index_array, bounds, sample_shape = _ensemble_predictor_setup(ensemble, xlim, ylim, variables, latlon,
+                                                                        forecast_hours, convolution, convolution_step,
+                                                                        verbose)
+    num_init = len(ensemble.dataset_init_dates)
+
+    ncf = None
+    out_array = None
+    fill_value = np.array(nc.default_fillvals['f4']).astype(np.float32)
+    if file_format == 'netcdf':
+        if verbose:
+            print("predictors_from_ensemble_to_file: creating dataset '%s'" % file_name)
+        ncf = nc.Dataset(file_name, 'w', format='NETCDF4')
+        ncf.createDimension('init_date', 0)
+        nc_time = ncf.createVariable('init_date', np.float64, ('init_date',))
+        nc_time[:] = nc.date2num(ensemble.dataset_init_dates, 'hours since 1970-01-01 00:00')
+
+    try:
+        for init, block in _ensemble_predictor_blocks(ensemble, variables, grand_index_array, bounds, sample_shape,
+                                                      convolution, convolution_step, verbose):
+            if convolved:
+                block = block.transpose((0, 1, 2, 3, 6, 4, 5))
+            if interpolate_factor > 1:
+                block = interpolate_ensemble_predictors(block, interpolate_factor, interpolate_method)
+            block = block.transpose(layout_axes)[0]  # one sample per init date
+            if file_format == 'netcdf':
+                if 'ENS_PRED' not in ncf.variables:
+                    dims = _ensemble_layout_dims(layout, convolved)
+                    for dim, size in zip(dims[1:], block.shape):
+                        ncf.createDimension(dim, size)
+                    nc_var = ncf.createVariable('ENS_PRED', np.float32, dims, fill_value=fill_value, zlib=True)
+                    nc_var.setncatts({
+                        'long_name': 'Predictors from ensemble',
+                        'units': 'N/A'
+                    })
+                ncf.variables['ENS_PRED'][init, ...] = block
+                ncf.sync()
+            else:
+                if out_array is None:
+                    out_array = np.lib.format.open_memmap(file_name, mode='w+', dtype=np.float32,
+                                                          shape=(num_init,) + block.shape)
+                    out_array[:] = np.nan
+                out_array[init] = block
+                out_array.flush()
+    finally:
+        if ncf is not None:
+            ncf.close()
+        out_array = None
+
+    if file_format == 'netcdf':
+        return xr.open_dataset(file_name, mask_and_scale=True)
+    else:
+        return np.load(file_name, mmap_mode='r')
+
+
 def predictors_from_ae_meso(ae_ds, ensemble, xlim, ylim, variables=(), forecast_hours=(0, 12, 24), sort_stations=True,
                             missing_tolerance=0.05, convolution=None, convolution_step=1, convolution_agg='mse',
-                            pickle_file=None, return_stations=False, verbose=True):
+                            pickle_file=None, store_directory=None, return_stations=False, verbose=True):
     """
     Compiles predictors from the error Dataset created by ensemble_net.verify.ae_mesowest(). See the docstring for
     'predictors_from_ensemble' for how the convolution works. If a convolution is requested in this function, then the
     available stations in the ae_mesowest dataset are combined into one metric at each convolution area.
 
-    :param ae_ds: xarray Dataset: result from ensemble_net.verify.ae_meso() for the ensemble
+    :param ae_ds: xarray Dataset: result from ensemble_net.verify.ae_meso() for the ensemble, in either the
+        per-station or the dense station layout (see ensemble_net.verify.util.ae_meso_to_dense)
     :param ensemble: NCARArray object with .open() method called
     :param xlim: tuple or list: longitude boundary limits
     :param ylim: tuple or list: latitude boundary limits
@@ -255,57 +524,19 @@ def predictors_from_ae_meso(ae_ds, ensemble, xlim, ylim, variables=(), forecast_
         'mse': mean square error
         'rmse': root-mean-square-error
     :param pickle_file: str: if given, file to write pickled predictor array
+    :param store_directory: str: if given, directory of an ArrayStore (see ensemble_net.array_store) to which to
+        write the predictor array, as 'predictors_from_ae_meso'
     :param return_stations: bool: if True, also returns the list of stations corresponding to the station dimension.
         Ignored if 'convolution' is not None.
     :param verbose: bool: print progress statements
     :return: ndarray: array of predictors (list: list of stations)
     """
-    def get_count(ds):
-        station_list = list(ds.data_vars.keys())
-        n_s = len(station_list)
-        count = 0
-        for s in range(n_s):
-            count = max(count, ds[station_list[s]].size)
-        return count
-
-    def trim_stations(ds, num):
-        for s in ds.data_vars.keys():
-            if np.sum(~np.isnan(ds[s].values)) < num:
-                ds = ds.drop(s)
-        return ds
-
-    def find_stations(d, xl, yl):
-        result = []
-        for s, ll in d.items():
-            if (yl[1] >= ll[0] >= yl[0]) and (xl[1] >= ll[1] >= xl[0]):
-                result.append(s)
-        return result
-
-    def find_stations_in_array(d, ys, xs, tol=1.0):
-        result = []
-        for s, ll in d.items():
-            distance = (ys - ll[0]) ** 2 + (xs - ll[1]) ** 2
-            if np.min(distance) < tol:
-                result.append(s)
-        return result
-
     # Test that data is loaded
     if ensemble.Dataset is None:
         raise IOError('no data loaded to NCARArray object.')
 
     # Sanity check for parameters
-    if convolution_step < 1:
-        raise ValueError("'convolution_step' should be at least 1")
-    if convolution is not None:
-        if type(convolution) is int:
-            convolution = (convolution, convolution)
-        elif type(convolution) is not tuple:
-            try:
-                convolution = tuple(convolution)
-            except:
-                raise TypeError("'convolution' must be None, an integer, or a length-2 tuple of integers")
-        if len(convolution) != 2:
-            raise ValueError("'convolution' must be None, an integer, or a length-2 tuple of integers")
+    convolution = _check_convolution(convolution, convolution_step)
     if convolution_agg not in ['mae', 'mse', 'rmse']:
         raise ValueError("'convolution_agg' must be 'mae', 'mse', or 'rmse'")
 
@@ -325,12 +556,11 @@ def predictors_from_ae_meso(ae_ds, ensemble, xlim, ylim, variables=(), forecast_
     lon = ensemble.lon[y1:y2, x1:x2]
     dummy = np.ones_like(lat)
 
-    # Get the lat/lon and reduce the stations
-    count_non_missing = (1 - missing_tolerance) * get_count(ae_ds)
-    ae_ds = trim_stations(ae_ds, count_non_missing)
-    stations_dict = OrderedDict()
-    for station in ae_ds.data_vars.keys():
-        stations_dict[station] = (ae_ds[station].attrs['LATITUDE'], ae_ds[station].attrs['LONGITUDE'])
+    # Use the dense station layout and reduce the stations
+    if not is_dense_ae_meso(ae_ds):
+        ae_ds = ae_meso_to_dense(ae_ds)
+    ae_ds = trim_ae_meso(ae_ds, missing_tolerance)
+    error = ae_ds['error']
 
     # Get the indexes of all training samples
     num_init = ae_ds.dims['time']
@@ -357,16 +587,32 @@ def predictors_from_ae_meso(ae_ds, ensemble, xlim, ylim, variables=(), forecast_
     num_samples = len(grand_index_list)
     num_members = ae_ds.dims['member']
     num_f_hours = len(forecast_hours)
+    init_index = [ind[0] for ind in grand_index_list]
+    f_index = grand_index_list[0][1] if num_samples > 0 else []
+    v_index = [list(ae_ds['variable'].values).index(variable) for variable in variables]
     if convolution is None:
         # Subset stations by the ones within the lat/lon arrays
         if type(ensemble) is NCARArray:
-            stations = find_stations_in_array(stations_dict, lat, lon - 360., tol=0.05)
+            tol = 0.05
         else:
-            stations = find_stations_in_array(stations_dict, lat, lon - 360.)
+            tol = 1.0
+        grid_tree = cKDTree(np.vstack((lat.flatten(), lon.flatten() - 360.)).T)
+        distance, nearest = grid_tree.query(np.vstack((ae_ds['station_lat'].values, ae_ds['station_lon'].values)).T)
+        station_index = np.where(distance ** 2 < tol)[0]
         if sort_stations:
-            stations.sort()
+            station_index = station_index[np.argsort(ae_ds['station'].values[station_index], kind='mergesort')]
+        stations = list(ae_ds['station'].values[station_index])
         num_stations = len(stations)
-        predictors = np.full((num_samples, num_var, num_members, num_f_hours, num_stations), np.nan, dtype=np.float32)
+
+        # Select all samples, variables and stations at once: (sample, var, member, fhour, station)
+        if verbose:
+            print('predictors_from_ae_meso: selecting %d samples at %d stations' % (num_samples, num_stations))
+        if num_samples > 0:
+            predictors = error.isel(station=station_index, time=init_index, fhour=f_index, variable=v_index)\
+                .transpose('time', 'variable', 'member', 'fhour', 'station').values.astype(np.float32)
+        else:
+            predictors = np.full((num_samples, num_var, num_members, num_f_hours, num_stations), np.nan,
+                                 dtype=np.float32)
     else:
         start_point_y = (convolution[1] + 1) // 2 - 1
         start_point_x = (convolution[0] + 1) // 2 - 1
@@ -375,41 +621,24 @@ def predictors_from_ae_meso(ae_ds, ensemble, xlim, ylim, variables=(), forecast_
         num_conv = num_conv_y * num_conv_x
         predictors = np.full((num_samples, num_var, num_members, num_f_hours, num_conv), np.nan, dtype=np.float32)
 
-    # Add the data to the array
-    for v in range(num_var):
-        variable = variables[v]
-        v_ind = list(ae_ds['variable'].values).index(variable)
-        for sample in range(num_samples):
+        # Find the stations within each convolution window once, as a sparse (window x station) matrix
+        if verbose:
+            print('predictors_from_ae_meso: indexing stations in convolution windows')
+        d, lats, lons = _convolve_latlon(dummy, convolution, convolution_step, lat, lon)
+        lons -= 360.  # longitude in ºW
+        window_matrix = _window_station_matrix(lats, lons, ae_ds['station_lat'].values, ae_ds['station_lon'].values)
+        num_all_stations = ae_ds.dims['station']
+        for v in range(num_var):
             if verbose:
-                print('predictors_from_ae_meso: variable %d of %d, sample %d of %d' % (v+1, num_var, sample+1,
-                                                                                       num_samples))
-            ind = grand_index_list[sample]
-            if convolution is None:
-                fields = []
-                for station in stations:
-                    field = ae_ds[station].isel(time=ind[0], fhour=ind[1], variable=v_ind).values
-                    fields.append(field)
-                predictors[sample, v, ...] = np.array(fields).transpose((1, 2, 0))
-            else:
-                d, lats, lons = _convolve_latlon(dummy, convolution, convolution_step, lat, lon)
-                for c in range(num_conv):
-                    if verbose:
-                        if c == num_conv // 4:
-                            print('    25% of convolutions done')
-                        elif c == num_conv // 2:
-                            print('    50% of convolutions done')
-                        elif c == 3 * (num_conv // 4):
-                            print('    75% of convolutions done')
-                    la, lo = lats[c], lons[c]
-                    lo -= 360.  # longitude in ºW
-                    stations = find_stations(stations_dict, lo, la)
-                    fields = []
-                    for station in stations:
-                        field = ae_ds[station].isel(time=ind[0], fhour=ind[1], variable=v_ind).values
-                        fields.append(field)
-                    fields = np.array(fields)
-                    new_field = _conv_agg(fields, convolution_agg, axis=0)
-                    predictors[sample, v, :, :, c] = new_field
+                print('predictors_from_ae_meso: variable %d of %d' % (v+1, num_var))
+            if num_samples == 0:
+                continue
+            # Array of (station, sample, member, fhour)
+            fields = error.isel(time=init_index, fhour=f_index, variable=v_index[v])\
+                .transpose('station', 'time', 'member', 'fhour').values
+            new_field = _sparse_conv_agg(window_matrix, fields.reshape((num_all_stations, -1)), convolution_agg)
+            predictors[:, v, ...] = new_field.reshape((num_conv, num_samples, num_members, num_f_hours))\
+                .transpose((1, 2, 3, 0))
 
     # Save as pickle, if requested
     if pickle_file is not None:
@@ -419,6 +648,10 @@ def predictors_from_ae_meso(ae_ds, ensemble, xlim, ylim, variables=(), forecast_
         with open(pickle_file, 'wb') as handle:
             pickle.dump(save_vars, handle, pickle.HIGHEST_PROTOCOL)
 
+    # Save to an array store, if requested
+    if store_directory is not None:
+        ArrayStore(store_directory, mode='a').write('predictors_from_ae_meso', predictors)
+
     if return_stations and convolution is None:
         return predictors, stations
     else:
@@ -442,7 +675,98 @@ def predictors_from_fss(fss, forecast_hours=(0, 12, 24), pickle_file=None, verbo
     return fss['FSS'].values.transpose((0, 2, 1))
 
 
-def convert_ensemble_predictors_to_samples(predictors, convolved=False, split_members=False):
+def _sample_axes(ndim, source, convolved, split_members, layout='ensemble'):
+    # Axes of a predictor array of the given source which make up the samples and the features, in sample order
+    if source == 'ensemble' and layout == 'samples':
+        if convolved:
+            return ((0, 2), (3, 4, 5, 6, 1)) if split_members else ((0, 1, 2), (3, 4, 5, 6))
+        return ((0,), (2, 3, 4, 5, 1)) if split_members else ((0, 1), (2, 3, 4, 5))
+    elif source == 'ensemble':
+        if convolved:
+            return ((0, 4), (5, 6, 1, 3, 2)) if split_members else ((0, 2, 4), (5, 6, 1, 3))
+        return ((0,), (4, 5, 1, 3, 2)) if split_members else ((0, 2), (4, 5, 1, 3))
+    elif source == 'ae_meso':
+        if convolved:
+            return ((0, 4), (1, 2, 3)) if split_members else ((0, 2, 4), (1, 3))
+        return ((0,), (4, 1, 2, 3)) if split_members else ((0, 2), (4, 1, 3))
+    elif source == 'fss':
+        return ((0,), tuple(range(1, ndim))) if split_members else ((0, 1), tuple(range(2, ndim)))
+    raise ValueError("'source' must be 'ensemble', 'ae_meso', or 'fss'")
+
+
+def _samples_from_layout(predictors, sample_axes, feature_axes, mask=None):
+    # Samples-by-features array with features in the order of feature_axes, keeping only the samples in mask
+    num_samples = int(np.prod([predictors.shape[a] for a in sample_axes]))
+    feature_shape = tuple(predictors.shape[a] for a in feature_axes)
+    predictors = predictors.transpose(tuple(sample_axes) + tuple(feature_axes))
+    if mask is None:
+        return predictors.reshape((num_samples,) + feature_shape)
+    mask = np.asarray(mask, dtype=bool)
+    if mask.size != num_samples:
+        raise ValueError("'mask' must have one element for each of the %d samples" % num_samples)
+    index = np.nonzero(mask.reshape(predictors.shape[:len(sample_axes)]))
+    return predictors[index]
+
+
+def sample_missing_counts(predictors, source='ensemble', convolved=False, split_members=False, chunk_size=None,
+                          layout='ensemble'):
+    """
+    Count the missing values (NaN or fill values larger than 1e30) of each sample of a predictor array, in the order
+    of the samples produced by the convert_*_predictors_to_samples functions, without converting the array. Use with
+    valid_sample_mask to convert only the samples which will be kept.
+
+    :param predictors: ndarray: array of predictors from predictors_from_ensemble, predictors_from_ae_meso, or
+        predictors_from_fss
+    :param source: str: the function which produced the array: 'ensemble', 'ae_meso', or 'fss'
+    :param convolved: bool: if True, the predictors were generated with convolution != None
+    :param split_members: bool: as in the convert_*_predictors_to_samples functions
+    :param chunk_size: int: number of init dates counted at a time (default: about 64 MB of data at a time)
+    :param layout: str: layout of ensemble predictors, 'ensemble' or 'samples' (see predictors_from_ensemble)
+    :return: ndarray: number of missing values of each sample; int: number of values of each sample
+    """
+    sample_axes, feature_axes = _sample_axes(predictors.ndim, source, convolved, split_members, layout)
+    sample_shape = tuple(predictors.shape[a] for a in sample_axes)
+    counts = np.zeros(sample_shape, dtype=np.int64)
+    if chunk_size is None:
+        init_size = max(int(np.prod(predictors.shape[1:])) * predictors.dtype.itemsize, 1)
+        chunk_size = max(1, (64 << 20) // init_size)
+    # The sample axes are in increasing order and start with the init date axis
+    for start in range(0, predictors.shape[0], chunk_size):
+        block = predictors[start:start + chunk_size]
+        counts[start:start + chunk_size] = np.sum(~(np.abs(block) <= 1.e30), axis=feature_axes)
+    num_features = int(np.prod([predictors.shape[a] for a in feature_axes]))
+    return counts.reshape(-1), num_features
+
+
+def valid_sample_mask(predictors=(), targets=(), threshold=None):
+    """
+    Compute a mask of the samples which delete_nan_samples would keep, from the missing-value counts of the source
+    arrays of the predictors and the targets.
+
+    :param predictors: iter: (counts, number of values) results of sample_missing_counts for each predictor array
+    :param targets: iter: (counts, number of values) results of sample_missing_counts for each target array
+    :param threshold: float 0-1: if not None, removes samples with a fraction of missing predictors or targets of at
+        least this; otherwise removes samples with any missing value
+    :return: ndarray: boolean mask of the samples to keep
+    """
+    if threshold is not None and not (0 <= threshold <= 1):
+        raise ValueError("'threshold' must be between 0 and 1")
+    keep = None
+    for arrays in (predictors, targets):
+        arrays = list(arrays)
+        if len(arrays) == 0:
+            continue
+        count = np.sum([c for c, n in arrays], axis=0)
+        size = sum(n for c, n in arrays)
+        bad = count > 0 if threshold is None else count >= threshold * size
+        keep = ~bad if keep is None else keep & ~bad
+    if keep is None:
+        raise ValueError("one of 'predictors' or 'targets' must be given")
+    return keep
+
+
+def convert_ensemble_predictors_to_samples(predictors, convolved=False, split_members=False, mask=None,
+                                           layout='ensemble'):
     """
     Convert an array from predictors_from_ensemble into a samples-by-features array.
 
@@ -450,42 +774,31 @@ def convert_ensemble_predictors_to_samples(predictors, convolved=False, split_me
     :param convolved: bool: if True, the predictors were generated with convolution != None.
     :param split_members: bool: if False, converts the members dimension to another image "channel", like variables.
         Individual ensemble member can be extracted back by using extract_members_from_samples.
+    :param mask: ndarray: if given, boolean mask of the samples to return (see valid_sample_mask); only these
+        samples are transposed and copied
+    :param layout: str: layout of the predictors, 'ensemble' or 'samples' (see predictors_from_ensemble). Unless
+        split_members is True, predictors in the 'samples' layout are returned as a view, without copying.
     :return: ndarray: array of reshaped predictors; tuple: shape of feature input, for future reshaping
     """
-    shape = predictors.shape
-    if convolved:
-        spatial_shape = shape[5:]
-        if split_members:
-            input_shape = spatial_shape + shape[1:4]
-            num_samples = shape[0]*shape[4]
-            num_channels = shape[1]*shape[2]*shape[3]
-            predictors = predictors.transpose((0, 4, 5, 6, 1, 3, 2))
-            predictors = predictors.reshape((num_samples,) + spatial_shape + (num_channels,))
-        else:
-            input_shape = spatial_shape + (shape[1],) + (shape[3],)
-            num_samples = shape[0]*shape[4]*shape[2]
-            num_channels = shape[1]*shape[3]
-            predictors = predictors.transpose((0, 2, 4, 5, 6, 1, 3))
-            predictors = predictors.reshape((num_samples,) + spatial_shape + (num_channels,))
+    _check_layout(layout)
+    sample_axes, feature_axes = _sample_axes(predictors.ndim, 'ensemble', convolved, split_members, layout)
+    # Shape of the predictors in the 'ensemble' layout
+    layout_axes = _layout_axes(layout, convolved)
+    shape = tuple(predictors.shape[layout_axes.index(a)] for a in range(predictors.ndim))
+    spatial_shape = shape[5:] if convolved else shape[4:]
+    if split_members:
+        input_shape = spatial_shape + shape[1:4]
+        num_channels = shape[1]*shape[2]*shape[3]
     else:
-        spatial_shape = shape[4:]
-        if split_members:
-            input_shape = spatial_shape + shape[1:4]
-            num_samples = shape[0]
-            num_channels = shape[1]*shape[2]*shape[3]
-            predictors = predictors.transpose((0, 4, 5, 1, 3, 2))
-            predictors = predictors.reshape((num_samples,) + spatial_shape + (num_channels,))
-        else:
-            input_shape = spatial_shape + (shape[1],) + (shape[3],)
-            num_samples = shape[0]*shape[2]
-            num_channels = shape[1]*shape[3]
-            predictors = predictors.transpose((0, 2, 4, 5, 1, 3))
-            predictors = predictors.reshape((num_samples,) + spatial_shape + (num_channels,))
+        input_shape = spatial_shape + (shape[1],) + (shape[3],)
+        num_channels = shape[1]*shape[3]
+    predictors = _samples_from_layout(predictors, sample_axes, feature_axes, mask)
+    predictors = predictors.reshape((predictors.shape[0],) + spatial_shape + (num_channels,))
 
     return predictors, input_shape
 
 
-def convert_ae_meso_predictors_to_samples(predictors, convolved=False, agg=None, split_members=False):
+def convert_ae_meso_predictors_to_samples(predictors, convolved=False, agg=None, split_members=False, mask=None):
     """
     Convert an array from predictors_from_ensemble into a samples-by-features array.
 
@@ -494,91 +807,124 @@ def convert_ae_meso_predictors_to_samples(predictors, convolved=False, agg=None,
     :param agg: None or str: if not None, converts all stations to an aggregated single error metric, 'mae', 'mse', or
         'rmse'. Ignored if convolved == True.
     :param split_members: bool: if True, converts the members dimension to another image "channel", like variables
+    :param mask: ndarray: if given, boolean mask of the samples to return (see valid_sample_mask); only these
+        samples are transposed and copied
     :return: ndarray: array of reshaped predictors; tuple: shape of feature input, for future reshaping
     """
     shape = predictors.shape
     if agg is not None and convolved:
         print("convert_ae_meso_predictors_to_samples: warning: ignoring parameter 'agg'")
+    sample_axes, feature_axes = _sample_axes(len(shape), 'ae_meso', convolved, split_members)
     if convolved:
         if split_members:
             input_shape = shape[1:4]
-            num_samples = shape[0]*shape[4]
-            num_features = shape[1]*shape[2]*shape[3]
-            predictors = predictors.transpose((0, 4, 1, 2, 3))
-            predictors = predictors.reshape((num_samples,) + (num_features,))
         else:
             input_shape = (shape[1],) + (shape[3],)
-            num_samples = shape[0]*shape[4]*shape[2]
-            num_features = shape[1]*shape[3]
-            predictors = predictors.transpose((0, 2, 4, 1, 3))
-            predictors = predictors.reshape((num_samples,) + (num_features,))
     else:
         if split_members:
             input_shape = (shape[4],) + shape[1:4]
-            num_samples = shape[0]
-            num_features = shape[1]*shape[2]*shape[3]*shape[4]
-            predictors = predictors.transpose((0, 4, 1, 2, 3))
-            if agg is not None:
-                num_features //= shape[4]
-                predictors = _conv_agg(predictors, agg, axis=1)
-                input_shape = input_shape[1:]
-            predictors = predictors.reshape((num_samples,) + (num_features,))
         else:
             input_shape = (shape[4],) + (shape[1],) + (shape[3],)
-            num_samples = shape[0]*shape[2]
-            num_features = shape[1]*shape[3]*shape[4]
-            predictors = predictors.transpose((0, 2, 4, 1, 3))
-            if agg is not None:
-                num_features //= shape[4]
-                predictors = _conv_agg(predictors, agg, axis=2)
-                input_shape = input_shape[1:]
-            predictors = predictors.reshape((num_samples,) + (num_features,))
+    predictors = _samples_from_layout(predictors, sample_axes, feature_axes, mask)
+    if agg is not None and not convolved:
+        # The station dimension follows the sample dimension
+        predictors = _conv_agg(predictors, agg, axis=1)
+        input_shape = input_shape[1:]
+    predictors = predictors.reshape((predictors.shape[0], int(np.prod(predictors.shape[1:]))))
 
     return predictors, input_shape
 
 
-def convert_fss_predictors_to_samples(predictors, split_members=False):
+def convert_fss_predictors_to_samples(predictors, split_members=False, mask=None):
     """
     Convert an array from predictors_from_fss into a samples-by-features array. Does not support convolution.
 
     :param predictors: ndarray: array of predictors
     :param split_members: bool: if True, converts the members dimension to another image "channel", like variables
+    :param mask: ndarray: if given, boolean mask of the samples to return (see valid_sample_mask)
     :return: ndarray: array of reshaped predictors; tuple: shape of feature input, for future reshaping
     """
     shape = predictors.shape
+    sample_axes, feature_axes = _sample_axes(len(shape), 'fss', False, split_members)
     if split_members:
         input_shape = (shape[1],)
-        num_samples = shape[0]
-        num_features = shape[1]*shape[2]
-        predictors = predictors.reshape((num_samples,) + (num_features,))
     else:
         input_shape = ()
-        num_samples = shape[0]*shape[1]
-        num_features = shape[2]
-        predictors = predictors.reshape((num_samples,) + (num_features,))
+    predictors = _samples_from_layout(predictors, sample_axes, feature_axes, mask)
+    predictors = predictors.reshape((predictors.shape[0], int(np.prod(predictors.shape[1:]))))
 
     return predictors, input_shape
 
 
-def interpolate_ensemble_predictors(predictors, factor, **griddata_kwargs):
+INTERPOLATE_METHODS = ('nearest', 'mean', 'max', 'bilinear')
+
+
+def _interpolated_size(n, factor, method):
+    # Length of a spatial dimension of length n after interpolate_ensemble_predictors
+    if method not in INTERPOLATE_METHODS:
+        raise ValueError("'method' must be one of %s" % list(INTERPOLATE_METHODS))
+    if method == 'nearest':
+        return len(range(factor // 2, n - 1, factor))
+    return -(-n // factor)
+
+
+def _coarsen_axis(predictors, factor, axis, method):
+    # Coarsen one axis in blocks of 'factor' points; the last block may be smaller
+    n = predictors.shape[axis]
+    starts = np.arange(0, n, factor)
+    ends = np.minimum(starts + factor, n)
+    shape = [1] * predictors.ndim
+    shape[axis] = len(starts)
+    if method == 'mean':
+        sums = np.add.reduceat(predictors, starts, axis=axis)
+        return sums / (ends - starts).reshape(shape).astype(sums.dtype)
+    elif method == 'max':
+        return np.maximum.reduceat(predictors, starts, axis=axis)
+    # Bilinear: linear interpolation to the center of each block
+    centers = 0.5 * (starts + ends - 1)
+    lower = np.floor(centers).astype(int)
+    upper = np.minimum(lower + 1, n - 1)
+    weight = (centers - lower).reshape(shape).astype(predictors.dtype)
+    return np.take(predictors, lower, axis=axis) * (1 - weight) + np.take(predictors, upper, axis=axis) * weight
+
+
+def interpolate_ensemble_predictors(predictors, factor, method='nearest'):
     """
     Reduces the dimensionality of the ensemble predictors by interpolating to a grid that is 'factor' times coarser
-    than the current spatial dimension for the ensemble samples.
+    than the current spatial dimension for the ensemble samples. The spatial dimensions are the last two dimensions,
+    (..., y, x), with any number of leading dimensions. Methods:
+        'nearest': every factor-th point, starting at factor // 2 (the original behavior; the last row and column are
+            never used)
+        'mean': mean over blocks of factor x factor points
+        'max': maximum over blocks of factor x factor points
+        'bilinear': bilinear interpolation to the center of each block of factor x factor points
+    With 'mean', 'max', and 'bilinear', a spatial dimension of length n becomes ceil(n / factor); the last blocks are
+    smaller if n is not a multiple of factor, and a factor of 1 returns the predictors unchanged. With 'mean' and 'max',
+    missing values (NaN) propagate to the blocks which contain them; 'bilinear' propagates only those at the grid
+    points it interpolates between, around each block center.
 
     :param predictors: ndarray: predictors from predictors_from_ensemble
     :param factor: int: factor for grid coarsening
-    :param griddata_kwargs: passed to scipy.interpolate.griddata
+    :param method: str: 'nearest', 'mean', 'max', or 'bilinear'
     :return: ndarray: dimensionality-reduced array of predictors
     """
-    # For now, let's just return the 'nearest' solution
     factor = int(factor)
     if factor < 1:
         raise ValueError("'factor' must be >= 1")
-    start = factor // 2
-    slices = [slice(None)] * len(predictors.shape)
-    slices[-2] = slice(start, -1, factor)
-    slices[-1] = slice(start, -1, factor)
-    return predictors[tuple(slices)]
+    if method not in INTERPOLATE_METHODS:
+        raise ValueError("'method' must be one of %s" % list(INTERPOLATE_METHODS))
+    if predictors.ndim < 2:
+        raise ValueError('predictors array must be at least 2 dimensions')
+    if method == 'nearest':
+        start = factor // 2
+        slices = [slice(None)] * len(predictors.shape)
+        slices[-2] = slice(start, -1, factor)
+        slices[-1] = slice(start, -1, factor)
+        return predictors[tuple(slices)]
+    if factor == 1:
+        return predictors
+    predictors = _coarsen_axis(predictors, factor, predictors.ndim - 2, method)
+    return _coarsen_axis(predictors, factor, predictors.ndim - 1, method)
 
 
 def extract_members_from_samples(predictors, num_members):
@@ -603,15 +949,16 @@ def extract_members_from_samples(predictors, num_members):
     return predictors.transpose(t_shape)
 
 
-def combine_predictors(*arrays, do_reshape=True):
+def combine_predictors(*arrays, do_reshape=True, mask=None):
     """
     Combines predictors from *_to_samples methods into a single samples-by-features array. For now, does not enable
     retention of spatial information for convolutional neural networks. Each input array must have the same sample
-    (axis 0) dimension.
+    (axis 0) dimension. The arrays are copied once, into a preallocated array.
 
     :param arrays: arrays with the same first dimension to combine
     :param do_reshape: bool: if True, forces reshape to 2-dimensional arrays. Otherwise, results in an error if
         concatenation along the last axis does not work.
+    :param mask: ndarray: if given, boolean mask of the samples to keep in the combined array
     :return: ndarray: samples by features combined array
     """
     new_arrays = []
@@ -621,52 +968,345 @@ def combine_predictors(*arrays, do_reshape=True):
         if len(array.shape) < 2:
             raise ValueError("input arrays must have at least 2 dimensions")
         if len(array.shape) > 2 and do_reshape:
-            new_arrays.append(array.reshape((array.shape[0], -1)))
+            new_arrays.append(array.reshape((array.shape[0], int(np.prod(array.shape[1:])))))
         else:
             new_arrays.append(array)
     if not new_arrays:
         return
-    return np.concatenate(new_arrays, axis=-1)
-
-
-def format_select_predictors(forecast, ae_meso, radar=None, convolved=False, num_members=10):
+    for array in new_arrays[1:]:
+        if array.shape[0] != new_arrays[0].shape[0] or array.shape[1:-1] != new_arrays[0].shape[1:-1]:
+            raise ValueError("input arrays must have the same shape except in the last dimension")
+    if mask is not None:
+        mask = np.asarray(mask, dtype=bool)
+        if mask.size != new_arrays[0].shape[0]:
+            raise ValueError("'mask' must have one element for each sample")
+        index = np.nonzero(mask)[0]
+    num_samples = new_arrays[0].shape[0] if mask is None else len(index)
+    num_features = sum(array.shape[-1] for array in new_arrays)
+    combined = np.empty((num_samples,) + new_arrays[0].shape[1:-1] + (num_features,),
+                        dtype=np.result_type(*new_arrays))
+    start = 0
+    for array in new_arrays:
+        end = start + array.shape[-1]
+        combined[..., start:end] = array if mask is None else array[index]
+        start = end
+    return combined
+
+
+def split_model_inputs(predictors, conv_shape):
+    """
+    Split a samples-by-features array of combined predictors, with the spatial (ENS_PRED) features first, into the
+    inputs of a multi-input model (see EnsembleSelector.build_multi_input_model): a 4-dimensional array of samples
+    by conv_shape, and a 2-dimensional array of the remaining features. Both are views of the predictors array, which
+    is not copied.
+
+    :param predictors: ndarray: samples by features array, e.g. from combine_predictors
+    :param conv_shape: tuple: shape of the spatial features of one sample, e.g. (y, x, channels)
+    :return: list: [spatial, extra] arrays
+    """
+    conv_shape = tuple(conv_shape)
+    num_conv_features = int(np.prod(conv_shape))
+    if predictors.ndim != 2:
+        raise ValueError("'predictors' must be a 2-dimensional samples by features array")
+    if predictors.shape[1] < num_conv_features:
+        raise ValueError("'predictors' has %d features, fewer than the %d of 'conv_shape' %s" %
+                         (predictors.shape[1], num_conv_features, conv_shape))
+    spatial = predictors[:, :num_conv_features].reshape((predictors.shape[0],) + conv_shape)
+    return [spatial, predictors[:, num_conv_features:]]
+
+
+def convert_predictors_to_member_samples(predictors, source='ensemble', convolved=False, layout='ensemble'):
+    """
+    Convert an array of predictors into an array of (member, init date, [convolution,] features), with one transpose
+    and copy. The features are in the same order as in the samples of the convert_*_predictors_to_samples functions
+    without split_members, i.e., as used to train the EnsembleSelector.
+
+    :param predictors: ndarray: array of predictors from predictors_from_ensemble ('ensemble') or of ae_meso errors
+        ('ae_meso'), including radar errors
+    :param source: str: 'ensemble' or 'ae_meso'
+    :param convolved: bool: if True, the predictors were generated with convolution != None
+    :param layout: str: layout of ensemble predictors, 'ensemble' or 'samples' (see predictors_from_ensemble)
+    :return: ndarray: array of predictors with the ensemble member as the first dimension
+    """
+    if source not in ['ensemble', 'ae_meso']:
+        raise ValueError("'source' must be 'ensemble' or 'ae_meso'")
+    sample_axes, feature_axes = _sample_axes(predictors.ndim, source, convolved, False, layout)
+    # Samples are (init, member, [convolution]); put the member first
+    sample_axes = (sample_axes[1], sample_axes[0]) + tuple(sample_axes[2:])
+    sample_shape = tuple(predictors.shape[a] for a in sample_axes)
+    num_features = int(np.prod([predictors.shape[a] for a in feature_axes]))
+    return predictors.transpose(sample_axes + tuple(feature_axes)).reshape(sample_shape + (num_features,))
+
+
+def format_select_predictors(forecast, ae_meso=None, radar=None, convolved=False, num_members=None, layout='ensemble',
+                             split_dates=False):
     """
     Formats a combination of ensemble forecast, error from ae_meso, and radar image/error predictors into an array
     shape suitable for input into the EnsembleSelector's 'select' method. Other than features, the arrays should have
-    matching dimensions.
+    the same dimensions (init dates, members, and convolutions), and may contain any number of init dates.
 
-    :param forecast: ndarray: array of ensemble forecast predictors
-    :param ae_meso: ndarray: array of ae_meso predictors
+    :param forecast: ndarray: array of forecast predictors
+    :param ae_meso: ndarray: array of ae_meso predictors, or None to use only the forecast predictors
     :param radar: ndarray: array of radar predictors
     :param convolved: bool: whether the predictors were generated with convolution
-    :param num_members: int: number of ensemble members for the selection
+    :param num_members: int: if given, number of ensemble members expected in the arrays
+    :param layout: str: layout of the forecast predictors, 'ensemble' or 'samples' (see predictors_from_ensemble)
+    :param split_dates: bool: if True, keep the init date dimension, so that the predictors are of shape (member,
+        date, [convolution,] features), to select for each date with 'select(..., axis=0, date_axis=1)'. Otherwise,
+        the shape is (member, sample, features), where the samples are the init dates and convolutions.
     :return: ndarray, tuple: formatted predictors, shape for 'ensemble_shape' parameter of 'select' method
     """
-    sel_fcst_predictors, spi = convert_ensemble_predictors_to_samples(forecast, convolved=convolved, split_members=True)
-    sel_ae_predictors, spi = convert_ae_meso_predictors_to_samples(ae_meso, convolved=convolved, split_members=True)
-    if radar is not None:
-        sel_rad_predictors, spi = convert_ae_meso_predictors_to_samples(radar, convolved=convolved, split_members=True)
-    sel_fcst_predictors = extract_members_from_samples(sel_fcst_predictors, num_members)
-    sel_ae_predictors = extract_members_from_samples(sel_ae_predictors, num_members)
-    if radar is not None:
-        sel_rad_predictors = extract_members_from_samples(sel_rad_predictors, num_members)
-    sel_fcst_predictors = sel_fcst_predictors.reshape(sel_fcst_predictors.shape[:2] + (-1,))
-    sel_ae_predictors = sel_ae_predictors.reshape(sel_ae_predictors.shape[:2] + (-1,))
-    if radar is not None:
-        sel_rad_predictors = sel_rad_predictors.reshape(sel_rad_predictors.shape[:2] + (-1,))
-        sel_combined_predictors = combine_predictors(sel_fcst_predictors, sel_ae_predictors, sel_rad_predictors,
-                                                     do_reshape=False)
+    arrays = [convert_predictors_to_member_samples(forecast, 'ensemble', convolved, layout)]
+    for array in [ae_meso, radar]:
+        if array is not None:
+            arrays.append(convert_predictors_to_member_samples(array, 'ae_meso', convolved))
+    if num_members is not None and arrays[0].shape[0] != num_members:
+        raise ValueError("predictors have %d ensemble members; 'num_members' is %d" % (arrays[0].shape[0],
+                                                                                       num_members))
+    if len(arrays) > 1:
+        sel_combined_predictors = combine_predictors(*arrays, do_reshape=False)
     else:
-        sel_combined_predictors = combine_predictors(sel_fcst_predictors, sel_ae_predictors, do_reshape=False)
+        sel_combined_predictors = arrays[0]
+    if not split_dates:
+        sel_combined_predictors = sel_combined_predictors.reshape((sel_combined_predictors.shape[0], -1,
+                                                                   sel_combined_predictors.shape[-1]))
     # TODO: will have to deal with NaN more elegantly in the future. Probably a "mask" array.
-    # sel_combined_predictors[np.isnan(sel_combined_predictors)] = 0.5
-    return sel_combined_predictors, sel_combined_predictors.shape[:2]
+    return sel_combined_predictors, sel_combined_predictors.shape[:-1]
+
+
+# Variables of a predictor Dataset (as written by ens_sel_batch_process.py) which a Preprocessor can use: the source
+# type of the convert_*_predictors_to_samples functions, and the axis at which to add a feature dimension of length 1
+PREPROCESSOR_SOURCES = {
+    'ENS_PRED': ('ensemble', None),
+    'AE_PRED': ('ae_meso', None),
+    'AE_TAR': ('ae_meso', 3),
+    'FSS_PRED': ('fss', None),
+    'FSS_TAR': ('fss', -1),
+}
 
 
 class Preprocessor(object):
     """
-    Class containing metadata and wrapper functions for processing data that enters the EnsembleSelector model.
+    Declarative pipeline which converts a predictor Dataset (as written by ens_sel_batch_process.py) into arrays of
+    predictor and target samples for an EnsembleSelector. The stages are:
+        1. load the 'predictors' and 'targets' variables of the Dataset
+        2. find the samples to keep from the missing values of all the arrays (see valid_sample_mask); skipped when
+            imputing without a missing_threshold
+        3. convert each array to samples with the convert_*_predictors_to_samples function of its source
+        4. combine the predictors and the targets into samples-by-features arrays, removing the samples above the
+            missing_threshold when imputing
+        5. impute and scale, with the Imputer and Scaler of an EnsembleSelector
+    Stages 2 and 3 run in parallel threads for the different arrays. If cache_size > 0, the combined (not yet scaled)
+    samples are kept in a bounded cache keyed by a hash of the input arrays, so that data seen before are not
+    processed again; cached arrays are read-only. A Preprocessor can be pickled. Attached to an EnsembleSelector as
+    its 'preprocessor' attribute (as done by DataGenerator), it is saved with the model, so that inference uses the
+    same transforms as training.
+
+    Example:
+        preprocessor = Preprocessor(predictors=('ENS_PRED', 'AE_PRED'), targets=('AE_TAR',), impute_missing=True)
+        predictors, targets = preprocessor.transform(ds.isel(init_date=days), selector=selector)
     """
 
-    def __init__(self):
-        self.convolved = False
+    def __init__(self, predictors=('ENS_PRED',), targets=('AE_TAR',), convolved=False, impute_missing=False,
+                 missing_threshold=None, selection=None, cache_size=0, n_jobs=1):
+        """
+        Initialize a Preprocessor.
+
+        :param predictors: iter: names of the Dataset variables used as predictors, in the order of the features
+        :param targets: iter: names of the Dataset variables used as targets, in the order of the features
+        :param convolved: bool: True if convolution was applied to create predictors
+        :param impute_missing: bool: if True, keep samples with missing values, to be imputed; otherwise remove them
+        :param missing_threshold: float 0-1: if not None and imputing, remove any samples with a fraction of missing
+            values larger than this
+        :param selection: dict: if given, passed to the Dataset's 'sel' method before loading, e.g. {'obs_var': [0]}
+        :param cache_size: int: maximum number of processed inputs kept in memory
+        :param n_jobs: int: number of threads processing the arrays
+        """
+        self.predictors = tuple(predictors)
+        self.targets = tuple(targets)
+        for name in self.predictors + self.targets:
+            if name not in PREPROCESSOR_SOURCES:
+                raise ValueError("unknown predictor variable '%s'; must be one of %s" %
+                                 (name, list(PREPROCESSOR_SOURCES.keys())))
+        if len(self.predictors) == 0 or len(self.targets) == 0:
+            raise ValueError("'predictors' and 'targets' must each contain at least one variable")
+        if len(set(self.predictors + self.targets)) < len(self.predictors + self.targets):
+            raise ValueError('a variable may be used only once as a predictor or target')
+        if missing_threshold is not None and not (0 <= missing_threshold <= 1):
+            raise ValueError("'missing_threshold' must be between 0 and 1")
+        if cache_size < 0:
+            raise ValueError("'cache_size' must be a non-negative integer")
+        if n_jobs < 1:
+            raise ValueError("'n_jobs' must be a positive integer")
+        self.convolved = convolved
+        self.impute_missing = impute_missing
+        self.missing_threshold = missing_threshold
+        self.selection = dict(selection) if selection else None
+        self.cache_size = cache_size
+        self.n_jobs = n_jobs
+        self.feature_shapes = {}
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_options(cls, obs_errors='both', radar_fss='none', **kwargs):
+        """
+        Create a Preprocessor from the 'obs_errors' and 'radar_fss' options of a DataGenerator.
+
+        :param obs_errors: str: how to use the obs errors: 'p' or 'predictors', 't' or 'targets', 'both', or 'none'
+        :param radar_fss: str: how to use the FSS: 'p' or 'predictors', 't' or 'targets', 'both', or 'none'
+        :param kwargs: passed to Preprocessor
+        :return: Preprocessor
+        """
+        predictors = ['ENS_PRED']
+        targets = []
+        if obs_errors in ['p', 'predictors', 'both']:
+            predictors.append('AE_PRED')
+        if radar_fss in ['p', 'predictors', 'both']:
+            predictors.append('FSS_PRED')
+        if obs_errors in ['t', 'targets', 'both']:
+            targets.append('AE_TAR')
+        if radar_fss in ['t', 'targets', 'both']:
+            targets.append('FSS_TAR')
+        return cls(predictors=predictors, targets=targets, **kwargs)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_cache'] = OrderedDict()
+        state['_lock'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def _map(self, function, items):
+        if self.n_jobs > 1 and len(items) > 1:
+            with ThreadPoolExecutor(max_workers=min(self.n_jobs, len(items))) as executor:
+                return list(executor.map(function, items))
+        return [function(item) for item in items]
+
+    def load(self, ds):
+        """
+        Load the arrays used by the Preprocessor from a predictor Dataset.
+
+        :param ds: xarray Dataset: predictor dataset
+        :return: OrderedDict of ndarrays by variable name; str: layout of the ensemble predictors
+        """
+        if self.selection is not None:
+            ds = ds.sel(**self.selection)
+        arrays = OrderedDict()
+        for name in self.predictors + self.targets:
+            array = ds[name].values
+            axis = PREPROCESSOR_SOURCES[name][1]
+            if axis is not None:
+                array = np.expand_dims(array, axis)
+            arrays[name] = array
+        layout = ensemble_layout(ds['ENS_PRED'].dims) if 'ENS_PRED' in arrays else 'ensemble'
+        return arrays, layout
+
+    def sample_mask(self, arrays, layout='ensemble'):
+        """
+        Find the samples to keep from the missing values of the arrays.
+
+        :param arrays: dict: arrays by variable name, as returned by 'load'
+        :param layout: str: layout of the ensemble predictors
+        :return: ndarray: boolean mask of the samples to keep, or None to keep all samples
+        """
+        if self.impute_missing and self.missing_threshold is None:
+            return None
+
+        def count(name):
+            source = PREPROCESSOR_SOURCES[name][0]
+            return sample_missing_counts(arrays[name], source, self.convolved and source != 'fss', layout=layout)
+
+        counts = dict(zip(arrays.keys(), self._map(count, list(arrays.keys()))))
+        threshold = self.missing_threshold if self.impute_missing else None
+        return valid_sample_mask([counts[n] for n in self.predictors], [counts[n] for n in self.targets],
+                                 threshold=threshold)
+
+    def convert(self, arrays, layout='ensemble', mask=None):
+        """
+        Convert each array to a samples-by-features array.
+
+        :param arrays: dict: arrays by variable name, as returned by 'load'
+        :param layout: str: layout of the ensemble predictors
+        :param mask: ndarray: if given, boolean mask of the samples to convert
+        :return: dict of ndarrays by variable name
+        """
+        def convert_one(name):
+            source = PREPROCESSOR_SOURCES[name][0]
+            if source == 'ensemble':
+                return convert_ensemble_predictors_to_samples(arrays[name], convolved=self.convolved, mask=mask,
+                                                              layout=layout)[0]
+            elif source == 'ae_meso':
+                return convert_ae_meso_predictors_to_samples(arrays[name], convolved=self.convolved, mask=mask)[0]
+            return convert_fss_predictors_to_samples(arrays[name], mask=mask)[0]
+
+        samples = dict(zip(arrays.keys(), self._map(convert_one, list(arrays.keys()))))
+        self.feature_shapes = {name: array.shape[1:] for name, array in samples.items()}
+        return samples
+
+    def _hash(self, arrays, layout):
+        options = (self.predictors, self.targets, self.convolved, self.impute_missing, self.missing_threshold, layout)
+        digest = hashlib.sha1(repr(options).encode())
+        for name, array in arrays.items():
+            digest.update(('%s%s%s' % (name, array.shape, array.dtype.str)).encode())
+            digest.update(np.ascontiguousarray(array).data)
+        return digest.hexdigest()
+
+    def process(self, ds):
+        """
+        Run the stages of the pipeline up to, but not including, imputing and scaling.
+
+        :param ds: xarray Dataset: predictor dataset
+        :return: ndarray, ndarray: predictor and target samples
+        """
+        arrays, layout = self.load(ds)
+        key = None
+        if self.cache_size > 0:
+            key = self._hash(arrays, layout)
+            with self._lock:
+                if key in self._cache:
+                    self._cache.move_to_end(key)
+                    return self._cache[key]
+
+        mask = self.sample_mask(arrays, layout)
+        samples = self.convert(arrays, layout, mask)
+        arrays = None
+        p = combine_predictors(*[samples[n] for n in self.predictors])
+        t = combine_predictors(*[samples[n] for n in self.targets])
+        samples = None
+        # Samples with missing values were already removed; with a threshold, set the remaining fill values to NaN
+        if mask is not None and self.impute_missing:
+            p, t = delete_nan_samples(p, t, threshold=self.missing_threshold, inplace=True)
+
+        if key is not None:
+            p.flags.writeable = False
+            t.flags.writeable = False
+            with self._lock:
+                self._cache[key] = (p, t)
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+        return p, t
+
+    def transform(self, ds, selector=None):
+        """
+        Run the full pipeline on a predictor Dataset.
+
+        :param ds: xarray Dataset: predictor dataset
+        :param selector: EnsembleSelector: if given, impute and scale the samples with its Imputer and Scaler (see
+            EnsembleSelector.init_fit)
+        :return: ndarray, ndarray: predictor and target samples
+        """
+        p, t = self.process(ds)
+        if selector is not None:
+            p, t = selector.fused_transform(p, t)
+        return p, t
+
+    def clear_cache(self):
+        """
+        Remove all processed samples from the cache.
+        """
+        with self._lock:
+            self._cache.clear()
@@ -0,0 +1,403 @@
+#
+# Copyright (c) 2017-18 Jonathan Weyn <jweyn@uw.edu>
+#
+# See the file LICENSE for your rights.
+#
+
+"""
+A long-lived local HTTP inference service for a trained EnsembleSelector. The model is loaded once and kept in memory.
+Requests from multiple clients are collected into micro-batches, which are passed to the model's 'predict' method
+together; the predictions are then aggregated into member scores and ranks for each request, like the 'select'
+method. Latency histograms are available from the server.
+
+Endpoints:
+    POST /select: body is an .npz file (see SelectionClient.select); returns an .npy file of scores and ranks
+    GET /stats: JSON latency statistics
+    GET /info: JSON model information
+    GET /health: returns 'ok'
+"""
+
+import io
+import json
+import time
+import queue
+import bisect
+import threading
+import numpy as np
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from urllib.request import urlopen, Request
+from urllib.error import HTTPError
+from .verify import aggregate_scores, stdmean, sqmean, absmean
+
+
+AGGREGATIONS = {
+    'none': None,
+    'mean': np.mean,
+    'nanmean': np.nanmean,
+    'stdmean': stdmean,
+    'sqmean': sqmean,
+    'absmean': absmean
+}
+
+
+class LatencyHistogram(object):
+    """
+    Thread-safe histogram of durations, in seconds, with fixed bucket edges.
+    """
+    BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1., 2., 5., 10., 30.)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counts = [0] * (len(self.BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.
+        self.max = 0.
+
+    def record(self, seconds):
+        with self._lock:
+            self.counts[bisect.bisect_left(self.BUCKETS, seconds)] += 1
+            self.count += 1
+            self.total += seconds
+            self.max = max(self.max, seconds)
+
+    def percentile(self, q):
+        """
+        :param q: float: percentile, 0 to 100
+        :return: float: upper edge of the bucket containing the percentile
+        """
+        if self.count == 0:
+            return 0.
+        target = q / 100. * self.count
+        cumulative = 0
+        for b, count in enumerate(self.counts):
+            cumulative += count
+            if cumulative >= target and count > 0:
+                return self.BUCKETS[b] if b < len(self.BUCKETS) else self.max
+        return self.max
+
+    def to_dict(self):
+        with self._lock:
+            buckets = {'<=%g' % edge: count for edge, count in zip(self.BUCKETS, self.counts)}
+            buckets['>%g' % self.BUCKETS[-1]] = self.counts[-1]
+            return {
+                'count': self.count,
+                'mean': self.total / self.count if self.count > 0 else 0.,
+                'max': self.max,
+                'p50': self.percentile(50),
+                'p90': self.percentile(90),
+                'p99': self.percentile(99),
+                'buckets': buckets
+            }
+
+
+class _SelectRequest(object):
+    def __init__(self, predictors, ensemble_shape, axis, date_axis, abs, agg):
+        self.predictors = predictors
+        self.ensemble_shape = ensemble_shape
+        self.axis = axis
+        self.date_axis = date_axis
+        self.abs = abs
+        self.agg = agg
+        self.num_samples = predictors.shape[0]
+        self.submit_time = time.time()
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+def _encode_npz(**arrays):
+    buffer = io.BytesIO()
+    np.savez(buffer, **arrays)
+    return buffer.getvalue()
+
+
+def _decode_select_request(body):
+    data = np.load(io.BytesIO(body), allow_pickle=False)
+    predictors = data['predictors']
+    ensemble_shape = tuple(int(e) for e in data['ensemble_shape'])
+    axis = int(data['axis']) if 'axis' in data else 0
+    date_axis = int(data['date_axis']) if 'date_axis' in data else None
+    abs = bool(data['abs']) if 'abs' in data else True
+    agg = str(data['agg']) if 'agg' in data else 'mean'
+    if agg not in AGGREGATIONS:
+        raise ValueError("'agg' must be one of %s" % list(AGGREGATIONS.keys()))
+    if predictors.shape[:len(ensemble_shape)] != ensemble_shape:
+        raise ValueError("'ensemble_shape' must match the first m dimensions of 'predictors'")
+    predictors = predictors.reshape((int(np.prod(ensemble_shape)),) + predictors.shape[len(ensemble_shape):])
+    return _SelectRequest(predictors, ensemble_shape, axis, date_axis, abs, AGGREGATIONS[agg])
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def _make_handler(server):
+
+    class SelectionRequestHandler(BaseHTTPRequestHandler):
+
+        def _respond(self, code, body, content_type):
+            self.send_response(code)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _respond_json(self, code, obj):
+            self._respond(code, json.dumps(obj).encode('utf-8'), 'application/json')
+
+        def do_GET(self):
+            if self.path == '/stats':
+                self._respond_json(200, server.stats())
+            elif self.path == '/info':
+                self._respond_json(200, server.info())
+            elif self.path == '/health':
+                self._respond(200, b'ok', 'text/plain')
+            else:
+                self._respond_json(404, {'error': 'unknown path %s' % self.path})
+
+        def do_POST(self):
+            if self.path != '/select':
+                self._respond_json(404, {'error': 'unknown path %s' % self.path})
+                return
+            try:
+                body = self.rfile.read(int(self.headers['Content-Length']))
+                request = _decode_select_request(body)
+            except (KeyError, TypeError, ValueError, OSError) as e:
+                self._respond_json(400, {'error': str(e)})
+                return
+            result = server.submit(request)
+            if request.error is not None:
+                self._respond_json(500, {'error': request.error})
+                return
+            buffer = io.BytesIO()
+            np.save(buffer, result)
+            self._respond(200, buffer.getvalue(), 'application/octet-stream')
+
+        def log_message(self, format, *args):
+            if server.verbose:
+                BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    return SelectionRequestHandler
+
+
+class SelectionServer(object):
+    """
+    HTTP server keeping an EnsembleSelector in memory and answering selection requests in micro-batches. The model
+    is only called from the thread running 'serve_forever', which should be the thread that loaded it.
+    """
+
+    def __init__(self, selector, host='127.0.0.1', port=8765, max_batch_samples=8192, max_wait=0.01,
+                 predict_batch_size=1024, timeout=300., verbose=False):
+        """
+        Initialize a SelectionServer.
+
+        :param selector: ensemble_net.ensemble_selection.EnsembleSelector: trained model
+        :param host: str: host address to bind
+        :param port: int: port to bind
+        :param max_batch_samples: int: maximum number of samples in a micro-batch (larger requests are never split)
+        :param max_wait: float: maximum time (s) to wait for more requests to fill a micro-batch
+        :param predict_batch_size: int: batch size passed to the Keras 'predict' method
+        :param timeout: float: time (s) after which a waiting request fails
+        :param verbose: bool: log every HTTP request
+        """
+        self.selector = selector
+        self.host = host
+        self.port = port
+        self.max_batch_samples = max_batch_samples
+        self.max_wait = max_wait
+        self.predict_batch_size = predict_batch_size
+        self.timeout = timeout
+        self.verbose = verbose
+        self._queue = queue.Queue()
+        self._stop = threading.Event()
+        self._http_server = None
+        self._http_thread = None
+        self._start_time = time.time()
+        self._counters_lock = threading.Lock()
+        self._counters = {'requests': 0, 'errors': 0, 'batches': 0, 'samples': 0}
+        self.histograms = {
+            'request_latency': LatencyHistogram(),
+            'queue_wait': LatencyHistogram(),
+            'predict_time': LatencyHistogram()
+        }
+
+    def info(self):
+        """
+        :return: dict: information about the served model
+        """
+        try:
+            model_input_shape = self.selector.model.input_shape
+            if isinstance(model_input_shape, list):
+                # Multi-input model: requests carry the combined samples-by-features predictors
+                input_shape = [int(sum(np.prod(shape[1:]) for shape in model_input_shape))]
+            else:
+                input_shape = [d for d in model_input_shape[1:]]
+        except AttributeError:
+            input_shape = None
+        return {
+            'input_shape': input_shape,
+            'impute': bool(self.selector.impute),
+            'scaler_type': self.selector.scaler_type,
+            'aggregations': list(AGGREGATIONS.keys())
+        }
+
+    def stats(self):
+        """
+        :return: dict: counters and latency histograms since the server started
+        """
+        with self._counters_lock:
+            stats = dict(self._counters)
+        stats['uptime'] = time.time() - self._start_time
+        stats['mean_batch_samples'] = stats['samples'] / stats['batches'] if stats['batches'] > 0 else 0.
+        for name, histogram in self.histograms.items():
+            stats[name] = histogram.to_dict()
+        return stats
+
+    def submit(self, request):
+        """
+        Queue a request and wait for its result. Called from the HTTP handler threads.
+
+        :param request: _SelectRequest
+        :return: ndarray: result of the selection, or None if there was an error
+        """
+        self._queue.put(request)
+        if not request.event.wait(self.timeout):
+            request.error = 'request timed out'
+        latency = time.time() - request.submit_time
+        self.histograms['request_latency'].record(latency)
+        with self._counters_lock:
+            self._counters['requests'] += 1
+            self._counters['errors'] += int(request.error is not None)
+        return request.result
+
+    def _next_batch(self):
+        try:
+            first = self._queue.get(timeout=0.1)
+        except queue.Empty:
+            return []
+        requests = [first]
+        num_samples = first.num_samples
+        deadline = time.time() + self.max_wait
+        while num_samples < self.max_batch_samples:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                request = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            requests.append(request)
+            num_samples += request.num_samples
+        return requests
+
+    def _process(self, requests):
+        start_time = time.time()
+        for request in requests:
+            self.histograms['queue_wait'].record(start_time - request.submit_time)
+        # Requests must have matching feature shapes to be predicted together
+        groups = {}
+        for request in requests:
+            groups.setdefault(request.predictors.shape[1:], []).append(request)
+        for group in groups.values():
+            try:
+                predictors = np.concatenate([r.predictors for r in group])
+                predicted = self.selector.predict(predictors, batch_size=self.predict_batch_size)
+            except Exception as e:
+                for request in group:
+                    request.error = '%s: %s' % (type(e).__name__, e)
+                    request.event.set()
+                continue
+            splits = np.cumsum([r.num_samples for r in group])[:-1]
+            for request, p in zip(group, np.split(predicted, splits)):
+                try:
+                    request.result = aggregate_scores(p.reshape(request.ensemble_shape + (-1,)), axis=request.axis,
+                                                      date_axis=request.date_axis, abs=request.abs, agg=request.agg)
+                except Exception as e:
+                    request.error = '%s: %s' % (type(e).__name__, e)
+                request.event.set()
+        self.histograms['predict_time'].record(time.time() - start_time)
+        with self._counters_lock:
+            self._counters['batches'] += 1
+            self._counters['samples'] += sum(r.num_samples for r in requests)
+
+    def serve_forever(self):
+        """
+        Start the HTTP server in background threads and process micro-batches in this thread until 'shutdown'.
+        """
+        self._stop.clear()
+        self._http_server = _ThreadingHTTPServer((self.host, self.port), _make_handler(self))
+        self.port = self._http_server.server_address[1]
+        self._http_thread = threading.Thread(target=self._http_server.serve_forever, daemon=True)
+        self._http_thread.start()
+        print('SelectionServer: serving on http://%s:%d' % (self.host, self.port))
+        try:
+            while not self._stop.is_set():
+                requests = self._next_batch()
+                if len(requests) > 0:
+                    self._process(requests)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self._http_server.shutdown()
+            self._http_server.server_close()
+
+    def shutdown(self):
+        """
+        Stop serving. May be called from any thread.
+        """
+        self._stop.set()
+
+
+class SelectionClient(object):
+    """
+    Client for a SelectionServer.
+    """
+
+    def __init__(self, host='127.0.0.1', port=8765, timeout=300.):
+        self.url = 'http://%s:%d' % (host, port)
+        self.timeout = timeout
+
+    def _get_json(self, path):
+        with urlopen(self.url + path, timeout=self.timeout) as response:
+            return json.loads(response.read().decode('utf-8'))
+
+    def select(self, predictors, ensemble_shape, axis=0, date_axis=None, abs=True, agg='mean'):
+        """
+        Request a selection from the server. Parameters are as in EnsembleSelector.select, except that 'agg' is the
+        name of an aggregation method: 'none', 'mean', 'nanmean', 'stdmean', 'sqmean', or 'absmean'.
+
+        :return: ndarray: array of aggregated error score and rank of each ensemble member
+        """
+        arrays = {
+            'predictors': np.asarray(predictors),
+            'ensemble_shape': np.array(ensemble_shape, dtype=np.int64),
+            'axis': np.array(axis),
+            'abs': np.array(abs),
+            'agg': np.array(agg)
+        }
+        if date_axis is not None:
+            arrays['date_axis'] = np.array(date_axis)
+        request = Request(self.url + '/select', data=_encode_npz(**arrays),
+                          headers={'Content-Type': 'application/octet-stream'})
+        try:
+            with urlopen(request, timeout=self.timeout) as response:
+                return np.load(io.BytesIO(response.read()), allow_pickle=False)
+        except HTTPError as e:
+            try:
+                message = json.loads(e.read().decode('utf-8'))['error']
+            except (ValueError, KeyError):
+                message = str(e)
+            raise RuntimeError('SelectionClient: server error: %s' % message)
+
+    def stats(self):
+        """
+        :return: dict: server statistics
+        """
+        return self._get_json('/stats')
+
+    def info(self):
+        """
+        :return: dict: served model information
+        """
+        return self._get_json('/info')
@@ -0,0 +1,182 @@
+#
+# Copyright (c) 2017-18 Jonathan Weyn <jweyn@uw.edu>
+#
+# See the file LICENSE for your rights.
+#
+
+"""
+Pre-processed training shards for an EnsembleSelector. 'compile_shards' runs the full processing of a DataGenerator
+(reshaping, removal of missing samples, imputing and scaling) once and writes the resulting samples to fixed-size
+float32 arrays of an ArrayStore (see ensemble_net.array_store). A ShardGenerator then serves batches as slices of
+memory-mapped shards, so training reads the data sequentially from disk without any processing.
+"""
+
+import numpy as np
+from keras.utils import Sequence
+from ..array_store import ArrayStore
+from .preprocessing import split_model_inputs
+
+
+def _write_shard(store, number, X, y, dtype):
+    x_name = 'X_%05d' % number
+    y_name = 'y_%05d' % number
+    store.write(x_name, X, dtype=dtype)
+    store.write(y_name, y, dtype=dtype)
+    return {'X': x_name, 'y': y_name, 'num_samples': int(X.shape[0])}
+
+
+def compile_shards(generator, directory, shard_size=4096, days_per_chunk=None, shuffle=False, dtype='float32',
+                   verbose=True):
+    """
+    Process all the init dates of a DataGenerator and write the scaled samples to shards of 'shard_size' samples
+    each (the last shard may be smaller). The EnsembleSelector of the generator must already be initialized with
+    init_fit(), and must be saved along with the shards to make predictions with the trained model.
+
+    :param generator: ensemble_net.ensemble_selection.DataGenerator: generator of training data
+    :param directory: str: directory of the ArrayStore in which to write the shards
+    :param shard_size: int: number of samples per shard
+    :param days_per_chunk: int: number of init dates processed at a time (default: the generator's batch size)
+    :param shuffle: bool: if True, process the init dates in random order, so that shards mix the dates
+    :param dtype: str or numpy dtype: data type of the saved samples
+    :param verbose: bool: print progress statements
+    :return: dict: the shard index, also saved as the attributes of the store
+    """
+    if not generator.selector.is_init_fit:
+        raise AttributeError("the generator's EnsembleSelector has not been initialized with init_fit()")
+    if shard_size < 1:
+        raise ValueError("'shard_size' must be a positive integer")
+    if days_per_chunk is None:
+        days_per_chunk = generator.batch_size
+    store = ArrayStore(directory, mode='w')
+
+    days = np.arange(generator.num_dates)
+    if shuffle:
+        np.random.shuffle(days)
+
+    shards = []
+    X_buffer, y_buffer = [], []
+    num_buffered = 0
+    for d in range(0, len(days), days_per_chunk):
+        if verbose:
+            print('compile_shards: processing init dates %d-%d of %d' % (d + 1, min(d + days_per_chunk, len(days)),
+                                                                        len(days)))
+        X, y = generator.generate_data(days[d:d + days_per_chunk])
+        X_buffer.append(X)
+        y_buffer.append(y)
+        num_buffered += X.shape[0]
+        if num_buffered >= shard_size:
+            X = np.concatenate(X_buffer)
+            y = np.concatenate(y_buffer)
+            while X.shape[0] >= shard_size:
+                shards.append(_write_shard(store, len(shards), X[:shard_size], y[:shard_size], dtype))
+                X = X[shard_size:]
+                y = y[shard_size:]
+            X_buffer, y_buffer = [X], [y]
+            num_buffered = X.shape[0]
+    if num_buffered > 0:
+        shards.append(_write_shard(store, len(shards), np.concatenate(X_buffer), np.concatenate(y_buffer),
+                                   dtype))
+    if len(shards) == 0:
+        raise ValueError('no valid samples were produced by the generator')
+
+    index = {
+        'shard_size': int(shard_size),
+        'num_samples': int(sum(s['num_samples'] for s in shards)),
+        'input_shape': list(store.shape(shards[0]['X'])[1:]),
+        'output_shape': list(store.shape(shards[0]['y'])[1:]),
+        'dtype': np.dtype(dtype).name,
+        'num_dates': int(generator.num_dates),
+        'shards': shards
+    }
+    store.attrs.update(index)
+    store.flush()
+    if verbose:
+        print('compile_shards: wrote %d samples in %d shards to %s' % (index['num_samples'], len(shards), directory))
+    return index
+
+
+def load_shard_index(directory):
+    """
+    Read the index of shards written by compile_shards.
+
+    :param directory: str: directory of the shards
+    :return: dict: the shard index
+    """
+    return ArrayStore(directory).attrs
+
+
+class ShardGenerator(Sequence):
+    """
+    Class used to serve batches of already-processed training samples from shards written by compile_shards. Batches
+    are slices of memory-mapped shards and never cross shard boundaries.
+    """
+
+    def __init__(self, directory, batch_size=256, shuffle=False, conv_shape=None):
+        """
+        Initialize a ShardGenerator.
+
+        :param directory: str: directory of the shards
+        :param batch_size: int: number of samples (not days) per batch
+        :param shuffle: bool: if True, serve the batches in random order in each epoch
+        :param conv_shape: tuple: if given, serve the predictors as [spatial, extra] inputs of a model built with
+            EnsembleSelector.build_multi_input_model, with spatial features of this shape (see
+            preprocessing.split_model_inputs)
+        """
+        if batch_size < 1:
+            raise ValueError("'batch_size' must be a positive integer")
+        self.directory = directory
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.conv_shape = tuple(conv_shape) if conv_shape is not None else None
+        self.index = load_shard_index(directory)
+        self.num_samples = self.index['num_samples']
+        self.input_shape = tuple(self.index['input_shape'])
+        self.output_shape = tuple(self.index['output_shape'])
+
+        # Batches as (shard, start, end)
+        self.batches = []
+        for s, shard in enumerate(self.index['shards']):
+            for start in range(0, shard['num_samples'], batch_size):
+                self.batches.append((s, start, min(start + batch_size, shard['num_samples'])))
+        self.indices = []
+        self._X = None
+        self._y = None
+        self._open()
+        self.on_epoch_end()
+
+    def _open(self):
+        store = ArrayStore(self.directory)
+        self._X = [store.read(s['X']) for s in self.index['shards']]
+        self._y = [store.read(s['y']) for s in self.index['shards']]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_X'] = None
+        state['_y'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._open()
+
+    def on_epoch_end(self):
+        self.indices = np.arange(len(self.batches))
+        if self.shuffle:
+            np.random.shuffle(self.indices)
+
+    def __len__(self):
+        """
+        :return: the number of batches per epoch
+        """
+        return len(self.batches)
+
+    def __getitem__(self, index):
+        """
+        Get one batch of data
+        :param index: index of batch
+        :return:
+        """
+        s, start, end = self.batches[self.indices[index]]
+        if self.conv_shape is not None:
+            return split_model_inputs(self._X[s][start:end], self.conv_shape), self._y[s][start:end]
+        return self._X[s][start:end], self._y[s][start:end]
@@ -0,0 +1,326 @@
+#
+# Copyright (c) 2017-18 Jonathan Weyn <jweyn@uw.edu>
+#
+# See the file LICENSE for your rights.
+#
+
+"""
+Cross-validation and hyper-parameter sweeps for an EnsembleSelector. The data of each fold are processed once with
+'compile_folds' into memory-mapped shards (see shards.py), which all the jobs of the fold read without copying. Each
+job (one combination of parameters and one fold) is trained in its own Python process, started with
+'python -m ensemble_net.ensemble_selection.sweep', so that no Keras or HDF state is shared between models. 'run_sweep'
+packs the jobs onto the available CPU cores and collects the validation scores and timings into an xarray Dataset.
+"""
+
+import os
+import sys
+import json
+import time
+import pickle
+import itertools
+import subprocess
+from copy import deepcopy
+import numpy as np
+import xarray as xr
+
+
+SELECTOR_FILE = 'selector.pkl'
+JOB_FILE = 'job.json'
+RESULT_FILE = 'result.json'
+LOG_FILE = 'log.txt'
+
+# Environment variables limiting the number of threads of numerical libraries in a job
+THREAD_VARIABLES = ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'NUMEXPR_NUM_THREADS',
+                    'NUMBA_NUM_THREADS')
+
+# Job parameters which are not swept take these values
+DEFAULT_PARAMETERS = {
+    'layers': None,
+    'batch_size': 256,
+    'optimizer': 'SGD',
+    'lr': 1e-4,
+    'loss': 'mse',
+    'metrics': ['mae'],
+    'epochs': 1
+}
+
+
+def make_folds(num_dates, num_folds, shuffle=True, seed=None):
+    """
+    Split init dates into folds for cross-validation. Each init date is in the validation set of exactly one fold.
+
+    :param num_dates: int: number of init dates
+    :param num_folds: int: number of folds
+    :param shuffle: bool: if True, assign random dates to each fold; otherwise use consecutive blocks of dates
+    :param seed: int: seed for the random assignment
+    :return: list of (train_set, val_set) lists of date indices
+    """
+    if num_folds < 2 or num_folds > num_dates:
+        raise ValueError("'num_folds' must be between 2 and the number of dates")
+    dates = np.arange(num_dates)
+    if shuffle:
+        np.random.RandomState(seed).shuffle(dates)
+    folds = []
+    for val_dates in np.array_split(dates, num_folds):
+        val_set = sorted(int(d) for d in val_dates)
+        train_set = sorted(set(range(num_dates)) - set(val_set))
+        folds.append((train_set, val_set))
+    return folds
+
+
+def compile_folds(selector, ds, folds, directory, batch_size=8, shard_size=4096, verbose=True, **generator_kwargs):
+    """
+    Prepare the data of each fold for a sweep: fit a copy of the selector's Imputer and Scaler to the training dates,
+    and write the processed training and validation samples to shards in '${directory}/fold_${n}'.
+
+    :param selector: ensemble_net.ensemble_selection.EnsembleSelector: selector defining the scaling and imputing
+    :param ds: xarray Dataset: predictor dataset
+    :param folds: list of (train_set, val_set) lists of date indices, e.g. from make_folds
+    :param directory: str: root directory of the fold data
+    :param batch_size: int: number of init dates processed at a time
+    :param shard_size: int: number of samples per shard
+    :param verbose: bool: print progress statements
+    :param generator_kwargs: passed to DataGenerator
+    :return: list of str: the directory of each fold
+    """
+    from .model import DataGenerator
+    from .shards import compile_shards
+
+    fold_directories = []
+    for f, (train_set, val_set) in enumerate(folds):
+        fold_directory = os.path.join(directory, 'fold_%d' % f)
+        os.makedirs(fold_directory, exist_ok=True)
+        if verbose:
+            print('compile_folds: fold %d of %d (%d training, %d validation dates)' %
+                  (f + 1, len(folds), len(train_set), len(val_set)))
+        fold_selector = deepcopy(selector)
+        fold_selector.model = None
+        generator = DataGenerator(fold_selector, ds.isel(init_date=train_set), batch_size, **generator_kwargs)
+        fold_selector.init_fit(generator)
+        compile_shards(generator, os.path.join(fold_directory, 'train'), shard_size=shard_size, shuffle=True,
+                       verbose=verbose)
+        val_generator = DataGenerator(fold_selector, ds.isel(init_date=val_set), batch_size, **generator_kwargs)
+        compile_shards(val_generator, os.path.join(fold_directory, 'val'), shard_size=shard_size, verbose=verbose)
+        with open(os.path.join(fold_directory, SELECTOR_FILE), 'wb') as f_out:
+            pickle.dump(fold_selector, f_out, protocol=pickle.HIGHEST_PROTOCOL)
+        with open(os.path.join(fold_directory, 'folds.json'), 'w') as f_out:
+            json.dump({'train_set': list(map(int, train_set)), 'val_set': list(map(int, val_set))}, f_out)
+        fold_directories.append(fold_directory)
+    return fold_directories
+
+
+def _is_scalar(value):
+    return isinstance(value, (int, float, str, np.integer, np.floating)) and not isinstance(value, bool)
+
+
+def _to_json(value):
+    if isinstance(value, tuple):
+        return [_to_json(v) for v in value]
+    if isinstance(value, list):
+        return [_to_json(v) for v in value]
+    if isinstance(value, dict):
+        return {k: _to_json(v) for k, v in value.items()}
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def _layers_from_json(layers, input_shape, num_outputs):
+    # Layer arguments must be tuples; the first layer gets the input shape and the last the number of outputs
+    layers = [[layer[0], tuple(layer[1] or ()), dict(layer[2] or {})] for layer in layers]
+    layers[0][2]['input_shape'] = tuple(input_shape)
+    layers[-1][1] = (num_outputs,)
+    return layers
+
+
+def _run_job(job_directory):
+    # Train and validate one model; runs in the job's own process
+    from keras.callbacks import TerminateOnNaN, History
+    from .shards import ShardGenerator
+    from .. import util
+
+    with open(os.path.join(job_directory, JOB_FILE), 'r') as f:
+        job = json.load(f)
+    parameters = job['parameters']
+    result = {'error': None}
+    start_time = time.time()
+    try:
+        _limit_keras_threads(job['cores'])
+        with open(os.path.join(job['fold_directory'], SELECTOR_FILE), 'rb') as f:
+            selector = pickle.load(f)
+        generator = ShardGenerator(os.path.join(job['fold_directory'], 'train'), batch_size=parameters['batch_size'],
+                                   shuffle=True)
+        val_generator = ShardGenerator(os.path.join(job['fold_directory'], 'val'), batch_size=4096)
+        layers = _layers_from_json(parameters['layers'], generator.input_shape, generator.output_shape[0])
+        optimizer = util.get_from_class('keras.optimizers', parameters['optimizer'])(lr=parameters['lr'])
+        selector.build_model(layers=layers, loss=parameters['loss'], optimizer=optimizer,
+                             metrics=list(parameters['metrics']))
+
+        history = History()
+        fit_start = time.time()
+        selector.fit_generator(generator, epochs=parameters['epochs'], verbose=2, workers=1,
+                               use_multiprocessing=False, shuffle=False, callbacks=[TerminateOnNaN(), history])
+        result['train_time'] = time.time() - fit_start
+        eval_start = time.time()
+        score = selector.model.evaluate_generator(val_generator, workers=1, use_multiprocessing=False)
+        result['eval_time'] = time.time() - eval_start
+        score = np.atleast_1d(score)
+        result['val_loss'] = float(score[0])
+        for m, metric in enumerate(parameters['metrics']):
+            result['val_%s' % metric] = float(score[m + 1])
+        result['train_loss'] = float(history.history['loss'][-1]) if len(history.history.get('loss', [])) > 0 \
+            else np.nan
+        if job['model_file'] is not None:
+            util.save_model(selector, job['model_file'], history=history)
+    except Exception as e:
+        result['error'] = '%s: %s' % (type(e).__name__, e)
+    result['job_time'] = time.time() - start_time
+    with open(os.path.join(job_directory, RESULT_FILE), 'w') as f:
+        json.dump(result, f)
+
+
+def _limit_keras_threads(cores):
+    # Set the number of TensorFlow threads, if using the TensorFlow backend
+    import keras.backend as K
+    if K.backend() != 'tensorflow':
+        return
+    import tensorflow as tf
+    config = tf.ConfigProto(intra_op_parallelism_threads=cores, inter_op_parallelism_threads=min(cores, 2))
+    K.set_session(tf.Session(config=config))
+
+
+def _job_environment(cores):
+    env = os.environ.copy()
+    for variable in THREAD_VARIABLES:
+        env[variable] = str(cores)
+    # Make this package importable from the job, whatever its working directory
+    root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    env['PYTHONPATH'] = os.pathsep.join([root] + [p for p in env.get('PYTHONPATH', '').split(os.pathsep) if p])
+    return env
+
+
+def run_sweep(parameters, fold_directories, directory, cores=None, cores_per_job=1, save_models=False,
+              poll_interval=1., verbose=True, **default_parameters):
+    """
+    Train and validate an EnsembleSelector for every combination of the swept parameters and every fold. Each job is
+    run in its own process, limited to 'cores_per_job' threads; as many jobs as fit on 'cores' cores run at a time.
+
+    Job parameters are 'layers' (see EnsembleSelector.build_model; the input shape and the number of outputs are set
+    automatically), 'batch_size' (in samples), 'optimizer' (name in keras.optimizers), 'lr', 'loss', 'metrics' and
+    'epochs'. Each may be swept by giving a list of values in 'parameters', or fixed with a keyword argument.
+
+    :param parameters: dict: list of values of each swept parameter, e.g. {'lr': [1e-4, 1e-5], 'batch_size': [64]}
+    :param fold_directories: list of str: fold directories written by compile_folds
+    :param directory: str: directory for job specifications, logs, results, and saved models
+    :param cores: int: number of CPU cores to use (default: all)
+    :param cores_per_job: int: number of threads of each job
+    :param save_models: bool: if True, save each trained model (ensemble_net.util.save_model) in its job directory
+    :param poll_interval: float: time (s) between checks of the running jobs
+    :param verbose: bool: print progress statements
+    :param default_parameters: values of parameters which are not swept
+    :return: xarray Dataset: validation scores and timings, with one dimension per swept parameter and a 'fold'
+        dimension. Parameters with non-scalar values (e.g. layers) are indexed by integers.
+    """
+    if cores is None:
+        cores = os.cpu_count() or 1
+    if cores_per_job < 1 or cores_per_job > cores:
+        raise ValueError("'cores_per_job' must be between 1 and 'cores'")
+    if len(fold_directories) == 0:
+        raise ValueError("'fold_directories' must not be empty")
+    for key in list(parameters.keys()) + list(default_parameters.keys()):
+        if key not in DEFAULT_PARAMETERS:
+            raise ValueError("unknown job parameter '%s'" % key)
+    fixed = dict(DEFAULT_PARAMETERS)
+    fixed.update(default_parameters)
+    names = list(parameters.keys())
+    values = [list(parameters[n]) for n in names]
+    if fixed['layers'] is None and 'layers' not in names:
+        raise ValueError("'layers' must be given as a swept or fixed parameter")
+    os.makedirs(directory, exist_ok=True)
+
+    # Write the job specifications
+    grid_shape = tuple(len(v) for v in values) + (len(fold_directories),)
+    jobs = []
+    for index in itertools.product(*[range(n) for n in grid_shape]):
+        job_parameters = dict(fixed)
+        job_parameters.update({n: values[p][index[p]] for p, n in enumerate(names)})
+        job_directory = os.path.join(directory, 'job_%05d' % len(jobs))
+        os.makedirs(job_directory, exist_ok=True)
+        if os.path.exists(os.path.join(job_directory, RESULT_FILE)):
+            os.remove(os.path.join(job_directory, RESULT_FILE))
+        job = {
+            'parameters': _to_json(job_parameters),
+            'fold_directory': os.path.abspath(fold_directories[index[-1]]),
+            'cores': cores_per_job,
+            'model_file': os.path.join(os.path.abspath(job_directory), 'model') if save_models else None
+        }
+        with open(os.path.join(job_directory, JOB_FILE), 'w') as f:
+            json.dump(job, f, indent=2)
+        jobs.append((index, job_directory))
+
+    # Schedule the jobs onto the cores
+    sweep_start = time.time()
+    pending = list(range(len(jobs)))
+    running = {}
+    queue_times = np.full(len(jobs), np.nan)
+    free_cores = cores
+    while len(pending) > 0 or len(running) > 0:
+        while len(pending) > 0 and free_cores >= cores_per_job:
+            j = pending.pop(0)
+            job_directory = jobs[j][1]
+            log = open(os.path.join(job_directory, LOG_FILE), 'w')
+            process = subprocess.Popen([sys.executable, '-m', __name__, job_directory], stdout=log,
+                                       stderr=subprocess.STDOUT, env=_job_environment(cores_per_job))
+            running[j] = (process, log)
+            queue_times[j] = time.time() - sweep_start
+            free_cores -= cores_per_job
+            if verbose:
+                print('run_sweep: started job %d of %d (%s)' % (j + 1, len(jobs), job_directory))
+        time.sleep(poll_interval)
+        for j in list(running.keys()):
+            process, log = running[j]
+            if process.poll() is not None:
+                log.close()
+                del running[j]
+                free_cores += cores_per_job
+                if verbose:
+                    print('run_sweep: job %d finished with exit code %d' % (j + 1, process.returncode))
+
+    # Collect the results
+    results = []
+    for j, (index, job_directory) in enumerate(jobs):
+        try:
+            with open(os.path.join(job_directory, RESULT_FILE), 'r') as f:
+                results.append(json.load(f))
+        except (IOError, ValueError):
+            results.append({'error': 'job process failed; see %s' % os.path.join(job_directory, LOG_FILE)})
+    score_names = sorted(set(k for r in results for k in r.keys() if k != 'error'))
+    coords = []
+    for n, v in zip(names, values):
+        coords.append((n, v if all(_is_scalar(x) for x in v) else list(range(len(v)))))
+    coords.append(('fold', list(range(len(fold_directories)))))
+    dims = [c[0] for c in coords]
+    ds = xr.Dataset(coords=dict(coords))
+    for score in score_names:
+        data = np.full(grid_shape, np.nan)
+        for (index, _), r in zip(jobs, results):
+            if r.get(score) is not None:
+                data[index] = r[score]
+        ds[score] = (dims, data)
+    ds['queue_time'] = (dims, queue_times.reshape(grid_shape))
+    errors = np.full(grid_shape, '', dtype=object)
+    for (index, _), r in zip(jobs, results):
+        errors[index] = r['error'] or ''
+    ds['error'] = (dims, errors.astype(str))
+    ds.attrs['sweep_time'] = time.time() - sweep_start
+    ds.attrs['cores'] = cores
+    ds.attrs['cores_per_job'] = cores_per_job
+    ds.attrs['directory'] = os.path.abspath(directory)
+    if verbose:
+        num_failed = int(np.sum(errors != ''))
+        print('run_sweep: %d jobs finished in %0.1f s (%d failed)' % (len(jobs), ds.attrs['sweep_time'], num_failed))
+    return ds
+
+
+if __name__ == '__main__':
+    _run_job(sys.argv[1])
@@ -9,90 +9,197 @@ Verification for an ensemble-selection model.
 """
 
 import numpy as np
-from .preprocessing import convert_ae_meso_predictors_to_samples, extract_members_from_samples, combine_predictors
+from numba import jit
+from .preprocessing import convert_predictors_to_member_samples
 
 
-def select_verification(verify, ensemble_shape, convolved=False, axis=0, abs=True, agg=np.nanmean):
+def aggregate_scores(scores, axis=0, date_axis=None, abs=True, agg=np.mean, mean=np.mean):
+    """
+    Aggregate an array of errors of ensemble members into a score and a rank for each member. The array has the
+    ensemble dimensions followed by one dimension of features (e.g. stations and variables). Ensemble dimensions other
+    than the member and date dimensions are considered convolutions and averaged.
+
+    :param scores: ndarray: array of errors
+    :param axis: int: the axis of the ensemble member dimension
+    :param date_axis: int: if not None, the axis of an init date dimension; scores and ranks are computed for each date
+    :param abs: bool: if True, take the absolute value of the averaged errors
+    :param agg: method: aggregation method for combining errors into one score. Should accept an 'axis' kwarg and is
+        applied to each date separately. If None, then returns the averaged errors.
+    :param mean: method: averaging method over convolutions. Should accept a tuple 'axis' kwarg.
+    :return: ndarray: array of aggregated score and rank of each member, of shape (member, 2) or (date, member, 2)
+    """
+    ens_size = scores.ndim - 1
+    if axis < 0:
+        axis += ens_size
+    if date_axis is not None and date_axis < 0:
+        date_axis += ens_size
+    if not 0 <= axis < ens_size or (date_axis is not None and not 0 <= date_axis < ens_size):
+        raise ValueError("'axis' and 'date_axis' must be among the ensemble dimensions")
+    if date_axis == axis:
+        raise ValueError("'axis' and 'date_axis' must be different")
+    keep_axes = [axis] if date_axis is None else [date_axis, axis]
+    mean_axes = tuple(d for d in range(ens_size) if d not in keep_axes)
+    if len(mean_axes) > 0:
+        scores = mean(scores, axis=mean_axes)
+    # Remaining dimensions are in their original order; put them as (date,) member, features
+    remaining = [d for d in range(ens_size) if d in keep_axes]
+    scores = np.moveaxis(scores, [remaining.index(d) for d in keep_axes], list(range(len(keep_axes))))
+    # Use the aggregation method
+    if abs:
+        scores = np.abs(scores)
+        if agg is None:
+            print("warning: returning absolute value of the scores ('abs' is True)")
+    if agg is None:
+        return scores
+    if date_axis is None:
+        agg_score = agg(scores, axis=1)
+    elif agg is stdmean:
+        agg_score = stdmean(scores, axis=-1, keep_axes=(0,))
+    elif agg in _ROW_AGGREGATIONS:
+        agg_score = agg(scores, axis=-1)
+    else:
+        agg_score = np.stack([agg(s, axis=1) for s in scores])
+    agg_rank = rank(agg_score, axis=-1)
+    return np.stack((agg_score, agg_rank), axis=-1)
+
+
+def select_verification(verify, ensemble_shape, convolved=False, axis=0, date_axis=None, abs=True, agg=np.nanmean):
     """
     Formats an array of errors into the same output as the EnsembleSelector's 'select' method. The errors should be
-    an array generated in the same way as the array for targets when training the EnsembleSelector.
-    TODO: add support for init_date dimension as well
+    an array generated in the same way as the array for targets when training the EnsembleSelector, and may contain
+    any number of init dates.
 
     :param verify: ndarray: array of ae_meso or radar outputs to be used as verification
-    :param ensemble_shape: tuple: ensemble dimensions (first m dimensions of predictors). Must contain an ensemble
-        member dimension. Other dimensions are considered convolutions and simply averaged.
+    :param ensemble_shape: tuple: ensemble dimensions (first m dimensions of predictors), as returned by
+        format_select_predictors. Must contain an ensemble member dimension. Other dimensions are considered
+        convolutions and averaged. May split the samples dimension of the formatted errors into init dates and
+        convolutions, e.g. (member, date, convolution).
     :param convolved: bool: whether the predictors were generated with convolution
     :param axis: int: the axis among the first m dimensions (given by ensemble_shape) of the ensemble member dim
+    :param date_axis: int: if not None, the axis among the first m dimensions of the init date dim
     :param abs: bool: if True, take the absolute mean of the predicted errors
     :param agg: method: aggregation method for combining predicted errors into one score. Should accept an 'axis'
         kwarg. If None, then returns the raw selection scores.
-    :return:
+    :return: ndarray: array of aggregated error score and rank of each ensemble member, for each date if date_axis
     """
     ens_size = len(ensemble_shape)
     if axis > ens_size:
         raise ValueError("'axis' larger than dimensions in 'ensemble_shape'")
-    if axis == -1:
-        axis = ens_size - 1
-    num_members = ensemble_shape[axis]
-    # Format verification just like the targets
+    # Format verification just like the targets, as (member, date, [convolution,] features)
     # Add an axis in 4th position if we don't have a 5-d array
     if len(verify.shape) == 4:
         verify = np.expand_dims(verify, 3)
-    verify_predictors, spi = convert_ae_meso_predictors_to_samples(verify, convolved=convolved, split_members=True)
-    verify_predictors = extract_members_from_samples(verify_predictors, num_members)
-    verified = verify_predictors.reshape(verify_predictors.shape[:2] + (-1,))
+    verified = convert_predictors_to_member_samples(verify, 'ae_meso', convolved)
     v_shape = verified.shape
-    if v_shape[:ens_size] != ensemble_shape:
-        raise ValueError("'ensemble_shape' (%s) does not match the first m dimensions of formatted verification (%s)" %
-                         (ensemble_shape, v_shape))
+    if v_shape[:-1] != tuple(ensemble_shape):
+        if ens_size < 2 or ensemble_shape[0] != v_shape[0] or \
+                int(np.prod(ensemble_shape[1:])) != int(np.prod(v_shape[1:-1])):
+            raise ValueError("'ensemble_shape' (%s) does not match the first m dimensions of formatted verification "
+                             "(%s)" % (ensemble_shape, v_shape[:-1]))
+        verified = verified.reshape(tuple(ensemble_shape) + (-1,))
     # Calculate the rank and reshape to output like the model's 'select' method
-    dim_sub = 0
-    for dim in range(ens_size):
-        if dim != axis:
-            verified = np.nanmean(verified, axis=dim - dim_sub)
-            dim_sub += 1
-    # We should now have a ens_size-by-target_features array
-    # Use the aggregation method
-    if abs:
-        verified = np.abs(verified)
-        if agg is None:
-            print("warning: returning absolute value of the verification ('abs' is True)")
-    if agg is None:
-        return verified
-    agg_score = agg(verified, axis=1)
-    agg_rank = rank(agg_score)
-    return np.vstack((agg_score, agg_rank)).T
+    return aggregate_scores(verified, axis=axis, date_axis=date_axis, abs=abs, agg=agg, mean=np.nanmean)
+
+
+_TIES = {'ordinal': 0, 'min': 1, 'max': 2, 'average': 3}
 
 
-def rank(s, lowest_first=True):
+def _tied_ranks(sorted_values, ties):
+    # Ranks of sorted values (along the last axis) under the given tie method
+    num = sorted_values.shape[-1]
+    positions = np.broadcast_to(np.arange(num, dtype=np.float64), sorted_values.shape)
+    if ties == 'ordinal' or num == 0:
+        return positions
+    new_group = np.ones(sorted_values.shape, dtype=bool)
+    new_group[..., 1:] = sorted_values[..., 1:] != sorted_values[..., :-1]
+    end_group = np.ones(sorted_values.shape, dtype=bool)
+    end_group[..., :-1] = new_group[..., 1:]
+    group_min = np.maximum.accumulate(np.where(new_group, positions, 0.), axis=-1)
+    group_max = np.flip(np.minimum.accumulate(np.flip(np.where(end_group, positions, num - 1.), axis=-1), axis=-1),
+                        axis=-1)
+    if ties == 'min':
+        return group_min
+    elif ties == 'max':
+        return group_max
+    return 0.5 * (group_min + group_max)
+
+
+@jit(nopython=True)
+def _rank_rows(a, ties):
+    ranks = np.empty(a.shape, dtype=np.float64)
+    num = a.shape[1]
+    for i in range(a.shape[0]):
+        order = np.argsort(a[i], kind='mergesort')
+        start = 0
+        while start < num:
+            end = start
+            if ties > 0:
+                while end + 1 < num and a[i, order[end + 1]] == a[i, order[start]]:
+                    end += 1
+            for k in range(start, end + 1):
+                if ties == 0:
+                    ranks[i, order[k]] = k
+                elif ties == 1:
+                    ranks[i, order[k]] = start
+                elif ties == 2:
+                    ranks[i, order[k]] = end
+                else:
+                    ranks[i, order[k]] = 0.5 * (start + end)
+            start = end + 1
+    return ranks
+
+
+def rank(s, lowest_first=True, axis=-1, ties='ordinal', use_numba=None):
     """
     Returns the ranking from lowest to highest (if lowest_first is True) of the elements in 'score' along 'axis'.
-    TODO: add 'axis' argument for ND arrays
+    Ranks start at 0. Missing values are ranked last.
 
     :param s: ndarray: array of scores
     :param lowest_first: bool: if True, ranks from lowest to highest score; otherwise from highest to lowest
+    :param axis: int: axis along which to rank
+    :param ties: str: handling of equal scores: 'ordinal' (in order of appearance), 'min' or 'max' (all get the
+        lowest or highest rank of the group), or 'average' (all get the mean rank of the group)
+    :param use_numba: bool: use the numba implementation, which is faster for many rows. If None, use it for 1024
+        or more rows.
     :return: ndarray: array of same shape as score containing ranks
     """
-    arg_sort = np.argsort(s)
+    if ties not in _TIES:
+        raise ValueError("'ties' must be one of %s" % list(_TIES.keys()))
+    s = np.asarray(s)
+    a = np.moveaxis(s, axis, -1)
     if not lowest_first:
-        arg_sort = arg_sort[::-1]
-    ranks = np.empty_like(s)
-    ranks[arg_sort] = np.arange(len(s))
-    return ranks
+        a = -a
+    a_shape = a.shape
+    a = a.reshape((-1, a_shape[-1]))
+    if use_numba is None:
+        use_numba = a.shape[0] >= 1024
+    if use_numba:
+        ranks = _rank_rows(np.ascontiguousarray(a, dtype=np.float64), _TIES[ties])
+    else:
+        order = np.argsort(a, axis=-1, kind='mergesort')
+        sorted_ranks = _tied_ranks(np.take_along_axis(a, order, axis=-1), ties)
+        # The inverse permutation of the sort puts the ranks back in place
+        ranks = np.take_along_axis(sorted_ranks, np.argsort(order, axis=-1, kind='mergesort'), axis=-1)
+    ranks = np.moveaxis(ranks.reshape(a_shape), -1, axis)
+    if ties == 'average' and not np.issubdtype(s.dtype, np.floating):
+        return ranks
+    return ranks.astype(s.dtype)
 
 
-def stdmean(a, axis=-1):
+def stdmean(a, axis=-1, keep_axes=()):
     """
     Normalize an array by the standard deviation of the variables in 'axis' (i.e., over all other axes) and then take
     the mean along 'axis'. Useful for averaging arrays with variables of different units.
 
     :param a: ndarray
     :param axis: int: axis along which to normalize and average
+    :param keep_axes: iter: axes (e.g., init date) over which the statistics are not pooled; the normalization is
+        done separately for each of their elements
     :return: ndarray: normalized mean
     """
-    axes = list(range(len(a.shape)))
-    del axes[axis]
-    axes = tuple(axes)
+    ndim = len(a.shape)
+    exclude = [axis % ndim] + [k % ndim for k in keep_axes]
+    axes = tuple(d for d in range(ndim) if d not in exclude)
     a_mean = np.nanmean(a, axis=axes, keepdims=True)
     a_std = np.nanstd(a, axis=axes, keepdims=True)
     a = (a - a_mean) / a_std
@@ -121,9 +228,14 @@ def absmean(a, axis=-1):
     return np.nanmean(np.abs(a), axis=axis)
 
 
+# Aggregation methods which reduce each row independently, so may be applied to all dates at once
+_ROW_AGGREGATIONS = (np.mean, np.nanmean, np.median, np.nanmedian, np.sum, np.nansum, sqmean, absmean)
+
+
 def rank_score(p, t, metric='mae', power=2., axis=-1):
     """
-    Calculate an agreggated score for a ranking of ensemble members, placing more weight on the best ensembles.
+    Calculate an agreggated score for a ranking of ensemble members, placing more weight on the best ensembles. The
+    arrays may have any number of dimensions, e.g. (date, member), giving a score for each element of the other axes.
 
     :param p: ndarray: predicted ranking
     :param t: ndarray: target ranking
@@ -132,13 +244,15 @@ def rank_score(p, t, metric='mae', power=2., axis=-1):
     :param axis: int: axis of calculation (ensemble member)
     :return: ndarray: rank score
     """
+    p = np.asarray(p)
+    t = np.asarray(t)
     if p.shape != t.shape:
         raise ValueError("shapes of 'p' and 't' must match")
     if metric not in ['mae', 'mse', 'rmse']:
         raise ValueError("'metric' must be 'mae', 'mse', or 'rmse'")
     num_ranks = p.shape[axis]
     weights_1d = ((num_ranks - np.arange(0, num_ranks)) / num_ranks) ** power
-    weights = weights_1d[t.astype(np.int)]
+    weights = weights_1d[np.clip(t, 0, num_ranks - 1).astype(int)]
     if metric == 'mae':
         r = np.abs(p - t)
     elif metric == 'mse':
@@ -5,13 +5,69 @@
 #
 
 import numpy as np
+from numpy.lib.stride_tricks import as_strided
 import pickle
 from datetime import timedelta
+from concurrent.futures import ThreadPoolExecutor
+from numba import jit
 import keras.backend as K
+from ..array_store import ArrayStore, load_arrays
+
+
+def _gather_samples(data, targets, predictors, v, rows, init_index, verif_index, train_index):
+    # Gather the target and history fields of the samples in 'rows' for variable v from data (time, member, fhour, y, x)
+    targets[rows, ..., v] = data[init_index[rows], :, verif_index[rows]]
+    predictors[rows, ..., v, :] = np.moveaxis(data[init_index[rows][:, None], :, train_index[rows]], 1, -1)
+
+
+def _regular_spacing(index, axis):
+    # Return the constant step of an integer index array along an axis, or None if the spacing is not constant
+    if index.shape[axis] < 2:
+        return 0
+    steps = np.diff(index, axis=axis)
+    if np.all(steps == steps.flat[0]):
+        return int(steps.flat[0])
+    return None
+
+
+def _window_views(block, init_index, verif_index, train_index):
+    # Strided views of targets and predictors over a (time, member, fhour, y, x, var) block, if the samples form a
+    # regular grid of (init, verif) with regularly spaced verification and training hours
+    inits = np.unique(init_index)
+    num_init = len(inits)
+    if num_init == 0 or len(init_index) % num_init != 0:
+        return None
+    num_verif = len(init_index) // num_init
+    shape = (num_init, num_verif)
+    if not np.array_equal(init_index, np.repeat(inits, num_verif)):
+        return None
+    init_grid = init_index.reshape(shape)[:, 0]
+    verif_grid = verif_index.reshape(shape)
+    train_grid = train_index.reshape(shape + (-1,))
+    init_step = _regular_spacing(init_grid, 0)
+    verif_step = _regular_spacing(verif_grid, 1)
+    train_verif_step = _regular_spacing(train_grid, 1)
+    train_step = _regular_spacing(train_grid, 2)
+    if None in (init_step, verif_step, train_verif_step, train_step):
+        return None
+    if not (np.all(verif_grid[:, 0] == verif_grid[0, 0]) and np.all(train_grid[:, 0, 0] == train_grid[0, 0, 0])):
+        return None
+    s_time, s_member, s_fhour, s_y, s_x, s_var = block.strides
+    base = block[init_grid[0]]
+    targets = as_strided(base[:, verif_grid[0, 0]], shape=shape + block.shape[1:2] + block.shape[3:],
+                         strides=(init_step * s_time, verif_step * s_fhour, s_member, s_y, s_x, s_var),
+                         writeable=False)
+    predictors = as_strided(base[:, train_grid[0, 0, 0]],
+                            shape=shape + block.shape[1:2] + block.shape[3:] + (train_grid.shape[-1],),
+                            strides=(init_step * s_time, train_verif_step * s_fhour, s_member, s_y, s_x, s_var,
+                                     train_step * s_fhour),
+                            writeable=False)
+    return predictors, targets
 
 
 def train_data_from_ensemble(ncar, xlim, ylim, variables=(), latlon=False, lead_time=1, train_time_steps=1,
-                             time_interval=1, split_ensemble_members=False, pickle_file=None, verbose=True):
+                             time_interval=1, split_ensemble_members=False, pickle_file=None, store_directory=None,
+                             n_jobs=1, dtype=np.float64, window_view=False, verbose=True):
     """
     Generate training and validation data from processed (written/loaded) NCAR ensemble files, for nowcasting. Data are
     hourly. Parameter 'lead_time' gives the forecast lead time in hours; 'train_time_steps' is the number of data time
@@ -29,8 +85,17 @@ def train_data_from_ensemble(ncar, xlim, ylim, variables=(), latlon=False, lead_
     :param time_interval: int: number of hours between training time steps, and between verifications
     :param split_ensemble_members: bool: return a separate training/validation set for each NCAR ensemble member
     :param pickle_file: str: if given, file to write pickled predictor and target arrays
+    :param store_directory: str: if given, directory of an ArrayStore (see ensemble_net.array_store) to which to
+        write the predictor and target arrays; read them with train_data_from_store
+    :param n_jobs: int: number of threads; if larger than 1, the samples of different init dates are gathered in
+        parallel
+    :param dtype: numpy dtype: data type of the returned arrays, e.g. np.float32 to halve their memory
+    :param window_view: bool: if True, return predictors and targets as read-only strided views of one loaded array
+        of all the variables, so that fields are not duplicated between samples. The arrays then have the dimensions
+        (init, verification, member, y, x, variable[, time step]), regardless of 'split_ensemble_members'. Requires
+        that every init date has the same regularly spaced verification and training hours.
     :param verbose: bool: print progress statements
-    :return:
+    :return: ndarray, ndarray: predictors, targets
     """
     # Test that data is loaded
     if ncar.Dataset is None:
@@ -45,6 +110,10 @@ def train_data_from_ensemble(ncar, xlim, ylim, variables=(), latlon=False, lead_
         raise ValueError("'train_time_steps' must be at least 1")
     if time_interval < 1 or time_interval > 24:
         raise ValueError("'time_interval' must be between 1 and 24 (hours)")
+    if n_jobs < 1:
+        raise ValueError("'n_jobs' must be a positive integer")
+    if window_view and (pickle_file is not None or store_directory is not None):
+        raise ValueError("'pickle_file' and 'store_directory' cannot be used with 'window_view'")
 
     # Get the indexes of all training sample and corresponding verifications
     num_init = len(ncar.dataset_init_dates)
@@ -100,11 +169,12 @@ def train_data_from_ensemble(ncar, xlim, ylim, variables=(), latlon=False, lead_
     num_var = len(variables)
     num_samples = len(grand_time_list)
     num_members = ncar.Dataset.dims['member']
-    targets = np.full((num_samples, num_members, num_y, num_x, num_var), np.nan)
-    predictors = np.full((num_samples, num_members, num_y, num_x, num_var, train_time_steps), np.nan)
+    if not window_view:
+        targets = np.full((num_samples, num_members, num_y, num_x, num_var), np.nan, dtype=dtype)
+        predictors = np.full((num_samples, num_members, num_y, num_x, num_var, train_time_steps), np.nan,
+                             dtype=dtype)
 
     # Add the data to the arrays
-    print('train_data_from_ensemble: strap in; this is gonna take a while.')
     if verbose:
         print('train_data_from_ensemble: dropping unnecessary variables')
     new_ds = ncar.Dataset.copy()
@@ -115,24 +185,46 @@ def train_data_from_ensemble(ncar, xlim, ylim, variables=(), latlon=False, lead_
         print('train_data_from_ensemble: reading all the data in the spatial subset')
     try:
         new_ds = new_ds.isel(south_north=range(y1, y2), west_east=range(x1, x2))
+        spatial_dims = ('south_north', 'west_east')
     except ValueError:
         new_ds = new_ds.isel(lat=range(y1, y2), lon=range(x1, x2))
+        spatial_dims = ('lat', 'lon')
     new_ds.load()
+    # Integer indices of the init date, verification hour, and training hours of every sample
+    init_index = np.array([ind[0] for ind in grand_index_list], dtype=int)
+    verif_index = np.array([ind[1] for ind in grand_index_list], dtype=int)
+    train_index = np.array([ind[2] for ind in grand_index_list], dtype=int).reshape((num_samples, train_time_steps))
+    if window_view:
+        if verbose:
+            print('train_data_from_ensemble: loading all variables into one array')
+        block = None
+        for v in range(num_var):
+            data = new_ds[variables[v]].transpose('time', 'member', 'fhour', *spatial_dims).values
+            if block is None:
+                block = np.empty(data.shape + (num_var,), dtype=dtype)
+            block[..., v] = data
+        views = None if block is None else _window_views(block, init_index, verif_index, train_index)
+        if views is None:
+            raise ValueError("'window_view' requires the same regularly spaced verification and training hours for "
+                             "every init date")
+        return views
+
+    if n_jobs > 1:
+        sample_groups = [np.where(init_index == init)[0] for init in np.unique(init_index)]
+    else:
+        sample_groups = [np.arange(num_samples)]
     for v in range(num_var):
         variable = variables[v]
-        for member in range(num_members):
-            for sample in range(num_samples):
-                if verbose:
-                    print('variable %d of %d, ensemble member %d of %d, sample %d of %d' % (v+1, num_var, member+1,
-                                                                                            num_members, sample+1,
-                                                                                            num_samples))
-                ind = grand_index_list[sample]
-                targets[sample, member, :, :, v] = np.squeeze(new_ds[variable].isel(time=ind[0], member=member,
-                                                                                    fhour=ind[1]).values)
-                predictors[sample, member, :, :, v, :] = ((new_ds[variable].isel(time=ind[0], member=member,
-                                                                                 fhour=ind[2]).values)
-                                                           .reshape((train_time_steps, num_y, num_x))
-                                                           .transpose((1, 2, 0)))
+        if verbose:
+            print('train_data_from_ensemble: gathering variable %d of %d (%s)' % (v + 1, num_var, variable))
+        data = new_ds[variable].transpose('time', 'member', 'fhour', *spatial_dims).values
+        if n_jobs > 1:
+            with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+                for future in [executor.submit(_gather_samples, data, targets, predictors, v, rows, init_index,
+                                               verif_index, train_index) for rows in sample_groups]:
+                    future.result()
+        else:
+            _gather_samples(data, targets, predictors, v, sample_groups[0], init_index, verif_index, train_index)
 
     # Format arrays according to split_ensemble_members
     if not split_ensemble_members:
@@ -148,6 +240,10 @@ def train_data_from_ensemble(ncar, xlim, ylim, variables=(), latlon=False, lead_
         with open(pickle_file, 'wb') as handle:
             pickle.dump(save_vars, handle, pickle.HIGHEST_PROTOCOL)
 
+    # Save to an array store, if requested
+    if store_directory is not None:
+        train_data_to_store(store_directory, predictors, targets)
+
     return predictors, targets
 
 
@@ -181,6 +277,33 @@ def train_data_from_pickle(pickle_file,):
     return save_vars['predictors'], save_vars['targets']
 
 
+def train_data_to_store(store_directory, predictors, targets):
+    """
+    Writes predictor and target arrays to an ArrayStore (see ensemble_net.array_store), which can be read partially
+    and in parallel, unlike a pickle file.
+
+    :param store_directory: str: directory of the store
+    :param predictors: ndarray
+    :param targets: ndarray
+    :return:
+    """
+    store = ArrayStore(store_directory, mode='a')
+    store.write('predictors', predictors)
+    store.write('targets', targets)
+
+
+def train_data_from_store(store_directory, mmap=True):
+    """
+    Reads predictor and target arrays from an ArrayStore written by train_data_to_store.
+
+    :param store_directory: str: directory of the store
+    :param mmap: bool: if True, return read-only memory maps instead of loading the arrays into memory
+    :return: predictors, targets: ndarrays
+    """
+    arrays = load_arrays(store_directory, 'predictors', 'targets', mmap=mmap)
+    return arrays['predictors'], arrays['targets']
+
+
 def reshape_keras_inputs(predictors):
     """
     Accepts ndarrays of predictor data and reshapes it to the shape expected by the Keras backend. The array provided
@@ -224,36 +347,104 @@ def reshape_keras_targets(targets, omit_edge_points=0):
     return targets, target_shape[1:], num_outputs
 
 
-def delete_nan_samples(predictors, targets, large_fill_value=True, threshold=None):
+@jit(nopython=True)
+def _count_missing(a, large_fill_value, replace):
+    # Count NaN and fill values (|x| > 1e30) in each row of a 2-D array, optionally replacing fill values with NaN
+    nan_count = np.zeros(a.shape[0], dtype=np.int64)
+    fill_count = np.zeros(a.shape[0], dtype=np.int64)
+    for i in range(a.shape[0]):
+        for j in range(a.shape[1]):
+            value = a[i, j]
+            if np.isnan(value):
+                nan_count[i] += 1
+            elif large_fill_value and (value > 1.e30 or value < -1.e30):
+                fill_count[i] += 1
+                if replace:
+                    a[i, j] = np.nan
+    return nan_count, fill_count
+
+
+@jit(nopython=True)
+def _compact_rows(a, keep):
+    # Move the rows to keep to the start of a 2-D array, in order; return the number of rows kept
+    n = 0
+    for i in range(a.shape[0]):
+        if keep[i]:
+            if i != n:
+                a[n, :] = a[i, :]
+            n += 1
+    return n
+
+
+def _missing_counts(a, large_fill_value, replace):
+    if not np.issubdtype(a.dtype, np.floating):
+        return np.zeros(a.shape[0], dtype=np.int64), np.zeros(a.shape[0], dtype=np.int64)
+    return _count_missing(a, large_fill_value, replace)
+
+
+def delete_nan_samples(predictors, targets, large_fill_value=True, threshold=None, inplace=False, return_stats=False):
     """
-    Delete any samples from the predictor and target numpy arrays and return new, reduced versions.
+    Delete any samples from the predictor and target numpy arrays and return new, reduced versions. Missing values
+    are counted for each sample in one pass over the arrays. Fill values in the returned samples are set to NaN.
 
     :param predictors: ndarray, shape [num_samples,...]: predictor data
     :param targets: ndarray, shape [num_samples,...]: target data
     :param large_fill_value: bool: if True, treats very large values (> 1e30) as NaNs
     :param threshold: float 0-1: if not None, then removes any samples with a fraction of NaN larger than this
-    :return: predictors, targets: ndarrays with samples removed
+    :param inplace: bool: if True, replace fill values with NaN in the input arrays and move the kept samples to the
+        start of the inputs, returning views of them instead of new arrays. Otherwise the inputs are not modified.
+    :param return_stats: bool: if True, also return a dictionary with the number of samples, the number kept and
+        dropped, the number dropped because of the predictors and because of the targets, and the numbers of NaN and
+        fill values found
+    :return: predictors, targets: ndarrays with samples removed (dict: statistics)
     """
     if threshold is not None and not (0 <= threshold <= 1):
         raise ValueError("'threshold' must be between 0 and 1")
-    if large_fill_value:
-        predictors[(predictors > 1.e30) | (predictors < -1.e30)] = np.nan
-        targets[(targets > 1.e30) | (targets < -1.e30)] = np.nan
     p_shape = predictors.shape
     t_shape = targets.shape
-    predictors = predictors.reshape((p_shape[0], -1))
-    targets = targets.reshape((t_shape[0], -1))
+    if p_shape[0] != t_shape[0]:
+        raise ValueError("'predictors' and 'targets' must have the same number of samples")
+    predictors_2d = predictors.reshape((p_shape[0], -1))
+    targets_2d = targets.reshape((t_shape[0], -1))
+    p_nan, p_fill = _missing_counts(predictors_2d, large_fill_value, inplace)
+    t_nan, t_fill = _missing_counts(targets_2d, large_fill_value, inplace)
     if threshold is None:
-        p_ind = list(np.where(np.isnan(predictors))[0])
-        t_ind = list(np.where(np.isnan(targets))[0])
+        p_bad = (p_nan + p_fill) > 0
+        t_bad = (t_nan + t_fill) > 0
     else:
-        p_ind = list(np.where(np.mean(np.isnan(predictors), axis=1) >= threshold)[0])
-        t_ind = list(np.where(np.mean(np.isnan(targets), axis=1) >= threshold)[0])
-    bad_ind = list(set(p_ind + t_ind))
-    predictors = np.delete(predictors, bad_ind, axis=0)
-    targets = np.delete(targets, bad_ind, axis=0)
-    new_p_shape = (predictors.shape[0],) + p_shape[1:]
-    new_t_shape = (targets.shape[0],) + t_shape[1:]
-    return predictors.reshape(new_p_shape), targets.reshape(new_t_shape)
-
+        p_bad = (p_nan + p_fill) >= threshold * predictors_2d.shape[1]
+        t_bad = (t_nan + t_fill) >= threshold * targets_2d.shape[1]
+    keep = ~(p_bad | t_bad)
 
+    if inplace:
+        num_kept = _compact_rows(predictors_2d, keep)
+        _compact_rows(targets_2d, keep)
+        predictors_2d = predictors_2d[:num_kept]
+        targets_2d = targets_2d[:num_kept]
+    else:
+        num_kept = int(np.sum(keep))
+        if num_kept < keep.shape[0]:
+            predictors_2d = predictors_2d[keep]
+            targets_2d = targets_2d[keep]
+        else:
+            predictors_2d = predictors_2d.copy()
+            targets_2d = targets_2d.copy()
+        # Samples with fill values may remain when using a threshold
+        if large_fill_value and np.any(p_fill[keep]):
+            _missing_counts(predictors_2d, large_fill_value, True)
+        if large_fill_value and np.any(t_fill[keep]):
+            _missing_counts(targets_2d, large_fill_value, True)
+    predictors = predictors_2d.reshape((num_kept,) + p_shape[1:])
+    targets = targets_2d.reshape((num_kept,) + t_shape[1:])
+    if return_stats:
+        stats = {
+            'samples': int(keep.shape[0]),
+            'kept': int(num_kept),
+            'dropped': int(keep.shape[0] - num_kept),
+            'dropped_predictors': int(np.sum(p_bad)),
+            'dropped_targets': int(np.sum(t_bad)),
+            'nan_values': int(np.sum(p_nan) + np.sum(t_nan)),
+            'fill_values': int(np.sum(p_fill) + np.sum(t_fill))
+        }
+        return predictors, targets, stats
+    return predictors, targets
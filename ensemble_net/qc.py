@@ -0,0 +1,158 @@
+#
+# Copyright (c) 2017-18 Jonathan Weyn <jweyn@uw.edu>
+#
+# See the file LICENSE for your rights.
+#
+
+"""
+Quality-control tools for station data. Computes the completeness of every station (and every variable at every
+station) in one vectorized pass, from which a mask of stations to keep is applied once. Works with ae_meso error
+Datasets, in either the per-station or the dense station layout, and with the station dictionary of a MesoWest object.
+"""
+
+import numpy as np
+import xarray as xr
+from collections import OrderedDict
+
+
+def _check_tolerance(missing_tolerance):
+    if missing_tolerance < 0. or missing_tolerance > 1.:
+        raise ValueError("'missing_tolerance' must be a float between 0 and 1")
+
+
+def completeness(data, station_dim='station', variable_dim='variable'):
+    """
+    Compute completeness statistics of station data. Returns an xarray Dataset along the station dimension with the
+    variables:
+        'count': number of non-missing values
+        'size': total number of values
+        'fraction': fraction of non-missing values
+        'variable_fraction': fraction of non-missing values of each variable (station, variable)
+    If the data are lazily loaded (dask), the result is also lazy; call .compute() or .load() on it.
+
+    :param data: one of: xarray DataArray with a station dimension; ae_meso Dataset in the dense layout (uses its
+        'error' variable); ae_meso Dataset with stations as variables; or dict of pandas DataFrames (MesoWest.Data)
+    :param station_dim: str: name of the station dimension of a DataArray
+    :param variable_dim: str: name of the variable dimension of a DataArray
+    :return: xarray Dataset: completeness statistics
+    """
+    if isinstance(data, dict):
+        stations = list(data.keys())
+        variables = sorted(set(c for df in data.values() for c in df.columns))
+        var_count = np.zeros((len(stations), len(variables)))
+        var_size = np.zeros((len(stations), len(variables)))
+        for s, df in enumerate(data.values()):
+            v_ind = [variables.index(c) for c in df.columns]
+            var_count[s, v_ind] = df.count().values
+            var_size[s, v_ind] = len(df.index)
+        count = xr.DataArray(var_count.sum(axis=1), coords=[('station', stations)])
+        size = xr.DataArray(var_size.sum(axis=1), coords=[('station', stations)])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            variable_fraction = xr.DataArray(var_count / var_size, coords=[('station', stations),
+                                                                           ('variable', variables)])
+    else:
+        if isinstance(data, xr.Dataset):
+            if station_dim in data.dims:
+                data = data['error']
+            else:
+                data = data.to_array(dim=station_dim)
+        other_dims = [d for d in data.dims if d != station_dim]
+        valid = data.notnull()
+        count = valid.sum(dim=other_dims)
+        size = xr.full_like(count, int(np.prod([data.sizes[d] for d in other_dims])))
+        if variable_dim in data.dims:
+            variable_fraction = valid.mean(dim=[d for d in other_dims if d != variable_dim])
+        else:
+            variable_fraction = valid.mean(dim=other_dims).expand_dims(variable_dim, axis=-1)
+        variable_fraction = variable_fraction.transpose(station_dim, variable_dim)
+        if station_dim != 'station':
+            count = count.rename({station_dim: 'station'})
+            size = size.rename({station_dim: 'station'})
+            variable_fraction = variable_fraction.rename({station_dim: 'station'})
+        if variable_dim != 'variable':
+            variable_fraction = variable_fraction.rename({variable_dim: 'variable'})
+
+    stats = xr.Dataset({
+        'count': count,
+        'size': size,
+        'fraction': count / size,
+        'variable_fraction': variable_fraction
+    })
+    return stats
+
+
+def keep_mask(stats, missing_tolerance, relative=False):
+    """
+    Return a boolean mask of the stations to keep, given completeness statistics from 'completeness'.
+
+    :param stats: xarray Dataset: result of 'completeness'
+    :param missing_tolerance: float: fraction (0 to 1) of values which are tolerated as missing
+    :param relative: bool: if True, the fraction of missing values is relative to the most complete station instead
+        of to the total number of values of each station
+    :return: ndarray: boolean mask along the station dimension
+    """
+    _check_tolerance(missing_tolerance)
+    count = np.asarray(stats['count'].values)
+    if relative:
+        reference = np.max(count) if count.size > 0 else 0
+    else:
+        reference = np.asarray(stats['size'].values)
+    return count >= (1. - missing_tolerance) * reference
+
+
+def tolerance_table(stats, tolerances=(0., 0.01, 0.02, 0.05, 0.1, 0.2, 0.5), relative=False):
+    """
+    Count the number of stations kept for each of several missing-value tolerances, to help in choosing a tolerance
+    without re-computing the statistics.
+
+    :param stats: xarray Dataset: result of 'completeness'
+    :param tolerances: iter: missing-value tolerances to test
+    :param relative: bool: see 'keep_mask'
+    :return: xarray DataArray: number of stations kept for each tolerance
+    """
+    kept = [np.sum(keep_mask(stats, t, relative=relative)) for t in tolerances]
+    return xr.DataArray(kept, coords=[('tolerance', list(tolerances))], name='stations_kept')
+
+
+def trim_ae_meso(ds, missing_tolerance, return_stats=False, **compute_kwargs):
+    """
+    Remove stations from an ae_meso error Dataset which have a larger fraction of missing values than
+    'missing_tolerance'. Works with the per-station and the dense station layouts. Only the statistics are computed;
+    a lazily-loaded (dask) Dataset stays lazy.
+
+    :param ds: xarray Dataset: result of ensemble_net.verify.ae_meso()
+    :param missing_tolerance: float: fraction (0 to 1) of values which are tolerated as missing
+    :param return_stats: bool: if True, also return the completeness statistics of all stations
+    :param compute_kwargs: passed to dask when computing the statistics, e.g. num_workers
+    :return: xarray Dataset: trimmed Dataset (xarray Dataset: completeness statistics)
+    """
+    _check_tolerance(missing_tolerance)
+    stats = completeness(ds).load(**compute_kwargs)
+    keep = keep_mask(stats, missing_tolerance)
+    if 'station' in ds.dims:
+        ds = ds.isel(station=np.where(keep)[0])
+    else:
+        stations = np.array(list(ds.data_vars.keys()))
+        ds = ds[[str(s) for s in stations[keep]]]
+    if return_stats:
+        return ds, stats
+    return ds
+
+
+def trim_meso_data(data, missing_tolerance, return_stats=False):
+    """
+    Remove stations from a dictionary of station DataFrames (MesoWest.Data) which have a larger fraction of missing
+    values than 'missing_tolerance', relative to the station with the most non-missing values.
+
+    :param data: dict of pandas DataFrames
+    :param missing_tolerance: float: fraction (0 to 1) of values which are tolerated as missing
+    :param return_stats: bool: if True, also return the completeness statistics of all stations
+    :return: OrderedDict: trimmed dictionary (xarray Dataset: completeness statistics)
+    """
+    _check_tolerance(missing_tolerance)
+    stats = completeness(data)
+    keep = keep_mask(stats, missing_tolerance, relative=True)
+    new_data = OrderedDict((s, df) for (s, df), k in zip(data.items(), keep) if k)
+    if return_stats:
+        return new_data, stats
+    return new_data
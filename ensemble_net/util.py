@@ -9,6 +9,8 @@ Ensemble-net utilities.
 """
 
 from datetime import datetime
+import os
+import json
 import types
 import pickle
 import tempfile
@@ -137,6 +139,198 @@ def load_model(file_name):
     return model
 
 
+_COMPACT_INDEX = 'model.json'
+
+
+def _to_json_value(value):
+    # Convert numpy scalars for JSON; raises TypeError for values which are not JSON-serializable
+    if isinstance(value, np.generic):
+        return value.item()
+    json.dumps(value)
+    return value
+
+
+def _save_estimator(estimator, name, directory):
+    config = {
+        'class': [type(estimator).__module__, type(estimator).__name__],
+        'params': {k: _to_json_value(v) for k, v in estimator.get_params(deep=False).items()},
+        'attributes': {},
+        'arrays': []
+    }
+    for attr, value in vars(estimator).items():
+        if not attr.endswith('_') or attr.startswith('_'):
+            continue
+        if isinstance(value, np.ndarray):
+            np.save(os.path.join(directory, 'estimators', '%s.%s.npy' % (name, attr)), value)
+            config['arrays'].append(attr)
+        else:
+            config['attributes'][attr] = _to_json_value(value)
+    return config
+
+
+def _load_estimator(config, name, directory):
+    estimator_class = get_from_class(*config['class'])
+    estimator = estimator_class(**config['params'])
+    for attr, value in config['attributes'].items():
+        setattr(estimator, attr, value)
+    for attr in config['arrays']:
+        setattr(estimator, attr, np.load(os.path.join(directory, 'estimators', '%s.%s.npy' % (name, attr))))
+    return estimator
+
+
+def _training_config(keras_model):
+    # Compile options of a Keras model, if they can be written as JSON
+    optimizer = getattr(keras_model, 'optimizer', None)
+    if optimizer is None:
+        return None
+    try:
+        config = {
+            'optimizer': {'class_name': type(optimizer).__name__, 'config': optimizer.get_config()},
+            'loss': keras_model.loss,
+            'metrics': list(getattr(keras_model, 'metrics', None) or [])
+        }
+        return json.loads(json.dumps(config, default=_to_json_value))
+    except (TypeError, ValueError):
+        return None
+
+
+def save_model_compact(model, directory, history=None):
+    """
+    Saves a class instance with a 'model' attribute (e.g., EnsembleSelector or NowCast) to a directory, without
+    pickling the Keras model. The directory contains:
+        model.json: the Keras architecture and compile options, the instance's class and simple attributes, and the
+            parameters of its scikit-learn estimators (Scaler, Imputer)
+        weights/: each Keras weight array as a .npy file
+        estimators/: fitted arrays of the scikit-learn estimators as .npy files
+        extra.pkl: pickle of any remaining attributes, if there are any
+    Use `load_model_compact()` to load a model saved with this method.
+
+    :param model: model instance (with a 'model' attribute) to save
+    :param directory: str: directory in which to save the model
+    :param history: history from Keras fitting, or None
+    :return:
+    """
+    keras_model = model.model
+    if isinstance(keras_model, LazyKerasModel):
+        keras_model = keras_model.keras_model
+    os.makedirs(os.path.join(directory, 'weights'), exist_ok=True)
+    os.makedirs(os.path.join(directory, 'estimators'), exist_ok=True)
+
+    index = {
+        'class': [type(model).__module__, type(model).__name__],
+        'attributes': {},
+        'estimators': {},
+        'keras': None
+    }
+    extra = {}
+    for attr, value in vars(model).items():
+        if attr == 'model':
+            continue
+        if hasattr(value, 'get_params'):
+            index['estimators'][attr] = _save_estimator(value, attr, directory)
+            continue
+        try:
+            index['attributes'][attr] = _to_json_value(value)
+        except (TypeError, ValueError):
+            extra[attr] = value
+    if keras_model is not None:
+        weights = keras_model.get_weights()
+        for w, weight in enumerate(weights):
+            np.save(os.path.join(directory, 'weights', '%05d.npy' % w), weight)
+        index['keras'] = {
+            'architecture': json.loads(keras_model.to_json()),
+            'num_weights': len(weights),
+            'training_config': _training_config(keras_model)
+        }
+    if extra:
+        with open(os.path.join(directory, 'extra.pkl'), 'wb') as f:
+            pickle.dump(extra, f, protocol=pickle.HIGHEST_PROTOCOL)
+    with open(os.path.join(directory, _COMPACT_INDEX), 'w') as f:
+        json.dump(index, f, indent=1)
+    if history is not None:
+        with open(os.path.join(directory, 'history.json'), 'w') as f:
+            json.dump(history.history, f, default=_to_json_value)
+
+
+def _build_keras_model(directory, compile=True):
+    with open(os.path.join(directory, _COMPACT_INDEX), 'r') as f:
+        config = json.load(f)['keras']
+    if config is None:
+        return None
+    custom_layers = {
+        'PartialConv2D': PartialConv2D
+    }
+    keras_model = keras.models.model_from_json(json.dumps(config['architecture']), custom_objects=custom_layers)
+    weights = [np.load(os.path.join(directory, 'weights', '%05d.npy' % w), mmap_mode='r')
+               for w in range(config['num_weights'])]
+    keras_model.set_weights(weights)
+    training_config = config['training_config']
+    if compile and training_config is not None:
+        optimizer = keras.optimizers.deserialize(training_config['optimizer'])
+        keras_model.compile(optimizer=optimizer, loss=training_config['loss'], metrics=training_config['metrics'])
+    return keras_model
+
+
+class LazyKerasModel(object):
+    """
+    Stand-in for a Keras model saved with `save_model_compact()`. The Keras model is built from the saved files on
+    first use; attribute access is then forwarded to it. Pickling stores only the directory, so the object may be
+    sent to worker processes cheaply, and each process loads the weights from disk (memory-mapped) when needed.
+    """
+
+    def __init__(self, directory, compile=True):
+        self.directory = directory
+        self.compile_model = compile
+        self._model = None
+
+    @property
+    def keras_model(self):
+        if self._model is None:
+            self._model = _build_keras_model(self.directory, compile=self.compile_model)
+        return self._model
+
+    def __getattr__(self, item):
+        if item.startswith('__') or item in ['directory', 'compile_model', '_model']:
+            raise AttributeError(item)
+        return getattr(self.keras_model, item)
+
+    def __getstate__(self):
+        return {'directory': self.directory, 'compile_model': self.compile_model}
+
+    def __setstate__(self, state):
+        self.directory = state['directory']
+        self.compile_model = state['compile_model']
+        self._model = None
+
+
+def load_model_compact(directory, lazy=True, compile=True):
+    """
+    Loads a model saved to disk with the `save_model_compact()` method.
+
+    :param directory: str: directory of the saved model
+    :param lazy: bool: if True, the Keras model is a LazyKerasModel, built on first use
+    :param compile: bool: if True, compile the Keras model with its saved optimizer, loss, and metrics
+    :return: model: loaded object
+    """
+    with open(os.path.join(directory, _COMPACT_INDEX), 'r') as f:
+        index = json.load(f)
+    model_class = get_from_class(*index['class'])
+    model = model_class.__new__(model_class)
+    model.__dict__.update(index['attributes'])
+    for attr, config in index['estimators'].items():
+        setattr(model, attr, _load_estimator(config, attr, directory))
+    if os.path.isfile(os.path.join(directory, 'extra.pkl')):
+        with open(os.path.join(directory, 'extra.pkl'), 'rb') as f:
+            model.__dict__.update(pickle.load(f))
+    if index['keras'] is None:
+        model.model = None
+    elif lazy:
+        model.model = LazyKerasModel(directory, compile=compile)
+    else:
+        model.model = _build_keras_model(directory, compile=compile)
+    return model
+
+
 # ==================================================================================================================== #
 # Custom Keras classes
 # ==================================================================================================================== #
@@ -11,29 +11,102 @@ Utility methods for processing data from the verify methods.
 from datetime import datetime, timedelta
 import xarray as xr
 import numpy as np
+from ..qc import trim_ae_meso
 
 
-def combine_ae_meso(*files, missing_tolerance=None, new_file_out=None):
+def is_dense_ae_meso(ds):
     """
-    Combine the station error data from multiple netCDF files, concatenating in time.
-    :param files:
-    :param missing_tolerance:
-    :param new_file_out:
-    :return:
+    Check whether an ae_meso error Dataset uses the dense station layout (see ae_meso_to_dense).
+
+    :param ds: xarray Dataset: result of ensemble_net.verify.ae_meso()
+    :return: bool
+    """
+    return 'station' in ds.dims
+
+
+def ae_meso_to_dense(ds, name='error'):
+    """
+    Convert an ae_meso error Dataset with one data variable per station into a dense layout, with a single data
+    variable of dimensions (station, time, member, fhour, variable) and the station latitudes and longitudes as the
+    'station_lat' and 'station_lon' coordinates. Lazily-loaded (dask) Datasets remain lazy.
+
+    :param ds: xarray Dataset: result of ensemble_net.verify.ae_meso() with stations as variables
+    :param name: str: name of the error variable in the new Dataset
+    :return: xarray Dataset: dense Dataset
     """
-    ds = xr.open_mfdataset(files, concat_dim='time')
-    ds.load()
+    if is_dense_ae_meso(ds):
+        return ds
     stations = list(ds.data_vars.keys())
+    error = ds.to_array(dim='station', name=name)
+    new_ds = xr.Dataset({name: error}, attrs=ds.attrs)
+    new_ds.coords['station_lat'] = ('station', np.array([ds[s].attrs['LATITUDE'] for s in stations], dtype=np.float64))
+    new_ds.coords['station_lon'] = ('station', np.array([ds[s].attrs['LONGITUDE'] for s in stations], dtype=np.float64))
+    new_ds['station_lat'].attrs = {'long_name': 'Latitude of individual stations', 'units': 'degrees_north'}
+    new_ds['station_lon'].attrs = {'long_name': 'Longitude of individual stations', 'units': 'degrees_east'}
+    return new_ds
+
+
+def ae_meso_from_dense(ds, name='error'):
+    """
+    Convert a dense ae_meso error Dataset (see ae_meso_to_dense) back to the layout with one data variable per station
+    and the station latitude and longitude in the attributes of each variable.
+
+    :param ds: xarray Dataset: dense error Dataset
+    :param name: str: name of the error variable in the dense Dataset
+    :return: xarray Dataset: Dataset with stations as variables
+    """
+    if not is_dense_ae_meso(ds):
+        return ds
+    lats = ds['station_lat'].values
+    lons = ds['station_lon'].values
+    new_ds = ds[name].reset_coords(drop=True).to_dataset(dim='station')
+    new_ds.attrs = ds.attrs
+    for s, station in enumerate(ds['station'].values):
+        new_ds[station].attrs['LATITUDE'] = float(lats[s])
+        new_ds[station].attrs['LONGITUDE'] = float(lons[s])
+    return new_ds
+
+
+def ae_meso_region(ds, xlim, ylim):
+    """
+    Subset the stations of a dense ae_meso error Dataset to those within a longitude/latitude box.
+
+    :param ds: xarray Dataset: dense error Dataset
+    :param xlim: tuple or list: longitude limits
+    :param ylim: tuple or list: latitude limits
+    :return: xarray Dataset: Dataset with the stations inside the box
+    """
+    lats = ds['station_lat'].values
+    lons = ds['station_lon'].values
+    inside = (lats >= min(ylim)) & (lats <= max(ylim)) & (lons >= min(xlim)) & (lons <= max(xlim))
+    return ds.isel(station=np.where(inside)[0])
+
+
+def combine_ae_meso(*files, missing_tolerance=None, new_file_out=None, chunks=None, parallel=False,
+                    num_workers=None):
+    """
+    Combine the station error data from multiple netCDF files, concatenating in time. The files may use either the
+    per-station or the dense station layout; the result has the same layout as the files. The data are never loaded
+    into memory all at once: missing-value fractions are computed chunk by chunk with dask, and the combined data are
+    written to new_file_out chunk by chunk. The returned Dataset is lazily loaded; call .load() to load it.
+
+    :param files: str: netCDF files to combine
+    :param missing_tolerance: float: if not None, remove stations with a larger fraction of missing values
+    :param new_file_out: str: if not None, write the combined data to this netCDF file and return that file's data
+    :param chunks: dict: dask chunk sizes per dimension, e.g. {'time': 100}. The default is one chunk per file.
+    :param parallel: bool: open the files in parallel with dask
+    :param num_workers: int: number of threads used by dask for computing (default: all cores)
+    :return: xarray Dataset: combined data
+    """
+    compute_kwargs = {} if num_workers is None else {'num_workers': num_workers}
+    ds = xr.open_mfdataset(files, concat_dim='time', chunks=chunks, parallel=parallel)
 
     if missing_tolerance is not None:
-        if missing_tolerance < 0. or missing_tolerance > 1.:
-            raise ValueError("'missing_tolerance' must be a float between 0 and 1")
-        for station in stations:
-            if np.sum(np.isnan(ds[station].values)) / ds[station].size > missing_tolerance:
-                ds = ds.drop(station)
+        ds = trim_ae_meso(ds, missing_tolerance, **compute_kwargs)
 
     if new_file_out is not None:
-        ds.to_netcdf(new_file_out)
+        ds.to_netcdf(new_file_out, compute=False).compute(**compute_kwargs)
+        ds.close()
+        ds = xr.open_dataset(new_file_out, chunks=chunks or {})
 
     return ds
-
@@ -10,22 +10,25 @@ Methods for verifying ensemble data using various data_tools classes.
 
 from ..data_tools import NCARArray, IEMRadar, MesoWest
 from ..calc import probability_matched_mean, fss
+from .util import ae_meso_to_dense
 from datetime import datetime, timedelta
 import xarray as xr
 import numpy as np
 from scipy.interpolate import griddata
 
 
-def ae_meso(ensemble, meso, variables='all', stations='all', verbose=True):
+def ae_meso(ensemble, meso, variables='all', stations='all', dense=False, verbose=True):
     """
     Calculate absolute error for ensemble forecasts at given MesoWest observations. Returns an xarray dataset with
-    stations as variables, and init_dates, times, members, and variables as dimensions.
+    stations as variables, and init_dates, times, members, and variables as dimensions. If 'dense' is True, instead
+    returns a single 'error' variable with a station dimension (see ensemble_net.verify.util.ae_meso_to_dense).
 
     :param ensemble: NCARArray object with loaded data
     :param meso: MesoWest object with loaded data
     :param variables: iter: iterable of variables to verify, or string 'all' for all matching variables
     :param stations: iter: iterable of string station IDs, or 'all' for all available stations. Stations outside of the
         lat/lon range of the ensemble will be ignored.
+    :param dense: bool: if True, return the dense station layout
     :param verbose: bool: print out progress statements
     :return:
     """
@@ -95,6 +98,8 @@ def ae_meso(ensemble, meso, variables='all', stations='all', verbose=True):
         ds[stid].attrs['LATITUDE'] = float(meso.Metadata[stid]['LATITUDE'])
         ds[stid].attrs['LONGITUDE'] = float(meso.Metadata[stid]['LONGITUDE'])
 
+    if dense:
+        return ae_meso_to_dense(ds)
     return ds
 
 